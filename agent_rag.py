@@ -1,21 +1,50 @@
 import os
 import json
+import asyncio
+import time
 from typing import Annotated, Sequence, TypedDict, Callable, Optional
 import difflib
 import re
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
+import numpy as np
 from langchain_core.messages import BaseMessage, ToolMessage, SystemMessage, HumanMessage, AIMessage
 from langchain_openai import ChatOpenAI
 from sentence_transformers import SentenceTransformer
 from langgraph.graph import StateGraph, END
-from langchain_text_splitters  import RecursiveCharacterTextSplitter
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableLambda
 from langchain_chroma import Chroma
-from langchain_community.document_loaders import PyPDFLoader
 
 from operator import add as add_messages
 from dotenv import load_dotenv
 
+from numpy_store import NumpyVectorStore
+from lexical_index import get_lexical_index
+from caching import LRUCache
+from rerankers import RerankingRetriever, get_reranker
+from retrievers import CachedRetriever, HybridRetriever, MMRRetriever, merge_with_source_diversity, multi_query_retrieve
+from embedding_cache import EmbeddingCache, get_embedding_cache, normalized_text_hash
+from file_locks import file_lock
+from llm_cache import get_llm_response_cache, messages_fingerprint
+from history_search import get_history_vector_index
+from term_stats import get_discussion_term_stats
+from context_budget import TokenBudget, compact_json, count_tokens, fit_newest, merge_chunks, token_budget
+from history_store import HistoryCache, get_history_store
+from ingestion import (
+    file_sha256,
+    iter_batches,
+    iter_chunk_stream,
+    iter_page_chunks,
+    iter_pdf_pages,
+    load_pdf_pages,
+    make_chunk_id,
+    split_pages_into_chunks,
+    text_sha1,
+)
+
 def build_llm(model: str = "nvidia/nemotron-nano-12b-v2-vl:free", temperature: float = 0):
     llm = ChatOpenAI(
         model=model,
@@ -25,190 +54,959 @@ def build_llm(model: str = "nvidia/nemotron-nano-12b-v2-vl:free", temperature: f
     )
     return llm
 
-def build_embeddings(embedding_model_name: str = "all-MiniLM-L6-v2"):
-    class SentenceTransformerEmbeddings:
-        def __init__(self, model_name):
-            # Carregar modelo com configurações explícitas para evitar problemas com meta tensors
-            import torch
-            import os
-            import gc
-            
-            # Forçar carregamento sem meta tensors
-            os.environ.setdefault("TRANSFORMERS_NO_ADVISORY_WARNINGS", "1")
-            
-            # Limpar cache antes de carregar
+# Registro de modelos compartilhado pelo processo: cada (modelo, device) é carregado
+# uma única vez e reutilizado por todas as sessões/threads do Streamlit.
+_MODEL_REGISTRY: dict = {}
+_MODEL_REGISTRY_LOCK = threading.Lock()
+_MODEL_LOAD_LOCKS: dict = {}
+
+
+def _load_sentence_transformer(model_name: str, device: str = "cpu"):
+    """Load a SentenceTransformer avoiding the meta tensor issue (runs once per model/device)."""
+    import torch
+    import gc
+
+    # Forçar carregamento sem meta tensors
+    os.environ.setdefault("TRANSFORMERS_NO_ADVISORY_WARNINGS", "1")
+
+    # Limpar cache antes de carregar
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+    try:
+        # Carregar modelo diretamente no device, sem usar meta device
+        model = SentenceTransformer(
+            model_name,
+            device=device,
+            trust_remote_code=False
+        )
+        # Garantir que o modelo está no modo de avaliação
+        model.eval()
+
+        # Forçar materialização: fazer uma inferência dummy para garantir que tudo está carregado
+        try:
+            _ = model.encode(["test"], convert_to_tensor=False)
+        except Exception:
+            # Se falhar, pode ser problema de meta tensor - recarregar
+            pass
+        return model
+
+    except Exception as e:
+        # Se houver erro, tentar recarregar sem especificar device
+        try:
             gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-            
-            try:
-                # Carregar modelo diretamente no CPU, sem usar meta device
-                # Usar use_auth_token=False e local_files_only=False para garantir download correto
-                self.model = SentenceTransformer(
-                    model_name, 
-                    device="cpu",
-                    trust_remote_code=False
-                )
-                # Garantir que o modelo está no modo de avaliação
-                self.model.eval()
-                
-                # Forçar materialização: fazer uma inferência dummy para garantir que tudo está carregado
-                try:
-                    _ = self.model.encode(["test"], convert_to_tensor=False)
-                except Exception:
-                    # Se falhar, pode ser problema de meta tensor - recarregar
-                    pass
-                    
-            except Exception as e:
-                # Se houver erro, tentar recarregar sem especificar device
-                try:
-                    gc.collect()
-                    self.model = SentenceTransformer(model_name)
-                    self.model.eval()
-                    # Testar novamente
-                    _ = self.model.encode(["test"], convert_to_tensor=False)
-                except Exception as e2:
-                    raise RuntimeError(
-                        f"Failed to load embedding model {model_name}. "
-                        f"Original error: {e}. Retry error: {e2}. "
-                        f"Try deleting the model cache and retrying."
-                    )
-
-        def embed_documents(self, texts):
-            if not texts:
-                return []
-            # Garantir que não estamos usando meta tensors - converter para numpy/list
-            embeddings = self.model.encode(
-                texts, 
-                convert_to_tensor=False,
-                show_progress_bar=False,
-                normalize_embeddings=False
-            )
-            # Converter numpy array para lista Python se necessário
-            if hasattr(embeddings, 'tolist'):
-                return embeddings.tolist()
-            elif isinstance(embeddings, list):
-                return embeddings
-            else:
-                return list(embeddings)
-
-        def embed_query(self, text):
-            if not text:
-                return None
-            # Garantir que não estamos usando meta tensors - converter para numpy/list
-            embedding = self.model.encode(
-                [text], 
-                convert_to_tensor=False,
-                show_progress_bar=False,
-                normalize_embeddings=False
+            model = SentenceTransformer(model_name)
+            model.eval()
+            # Testar novamente
+            _ = model.encode(["test"], convert_to_tensor=False)
+            return model
+        except Exception as e2:
+            raise RuntimeError(
+                f"Failed to load embedding model {model_name}. "
+                f"Original error: {e}. Retry error: {e2}. "
+                f"Try deleting the model cache and retrying."
             )
-            # Extrair primeiro elemento e converter para lista Python
-            result = embedding[0] if len(embedding) > 0 else embedding
-            if hasattr(result, 'tolist'):
-                return result.tolist()
-            elif isinstance(result, list):
-                return result
-            else:
-                return list(result)
 
-    return SentenceTransformerEmbeddings(embedding_model_name)
 
-def load_pdf_pages(file_path: str, source_name: Optional[str] = None):
-    """Load pages from a PDF and annotate each page's metadata with a stable source name.
+def get_shared_sentence_transformer(model_name: str = "all-MiniLM-L6-v2", device: str = "cpu", max_seq_length: Optional[int] = None):
+    """Return the process-wide SentenceTransformer for (model_name, device), loading it on first use.
+
+    Loading is guarded by a per-key lock, so concurrent sessions asking for the same model
+    wait for a single load instead of each loading their own copy. A custom `max_seq_length`
+    is part of the key, since it is a property of the model object itself.
+    """
+    key = (model_name, device, max_seq_length)
+    model = _MODEL_REGISTRY.get(key)
+    if model is not None:
+        return model
+    with _MODEL_REGISTRY_LOCK:
+        key_lock = _MODEL_LOAD_LOCKS.setdefault(key, threading.Lock())
+    with key_lock:
+        model = _MODEL_REGISTRY.get(key)
+        if model is None:
+            model = _load_sentence_transformer(model_name, device=device)
+            if max_seq_length:
+                model.max_seq_length = int(max_seq_length)
+            _MODEL_REGISTRY[key] = model
+    return model
+
+
+def warmup_embeddings(model_names: Sequence[str] = ("all-MiniLM-L6-v2",), device: str = "cpu", background: bool = False):
+    """Eagerly load the embedding models into the shared registry (e.g. at server start).
 
-    If `source_name` is provided, it will be used for `source_file` in metadata. This
-    prevents temporary filenames from leaking into chunk metadata when files are
-    uploaded and written to temporary paths.
+    With `background=True` the load runs in a daemon thread and the started thread is
+    returned; callers that need the model meanwhile simply block on the registry lock.
     """
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(f"File not found: {file_path}")
-    loader = PyPDFLoader(file_path)
-    pages = loader.load()
-    # Use the provided source_name if given, otherwise the basename of the path
-    basename = source_name or os.path.basename(file_path)
-    for idx, page in enumerate(pages):
+    def _warm():
+        for name in model_names:
+            try:
+                # via build_embeddings para usar a mesma chave (RAG_EMBED_MAX_SEQ_LENGTH) do app
+                build_embeddings(name, device=device)
+            except Exception:
+                # o erro reaparece (e é reportado) no primeiro uso real do modelo
+                pass
+
+    if background:
+        thread = threading.Thread(target=_warm, name="embedding-warmup", daemon=True)
+        thread.start()
+        return thread
+    _warm()
+    return None
+
+
+_QUERY_CACHES: dict = {}
+
+
+def _get_query_embedding_cache(key: str, maxsize: int) -> LRUCache:
+    with _MODEL_REGISTRY_LOCK:
+        cache = _QUERY_CACHES.get(key)
+        if cache is None:
+            cache = LRUCache(maxsize=maxsize)
+            _QUERY_CACHES[key] = cache
+        return cache
+
+
+class SentenceTransformerEmbeddings:
+    """LangChain-compatible embeddings backed by the shared SentenceTransformer.
+
+    `encode`/`embed_query_array` return contiguous float32 NumPy arrays (L2-normalized by
+    default, so cosine similarity is a plain dot product). `embed_documents`/`embed_query`
+    are the list-based interface expected by Chroma and only convert at that boundary.
+    """
+
+    def __init__(
+        self,
+        model_name: str = "all-MiniLM-L6-v2",
+        device: str = "cpu",
+        batch_size: int = 64,
+        max_seq_length: Optional[int] = None,
+        normalize: bool = True,
+        cache: Optional[EmbeddingCache] = None,
+        query_cache_size: int = 1024,
+    ):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = max(1, int(batch_size))
+        self.max_seq_length = max_seq_length
+        self.normalize = normalize
+        self.cache = cache
+        # LRU de consultas recentes, compartilhado pelas sessões que usam o mesmo modelo
+        # (não depende do índice, então nunca precisa ser invalidado)
+        self.query_cache = _get_query_embedding_cache(self.cache_key, query_cache_size) if query_cache_size else None
+        # Modelo compartilhado pelo processo (ver get_shared_sentence_transformer)
+        self.model = get_shared_sentence_transformer(model_name, device=device, max_seq_length=max_seq_length)
+
+    @property
+    def cache_key(self) -> str:
+        """Identifies vectors in the embedding cache: same model + same encode settings."""
+        return f"{self.model_name}|seq={self.max_seq_length or 'default'}|norm={int(self.normalize)}"
+
+    @property
+    def dimension(self) -> int:
+        return int(self.model.get_sentence_embedding_dimension())
+
+    def encode(self, texts: Sequence[str], batch_size: Optional[int] = None, use_cache: bool = True) -> np.ndarray:
+        """Encode `texts` into a (n, dim) contiguous float32 matrix.
+
+        With an embedding cache configured, only texts missing from the cache go through
+        the model; the new vectors are written back to the cache.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        if use_cache and self.cache is not None:
+            hashes = [normalized_text_hash(t) for t in texts]
+            vectors, found = self.cache.get_many(self.cache_key, hashes, self.dimension)
+            missing = np.flatnonzero(~found)
+            if len(missing):
+                fresh = self._encode_uncached([texts[i] for i in missing], batch_size)
+                vectors[missing] = fresh
+                self.cache.put_many(self.cache_key, [hashes[i] for i in missing], fresh)
+            return vectors
+        return self._encode_uncached(texts, batch_size)
+
+    def _encode_uncached(self, texts: Sequence[str], batch_size: Optional[int] = None) -> np.ndarray:
+        # Garantir que não estamos usando meta tensors - saída direto em numpy
+        embeddings = self.model.encode(
+            texts,
+            batch_size=batch_size or self.batch_size,
+            convert_to_numpy=True,
+            convert_to_tensor=False,
+            show_progress_bar=False,
+            normalize_embeddings=self.normalize,
+        )
+        return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    def embed_query_array(self, text: str) -> Optional[np.ndarray]:
+        if not text:
+            return None
+        if self.query_cache is not None:
+            vector = self.query_cache.get(text)
+            if vector is not None:
+                return vector
+        # consultas não passam pelo cache em disco (raramente se repetem entre índices)
+        vector = self.encode([text], use_cache=False)[0]
+        vector.setflags(write=False)
+        if self.query_cache is not None:
+            self.query_cache.put(text, vector)
+        return vector
+
+    def embed_queries_array(self, texts: Sequence[str]) -> np.ndarray:
+        """Embed several queries with a single model call (only those not in the query LRU).
+
+        The new vectors go into the query LRU, so searches that later embed the same query
+        text (e.g. one `retriever.invoke` per query) reuse them instead of re-encoding.
+        """
+        texts = list(texts)
+        if not texts:
+            return np.empty((0, self.dimension), dtype=np.float32)
+        vectors = [self.query_cache.get(t) if self.query_cache is not None else None for t in texts]
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        if missing:
+            fresh = dict(zip(missing, self.encode(missing, use_cache=False)))
+            for text, vector in fresh.items():
+                vector.setflags(write=False)
+                if self.query_cache is not None:
+                    self.query_cache.put(text, vector)
+            vectors = [v if v is not None else fresh[t] for t, v in zip(texts, vectors)]
+        return np.stack(vectors)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        # Conversão para lista apenas na fronteira com o Chroma
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        vector = self.embed_query_array(text)
+        return vector.tolist() if vector is not None else None
+
+
+def build_embeddings(
+    embedding_model_name: str = "all-MiniLM-L6-v2",
+    device: str = "cpu",
+    batch_size: Optional[int] = None,
+    max_seq_length: Optional[int] = None,
+    normalize: bool = True,
+    cache: Optional[EmbeddingCache] = None,
+):
+    """Build the embeddings used by the indexer and retriever.
+
+    The persistent embedding cache is enabled by default (see `get_embedding_cache`); pass
+    an explicit `cache` to use another one.
+    """
+    # Permite ajustar o batch/sequência via ambiente sem alterar o código do app
+    if batch_size is None:
+        batch_size = int(os.environ.get("RAG_EMBED_BATCH_SIZE", "64"))
+    if max_seq_length is None and os.environ.get("RAG_EMBED_MAX_SEQ_LENGTH"):
+        max_seq_length = int(os.environ["RAG_EMBED_MAX_SEQ_LENGTH"])
+    return SentenceTransformerEmbeddings(
+        embedding_model_name,
+        device=device,
+        batch_size=batch_size,
+        max_seq_length=max_seq_length,
+        normalize=normalize,
+        cache=cache if cache is not None else get_embedding_cache(),
+    )
+
+# ============================================================================
+# MANIFESTO DO ÍNDICE - arquivos indexados, hash, nº de chunks e modelo usado
+# ============================================================================
+
+INDEX_MANIFEST_NAME = "index_manifest.json"
+LEGACY_INDEX_REGISTRY_NAME = "indexed_files.txt"
+
+
+def get_index_manifest_path(persist_directory: str = "./vdb") -> str:
+    return os.path.join(persist_directory, INDEX_MANIFEST_NAME)
+
+
+def read_index_manifest(persist_directory: str = "./vdb") -> dict:
+    """Read the index manifest: {"generation": n, "files": {source_file: {file_hash, chunk_count, embedding_model, collection, indexed_at}}}.
+
+    Filenames only present in the legacy `indexed_files.txt` are migrated with unknown
+    hash/chunk count, so they are listed but will be re-checked on the next upload.
+    """
+    manifest = {"version": 1, "generation": 0, "files": {}}
+    path = get_index_manifest_path(persist_directory)
+    if os.path.exists(path):
         try:
-            meta = page.metadata or {}
+            with open(path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            if isinstance(data, dict) and isinstance(data.get("files"), dict):
+                manifest.update(data)
         except Exception:
-            meta = {}
-        # prefer existing page number metadata if present, else use index+1
-        page_number = meta.get("page") or meta.get("page_number") or (idx + 1)
-        meta["source_file"] = basename
-        meta["page_number"] = page_number
-        page.metadata = meta
-    return pages
-
-def build_vectorstore_from_pages(pages, embeddings, persist_directory: str = "./vdb", collection_name: str = "book"):
-    if not os.path.exists(persist_directory):
-        os.makedirs(persist_directory)
+            pass
+    legacy_path = os.path.join(persist_directory, LEGACY_INDEX_REGISTRY_NAME)
+    if os.path.exists(legacy_path):
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as fh:
+                for line in fh.read().splitlines():
+                    name = line.strip()
+                    if name and name not in manifest["files"]:
+                        manifest["files"][name] = {
+                            "file_hash": None,
+                            "chunk_count": None,
+                            "embedding_model": None,
+                            "collection": None,
+                            "indexed_at": None,
+                        }
+        except Exception:
+            pass
+    return manifest
+
+
+def _replace_manifest_file(manifest: dict, persist_directory: str):
+    path = get_index_manifest_path(persist_directory)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, ensure_ascii=False, indent=2)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_index_manifest(manifest: dict, persist_directory: str = "./vdb", bump_generation: bool = False):
+    """Atomically replace the manifest file (write to a temp file, fsync, then rename).
+
+    With `bump_generation`, the index `generation` counter is incremented: caches of
+    retrieval results are keyed by it, so they are invalidated by every ingest. Prefer
+    `update_index_manifest` when other sessions may be indexing at the same time.
+    """
+    with file_lock(get_index_manifest_path(persist_directory)):
+        if bump_generation:
+            manifest["generation"] = int(manifest.get("generation", 0)) + 1
+        _replace_manifest_file(manifest, persist_directory)
 
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    # Split each page individually so that chunk metadata keeps the originating page metadata
-    chunks = []
+
+def update_index_manifest(files: dict, persist_directory: str = "./vdb", bump_generation: bool = False) -> dict:
+    """Merge `files` entries into the manifest on disk under its advisory lock.
+
+    The manifest is re-read inside the lock, so two sessions uploading different PDFs at
+    the same time both keep their entries (a plain read-modify-write would let the last
+    writer drop the other's files), and generation bumps are never lost. Returns the
+    merged manifest.
+    """
+    with file_lock(get_index_manifest_path(persist_directory)):
+        manifest = read_index_manifest(persist_directory)
+        manifest["files"].update(files)
+        if bump_generation:
+            manifest["generation"] = int(manifest.get("generation", 0)) + 1
+        _replace_manifest_file(manifest, persist_directory)
+    return manifest
+
+
+def _group_pages_by_source(pages) -> dict:
+    grouped = {}
     for page in pages:
-        page_chunks = splitter.split_documents([page])
-        for ch in page_chunks:
-            # ensure chunk metadata contains source_file and page_number
-            try:
-                ch_meta = ch.metadata or {}
-            except Exception:
-                ch_meta = {}
-            # overlay page metadata (page metadata takes precedence)
-            page_meta = getattr(page, "metadata", {}) or {}
-            merged = {**ch_meta, **page_meta}
-            ch.metadata = merged
-            chunks.append(ch)
-
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
+        meta = getattr(page, "metadata", {}) or {}
+        source = meta.get("source_file") or meta.get("source") or "unknown"
+        grouped.setdefault(source, []).append(page)
+    return grouped
+
+
+def _embedding_model_name(embeddings) -> str:
+    return getattr(embeddings, "model_name", None) or type(embeddings).__name__
+
+
+def _is_source_up_to_date(manifest: dict, source: str, file_hash: str, model_name: str, collection_name: str, backend: str = "chroma") -> bool:
+    entry = manifest["files"].get(source) or {}
+    return (
+        entry.get("file_hash") == file_hash
+        and entry.get("embedding_model") == model_name
+        and entry.get("collection") == collection_name
+        and entry.get("backend", "chroma") == backend
+    )
+
+
+class _SourceUpsert:
+    """Streaming upsert of the chunks of one source file into the collection.
+
+    `add` embeds only chunk IDs not yet in the collection (all of them if the file was
+    indexed with another embedding model); `finish` deletes chunks of a previous version
+    of the file that were not seen again and updates the manifest entry (the caller
+    writes the manifest). The BM25 `lexical_index`, if given, is kept in sync.
+    """
+
+    def __init__(self, vectorstore, manifest: dict, source: str, file_hash: str, model_name: str, collection_name: str, lexical_index=None, backend: str = "chroma"):
+        self.vectorstore = vectorstore
+        self.backend = backend
+        self.lexical_index = lexical_index
+        self.manifest = manifest
+        self.source = source
+        self.file_hash = file_hash
+        self.model_name = model_name
+        self.collection_name = collection_name
+        entry = manifest["files"].get(source) or {}
+        # vetores de outro modelo não são comparáveis: reembedar o arquivo inteiro
+        self.reembed = bool(entry) and entry.get("embedding_model") != model_name
+        self.existing_ids = set(vectorstore.get(where={"source_file": source}, include=[]).get("ids", []))
+        self.seen_ids = set()
+        self.embedded = 0
+
+    def add(self, chunks) -> int:
+        new_chunks = []
+        batch = []
+        for ch in chunks:
+            chunk_id = ch.metadata["chunk_id"]
+            if chunk_id in self.seen_ids:
+                continue
+            self.seen_ids.add(chunk_id)
+            batch.append(ch)
+            if self.reembed or chunk_id not in self.existing_ids:
+                new_chunks.append(ch)
+        if new_chunks:
+            # os backends fazem upsert: IDs reembedados sobrescrevem os vetores antigos
+            self.vectorstore.add_documents(new_chunks, ids=[ch.metadata["chunk_id"] for ch in new_chunks])
+        if self.lexical_index is not None and batch:
+            # inclui chunks já presentes na coleção mas ainda fora do BM25 (índices antigos)
+            missing = self.lexical_index.missing_ids(ch.metadata["chunk_id"] for ch in batch)
+            lexical_batch = [ch for ch in batch if ch.metadata["chunk_id"] in missing]
+            self.lexical_index.add_documents(lexical_batch, [ch.metadata["chunk_id"] for ch in lexical_batch])
+        self.embedded += len(new_chunks)
+        return len(new_chunks)
+
+    def finish(self):
+        stale_ids = self.existing_ids - self.seen_ids
+        if stale_ids:
+            self.vectorstore.delete(ids=list(stale_ids))
+            if self.lexical_index is not None:
+                self.lexical_index.delete(stale_ids)
+        self.manifest["files"][self.source] = {
+            "file_hash": self.file_hash,
+            "chunk_count": len(self.seen_ids),
+            "embedding_model": self.model_name,
+            "collection": self.collection_name,
+            "backend": self.backend,
+            "indexed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+
+
+VECTOR_BACKENDS = ("chroma", "numpy")
+
+
+def _vector_backend(backend: Optional[str] = None) -> str:
+    backend = (backend or os.environ.get("RAG_VECTOR_BACKEND", "chroma")).strip().lower()
+    if backend not in VECTOR_BACKENDS:
+        raise ValueError(f"Unknown vector backend '{backend}'. Available: {', '.join(VECTOR_BACKENDS)}")
+    return backend
+
+
+def _open_collection(persist_directory: str, collection_name: str, embeddings, backend: Optional[str] = None):
+    """Open (creating if needed) the persisted collection with the selected backend.
+
+    - "chroma": ChromaDB collection (default);
+    - "numpy": `NumpyVectorStore`, exact search over a memory-mapped float32 matrix,
+      meant for small corpora where Chroma's overhead dominates. `RAG_VECTOR_QUANTIZATION`
+      ("int8" or "float16") searches on a compressed in-memory copy instead, re-scoring
+      the top candidates exactly unless `RAG_VECTOR_RESCORE=0`.
+    """
+    if not os.path.exists(persist_directory):
+        os.makedirs(persist_directory)
+    if _vector_backend(backend) == "numpy":
+        quantization = os.environ.get("RAG_VECTOR_QUANTIZATION", "").strip().lower() or None
+        if quantization in ("none", "float32", "0", "off"):
+            quantization = None
+        return NumpyVectorStore(
+            embeddings,
+            persist_directory=persist_directory,
+            collection_name=collection_name,
+            quantization=quantization,
+            rescore=os.environ.get("RAG_VECTOR_RESCORE", "1").strip().lower() not in ("0", "false", "no"),
+        )
+    return Chroma(
         persist_directory=persist_directory,
         collection_name=collection_name,
+        embedding_function=embeddings,
     )
+
+
+def _vectorstore_location(vectorstore):
+    """(persist_directory, collection_name) of a Chroma or Numpy vector store (None if in-memory)."""
+    persist_directory = getattr(vectorstore, "persist_directory", None) or getattr(vectorstore, "_persist_directory", None)
+    collection_name = getattr(vectorstore, "collection_name", None) or getattr(getattr(vectorstore, "_collection", None), "name", None)
+    return persist_directory, collection_name
+
+
+def _upsert_batch_size(batch_size: Optional[int] = None) -> int:
+    if batch_size is None:
+        batch_size = int(os.environ.get("RAG_UPSERT_BATCH_SIZE", "256"))
+    return max(1, batch_size)
+
+
+def build_vectorstore_from_pages(
+    pages,
+    embeddings,
+    persist_directory: str = "./vdb",
+    collection_name: str = "book",
+    batch_size: Optional[int] = None,
+    backend: Optional[str] = None,
+):
+    """Incrementally index `pages` into the persisted collection (`backend`: see `_open_collection`).
+
+    Files whose hash and embedding model match the manifest are skipped without being
+    split. For the others, chunks get deterministic IDs (source + page + text hash) and
+    are split lazily and upserted in fixed-size batches: only IDs missing from the
+    collection are embedded, and chunks of a previous version of the same file that no
+    longer exist are deleted. The BM25 lexical index next to the collection is updated
+    with the same chunks, and the manifest is updated at the end.
+    """
+    backend = _vector_backend(backend)
+    vectorstore = _open_collection(persist_directory, collection_name, embeddings, backend)
+    lexical_index = get_lexical_index(persist_directory, collection_name)
+    manifest = read_index_manifest(persist_directory)
+    model_name = _embedding_model_name(embeddings)
+    batch_size = _upsert_batch_size(batch_size)
+    finished = []
+
+    for source, source_pages in _group_pages_by_source(pages).items():
+        page_meta = getattr(source_pages[0], "metadata", {}) or {}
+        file_hash = page_meta.get("file_hash") or text_sha1("\n".join(p.page_content or "" for p in source_pages))
+        if _is_source_up_to_date(manifest, source, file_hash, model_name, collection_name, backend):
+            continue
+        upsert = _SourceUpsert(vectorstore, manifest, source, file_hash, model_name, collection_name, lexical_index, backend)
+        for batch in iter_batches(iter_page_chunks(source_pages), batch_size):
+            upsert.add(batch)
+        upsert.finish()
+        finished.append(source)
+
+    if finished:
+        update_index_manifest({s: manifest["files"][s] for s in finished}, persist_directory, bump_generation=True)
     return vectorstore
 
 
-def load_vectorstore_from_persist(persist_directory: str = "./vdb", collection_name: str = "book", embeddings=None):
+def index_pdf_files(
+    files,
+    embeddings,
+    persist_directory: str = "./vdb",
+    collection_name: str = "book",
+    max_workers: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    progress_callback: Optional[Callable[[dict], None]] = None,
+    backend: Optional[str] = None,
+):
+    """Index several PDFs through a streaming, bounded-memory pipeline.
+
+    `files` is a list of `(file_path, source_name)` pairs (`source_name` may be None).
+    Unchanged files are detected by hash before parsing. The rest flow through
+    pages → chunks (parsed in a process pool, see `iter_chunk_stream`) → fixed-size
+    batches → embedding + upsert, so memory does not grow with document size and file
+    N is embedded while the pool parses the next pages/files.
+
+    `progress_callback`, if given, receives a dict after every upserted batch and at the
+    end of each file with: source, pages_done, pages_total, chunks_indexed,
+    chunks_embedded, files_done, files_total.
+    """
+    backend = _vector_backend(backend)
+    vectorstore = _open_collection(persist_directory, collection_name, embeddings, backend)
+    lexical_index = get_lexical_index(persist_directory, collection_name)
+    manifest = read_index_manifest(persist_directory)
+    model_name = _embedding_model_name(embeddings)
+    batch_size = _upsert_batch_size(batch_size)
+
+    pending = []
+    for file_path, source_name in files:
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"File not found: {file_path}")
+        source = source_name or os.path.basename(file_path)
+        file_hash = file_sha256(file_path)
+        if _is_source_up_to_date(manifest, source, file_hash, model_name, collection_name, backend):
+            continue
+        pending.append((file_path, source, file_hash))
+
+    progress = {
+        "source": None,
+        "pages_done": 0,
+        "pages_total": 0,
+        "chunks_indexed": 0,
+        "chunks_embedded": 0,
+        "files_done": len(files) - len(pending),
+        "files_total": len(files),
+    }
+
+    def _report():
+        if progress_callback is not None:
+            progress_callback(dict(progress))
+
+    upsert = None
+    buffer = []
+    finished = []
+
+    def _flush():
+        if buffer:
+            progress["chunks_embedded"] += upsert.add(buffer)
+            progress["chunks_indexed"] += len(buffer)
+            buffer.clear()
+            _report()
+
+    try:
+        for kind, source, file_hash, chunks, pages_done, pages_total in iter_chunk_stream(pending, max_workers=max_workers):
+            if upsert is None or upsert.source != source:
+                upsert = _SourceUpsert(vectorstore, manifest, source, file_hash, model_name, collection_name, lexical_index, backend)
+            progress.update(source=source, pages_done=pages_done, pages_total=pages_total)
+            if kind == "chunks":
+                for ch in chunks:
+                    buffer.append(ch)
+                    if len(buffer) >= batch_size:
+                        _flush()
+            else:
+                _flush()
+                upsert.finish()
+                finished.append(source)
+                upsert = None
+                progress["files_done"] += 1
+                _report()
+    finally:
+        # arquivos já indexados ficam registrados mesmo se outro falhar; o merge sob lock
+        # preserva o que outras sessões indexaram em paralelo; a geração (que invalida os
+        # caches de recuperação e do LLM) só muda se algum arquivo terminou
+        if finished:
+            update_index_manifest({s: manifest["files"][s] for s in finished}, persist_directory, bump_generation=True)
+    return vectorstore
+
+
+def load_vectorstore_from_persist(persist_directory: str = "./vdb", collection_name: str = "book", embeddings=None, backend: Optional[str] = None):
     if not os.path.exists(persist_directory):
         raise FileNotFoundError(f"Persist directory not found: {persist_directory}")
     if embeddings is None:
         embeddings = build_embeddings()
 
-    vectorstore = Chroma(
-        persist_directory=persist_directory,
-        collection_name=collection_name,
-        embedding_function=embeddings,
-    )
+    vectorstore = _open_collection(persist_directory, collection_name, embeddings, backend)
     return vectorstore
 
-def build_retriever(vectorstore, k: int = 7):
-    return vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": k})
+def build_retriever(vectorstore, k: int = 7, mode: Optional[str] = None, cache: bool = True, mmr: Optional[bool] = None, rerank: Optional[str] = None):
+    """Build the retriever used by the agent.
+
+    `mode` (default: `RAG_RETRIEVAL_MODE`, else "hybrid"):
+    - "similarity": plain vector search;
+    - "hybrid": vector search + the BM25 index of the collection, merged with reciprocal
+      rank fusion. Falls back to "similarity" for collections without a persist directory;
+    - "mmr" / "hybrid_mmr": the same with `mmr=True`.
+
+    With `mmr` (default: `RAG_RETRIEVAL_MMR`, off), the results are re-ranked by maximal
+    marginal relevance over `RAG_MMR_FETCH_MULTIPLIER * k` candidates (default 4), with
+    `RAG_MMR_LAMBDA` (default 0.5; 1 = relevance only) and at most
+    `RAG_MMR_MAX_PER_SOURCE` results per source file (default 0 = no quota).
+
+    `rerank` (default: `RAG_RERANKER`, "off") adds a second stage after that: "lexical" or
+    "cross-encoder" re-scores `RAG_RERANK_FETCH_MULTIPLIER * k` candidates (default 3)
+    within a latency budget (see `rerankers.get_reranker`).
+
+    With `cache`, results are served from a process-wide cache keyed by query, search
+    kwargs and the index generation (see `get_retrieval_cache`).
+    """
+    mode = (mode or os.environ.get("RAG_RETRIEVAL_MODE", "hybrid")).strip().lower()
+    if mode in ("mmr", "hybrid_mmr"):
+        mode = "similarity" if mode == "mmr" else "hybrid"
+        mmr = True
+    if mmr is None:
+        mmr = os.environ.get("RAG_RETRIEVAL_MMR", "0").strip().lower() in ("1", "true", "yes", "on")
+    persist_directory, collection_name = _vectorstore_location(vectorstore)
+    collection_name = collection_name or "book"
+    if mode == "hybrid" and persist_directory:
+        lexical_index = get_lexical_index(persist_directory, collection_name)
+        if len(lexical_index) == 0:
+            # coleção indexada antes do BM25: preencher uma vez a partir da coleção
+            lexical_index.sync_from_vectorstore(vectorstore)
+        retriever = HybridRetriever(vectorstore=vectorstore, lexical_index=lexical_index, search_kwargs={"k": k})
+    else:
+        mode = "similarity"
+        retriever = vectorstore.as_retriever(search_type="similarity", search_kwargs={"k": k})
+    if mmr:
+        lambda_mult = float(os.environ.get("RAG_MMR_LAMBDA", "0.5"))
+        max_per_source = int(os.environ.get("RAG_MMR_MAX_PER_SOURCE", "0")) or None
+        retriever = MMRRetriever(
+            inner=retriever,
+            vectorstore=vectorstore,
+            search_kwargs={"k": k},
+            fetch_multiplier=max(1, int(os.environ.get("RAG_MMR_FETCH_MULTIPLIER", "4"))),
+            lambda_mult=lambda_mult,
+            max_per_source=max_per_source,
+        )
+        mode = f"{mode}+mmr({lambda_mult},{max_per_source})"
+    reranker = get_reranker(rerank, get_lexical_index(persist_directory, collection_name) if persist_directory else None)
+    if reranker is not None:
+        # segundo estágio por último: a diversidade escolhe o conjunto, o reranker a ordem final
+        retriever = RerankingRetriever(
+            inner=retriever,
+            reranker=reranker,
+            vectorstore=vectorstore,
+            search_kwargs={"k": k},
+            fetch_multiplier=max(1, int(os.environ.get("RAG_RERANK_FETCH_MULTIPLIER", "3"))),
+        )
+        mode = f"{mode}+rerank({reranker.scorer.name},{getattr(reranker.scorer, 'model_name', '')})"
+    if not cache or not persist_directory:
+        return retriever
+    return CachedRetriever(
+        inner=retriever,
+        cache=get_retrieval_cache(),
+        generation_fn=lambda: get_index_generation(persist_directory),
+        namespace=f"{os.path.abspath(persist_directory)}|{collection_name}|{type(vectorstore).__name__}|{mode}",
+        vectorstore=vectorstore,
+        search_kwargs={"k": k},
+    )
+
+
+_RETRIEVAL_CACHE = None
+_RETRIEVAL_CACHE_LOCK = threading.Lock()
+
+
+def get_retrieval_cache() -> LRUCache:
+    """Process-wide cache of retrieval results, shared by all sessions/agents.
+
+    Sized by `RAG_RETRIEVAL_CACHE_SIZE` (entries, default 512) and `RAG_RETRIEVAL_CACHE_TTL`
+    (seconds, default 600).
+    """
+    global _RETRIEVAL_CACHE
+    with _RETRIEVAL_CACHE_LOCK:
+        if _RETRIEVAL_CACHE is None:
+            _RETRIEVAL_CACHE = LRUCache(
+                maxsize=int(os.environ.get("RAG_RETRIEVAL_CACHE_SIZE", "512")),
+                ttl=float(os.environ.get("RAG_RETRIEVAL_CACHE_TTL", "600")),
+            )
+        return _RETRIEVAL_CACHE
+
+
+_MANIFEST_CACHE: dict = {}
+
+
+def _read_index_manifest_cached(persist_directory: str) -> dict:
+    """`read_index_manifest`, re-read only when the manifest (or legacy registry) changes on disk."""
+    paths = (get_index_manifest_path(persist_directory), os.path.join(persist_directory, LEGACY_INDEX_REGISTRY_NAME))
+    stamp = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    stamp = tuple(stamp)
+    key = os.path.abspath(persist_directory)
+    cached = _MANIFEST_CACHE.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    manifest = read_index_manifest(persist_directory)
+    _MANIFEST_CACHE[key] = (stamp, manifest)
+    return manifest
+
+
+def get_indexed_sources(persist_directory: str = "./vdb", collection_name: Optional[str] = None) -> list:
+    """Names of the files indexed in `persist_directory` (optionally in one collection).
+
+    Read from the index manifest and cached until the manifest file changes, so callers
+    can ask for it on every query at the cost of a `stat`.
+    """
+    manifest = _read_index_manifest_cached(persist_directory)
+    return [
+        name for name, entry in manifest["files"].items()
+        if collection_name is None or entry.get("collection") in (None, collection_name)
+    ]
+
+
+def get_index_generation(persist_directory: str = "./vdb") -> int:
+    """Generation counter of the index, bumped by every ingest that changed it."""
+    return int(_read_index_manifest_cached(persist_directory).get("generation", 0))
+
+
+def _source_key(name: str) -> str:
+    """Comparable form of a file name: no extension, lowercase, alphanumerics only."""
+    stem = re.sub(r"\.[A-Za-z0-9]{1,5}$", "", (name or "").strip())
+    return re.sub(r"[^a-z0-9]", "", stem.lower())
+
+
+def resolve_source_name(name: str, sources: Sequence[str], fuzzy: bool = True) -> Optional[str]:
+    """Fuzzy-match a user-provided article name against the indexed file names.
+
+    Tries, in order: case-insensitive exact match, match ignoring extension/punctuation,
+    unique substring match and finally (if `fuzzy`) difflib similarity (60% cutoff).
+    """
+    name = (name or "").strip().strip("\"'").strip()
+    if not name or not sources:
+        return None
+    lowered = {s.lower(): s for s in sources}
+    if name.lower() in lowered:
+        return lowered[name.lower()]
+    keys = {_source_key(s): s for s in sources}
+    key = _source_key(name)
+    if not key:
+        return None
+    if key in keys:
+        return keys[key]
+    contained = [s for k, s in keys.items() if key in k]
+    if len(contained) == 1:
+        return contained[0]
+    if not fuzzy:
+        return None
+    matches = difflib.get_close_matches(key, list(keys), n=1, cutoff=0.6)
+    if matches:
+        return keys[matches[0]]
+    return None
+
+
+def split_source_reference(reference: str, sources: Sequence[str]):
+    """Split "artigo1.pdf conceitos fundamentais" into (matched source, remaining query).
+
+    The `source:` pattern captures everything up to the end of the clause, so the longest
+    word prefix that resolves to an indexed file is taken as the article name and the
+    rest is given back to the semantic query. Exact/substring matches are preferred
+    over fuzzy ones, which would otherwise swallow query words into the name.
+    """
+    words = (reference or "").split()
+    for fuzzy in (False, True):
+        for n in range(len(words), 0, -1):
+            matched = resolve_source_name(" ".join(words[:n]), sources, fuzzy=fuzzy)
+            if matched:
+                return matched, " ".join(words[n:])
+    return None, ""
+
+
+_TOOL_EXECUTOR = None
+_TOOL_EXECUTOR_LOCK = threading.Lock()
+_TOOL_WORKERS = 0
+# chamadas que estouraram o timeout mas seguem rodando (ocupando um worker do pool)
+_ABANDONED_TOOL_CALLS = set()
 
-def build_agent(retriever, llm, history_file: Optional[str] = None):
+
+def get_tool_executor() -> ThreadPoolExecutor:
+    """Process-wide, bounded pool that runs the agents' tool calls (`RAG_TOOL_WORKERS`, default 4).
+
+    Shared by every agent/session of the process, so recreating agents does not leave
+    idle threads behind and the total number of concurrent tool calls stays bounded.
+    """
+    global _TOOL_EXECUTOR, _TOOL_WORKERS
+    with _TOOL_EXECUTOR_LOCK:
+        if _TOOL_EXECUTOR is None:
+            _TOOL_WORKERS = max(1, int(os.environ.get("RAG_TOOL_WORKERS", "4")))
+            _TOOL_EXECUTOR = ThreadPoolExecutor(max_workers=_TOOL_WORKERS, thread_name_prefix="agent-tool")
+        return _TOOL_EXECUTOR
+
+
+def abandon_tool_call(future) -> None:
+    """Give up on a timed-out tool call.
+
+    A call that has not started is cancelled. One already running cannot be stopped
+    (threads are not interruptible): it keeps its worker until it returns, so it is
+    tracked until then and counted by `tool_pool_saturated`.
+    """
+    if future.cancel():
+        return
+    with _TOOL_EXECUTOR_LOCK:
+        _ABANDONED_TOOL_CALLS.add(future)
+
+    def _release(done):
+        with _TOOL_EXECUTOR_LOCK:
+            _ABANDONED_TOOL_CALLS.discard(done)
+
+    future.add_done_callback(_release)
+
+
+def tool_pool_saturated() -> bool:
+    """True when every worker of the tool pool is held by an abandoned (timed-out) call."""
+    with _TOOL_EXECUTOR_LOCK:
+        return bool(_TOOL_WORKERS) and len(_ABANDONED_TOOL_CALLS) >= _TOOL_WORKERS
+
+
+def build_agent(retriever, llm, history_file: Optional[str] = None, index_dir: Optional[str] = None):
     history_path = history_file or os.environ.get("RAG_HISTORY_FILE") or os.path.join("./vdb", "conversation_history.txt")
+    vectorstore = getattr(retriever, "vectorstore", None)
+    vectorstore_dir, collection_name = _vectorstore_location(vectorstore)
+    index_dir = index_dir or vectorstore_dir or os.path.dirname(history_path) or "."
+    # histórico parseado compartilhado pelo nó do LLM e por todas as tools deste agente
+    history = HistoryCache(get_history_store(history_path), max_records=200)
+    # busca semântica no histórico completo, com o mesmo modelo de embeddings dos artigos
+    history_embeddings = getattr(vectorstore, "embeddings", None)
+    history_index = get_history_vector_index(history_path, history_embeddings) if history_embeddings is not None else None
+    if history_index is not None:
+        history_index.schedule_sync()
+    # palavras-chave da discussão (TF-IDF contra o BM25 dos artigos), atualizadas a cada mensagem nova
+    try:
+        discussion_terms = get_discussion_term_stats(
+            history_path,
+            get_lexical_index(vectorstore_dir, collection_name or "book") if vectorstore_dir else None,
+            generation_fn=lambda: get_index_generation(index_dir),
+        )
+    except Exception:
+        discussion_terms = None
+    fallback_sources = []
+
+    def list_indexed_sources():
+        sources = get_indexed_sources(index_dir, collection_name)
+        if sources:
+            return sources
+        # índice sem manifesto (versões antigas): listar as fontes da coleção uma única vez
+        if not fallback_sources and vectorstore is not None and hasattr(vectorstore, "get"):
+            try:
+                metadatas = vectorstore.get(include=["metadatas"]).get("metadatas") or []
+                names = {m.get("source_file") for m in metadatas if m and m.get("source_file")}
+                fallback_sources.extend(sorted(names))
+            except Exception:
+                pass
+        return fallback_sources
 
     def get_participants_from_history(max_messages: int = 200):
-        if not os.path.exists(history_path):
-            return []
         try:
-            with open(history_path, "r", encoding="utf-8") as fh:
-                lines = fh.read().splitlines()
+            return history.participants(max_messages)
         except Exception:
             return []
-        participants = []
-        seen = set()
-        for line in lines[-max_messages:]:
-            parts = line.split("::", 2)
-            if len(parts) < 3:
-                continue
-            role, user = parts[0], parts[1]
-            if role.strip().lower() != "user":
-                continue
-            user = user.strip() or "Usuário"
-            if user not in seen:
-                seen.add(user)
-                participants.append(user)
-        return participants
+
+    def parse_retriever_query(query: str):
+        """Split "source: X ..." / "from X ..." into (search query, matched source, error message)."""
+        source_name = None
+        search_query = query
+        try:
+            m = re.search(r"source\s*:\s*([^\n,;]+)", query, flags=re.IGNORECASE)
+            if not m:
+                m = re.search(r"from\s+[\"']?([^\n\"'.,;]+)[\"']?", query, flags=re.IGNORECASE)
+            if m:
+                source_name = m.group(1).strip()
+                search_query = (query[:m.start()] + query[m.end():]).strip()
+        except Exception:
+            source_name = None
+
+        if not source_name:
+            return search_query, None, None
+        available_sources = list_indexed_sources()
+        matched_source, leftover = split_source_reference(source_name, available_sources)
+        search_query = f"{search_query} {leftover}".strip()
+        if not matched_source:
+            return search_query, None, f"No document found matching '{source_name}'. Available: {', '.join(available_sources) if available_sources else 'none'}"
+        # filtro aplicado dentro da busca vetorial: sempre k trechos do artigo pedido
+        return search_query or source_name, matched_source, None
+
+    def format_retrieved_docs(docs, matched_source) -> str:
+        if not docs:
+            return "No relevant info was found in the document"
+        # trechos sobrepostos da mesma página viram um só; o total cabe em RAG_TOOL_TOKEN_BUDGET
+        budget = TokenBudget(token_budget("RAG_TOOL_TOKEN_BUDGET", 2500))
+        results = []
+        for doc in merge_chunks(docs):
+            meta = getattr(doc, "metadata", {}) or {}
+            source = meta.get("source_file", meta.get("source", "unknown"))
+            page_no = meta.get("page_number", meta.get("page", "?"))
+            header = f"Document {len(results)+1} (source: {source}, page: {page_no}):"
+            budget.charge(count_tokens(header) + 2)
+            snippet = budget.fit(doc.page_content.strip(), min_tokens=48)
+            if snippet is None:
+                break
+            results.append(f"{header}\n{snippet}")
+        if not results:
+            return "No relevant info was found in the document"
+        if matched_source:
+            note = f"[Filtered to source: {matched_source}]\n\n"
+        else:
+            note = ""
+        return note + "\n\n".join(results)
+
+    async def aretriever_tool(query: str) -> str:
+        search_query, matched_source, error = parse_retriever_query(query)
+        if error:
+            return error
+        if matched_source:
+            docs = await retriever.ainvoke(search_query, filter={"source_file": matched_source})
+        else:
+            docs = await retriever.ainvoke(search_query)
+        return format_retrieved_docs(docs, matched_source)
 
     @tool
     def retriever_tool(query: str) -> str:
@@ -253,56 +1051,17 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         
         Note: Returns "No relevant info was found in the document" if no matches exist.
         """
-        source_name = None
-        search_query = query
-        try:
-            m = re.search(r"source\s*:\s*([^\n,;]+)", query, flags=re.IGNORECASE)
-            if not m:
-                m = re.search(r"from\s+[\"']?([^\n\"'.,;]+)[\"']?", query, flags=re.IGNORECASE)
-            if m:
-                source_name = m.group(1).strip()
-                search_query = (query[:m.start()] + query[m.end():]).strip()
-        except Exception:
-            source_name = None
-
-        docs = retriever.invoke(search_query)
-        if not docs:
-            return "No relevant info was found in the document"
-        results = []
-        available_sources = []
-        for d in docs:
-            meta = getattr(d, "metadata", {}) or {}
-            src = meta.get("source_file", meta.get("source"))
-            if src and src not in available_sources:
-                available_sources.append(src)
-
-        filtered_docs = docs
-        matched_source = None
-        if source_name:
-            matches = difflib.get_close_matches(source_name, available_sources, n=1, cutoff=0.6)
-            if matches:
-                matched_source = matches[0]
-                filtered_docs = [d for d in docs if (getattr(d, "metadata", {}) or {}).get("source_file") == matched_source]
-            else:
-                lowered = {s.lower(): s for s in available_sources}
-                if source_name.lower() in lowered:
-                    matched_source = lowered[source_name.lower()]
-                    filtered_docs = [d for d in docs if (getattr(d, "metadata", {}) or {}).get("source_file") == matched_source]
-                else:
-                    return f"No document found matching '{source_name}'. Available: {', '.join(available_sources) if available_sources else 'none'}"
-
-        for i, doc in enumerate(filtered_docs):
-            meta = getattr(doc, "metadata", {}) or {}
-            source = meta.get("source_file", meta.get("source", "unknown"))
-            page_no = meta.get("page_number", meta.get("page", "?"))
-            snippet = doc.page_content.strip()
-            citation = f"(source: {source}, page: {page_no})"
-            results.append(f"Document {i+1} {citation}:\n{snippet}")
+        search_query, matched_source, error = parse_retriever_query(query)
+        if error:
+            return error
         if matched_source:
-            note = f"[Filtered to source: {matched_source}]\n\n"
+            docs = retriever.invoke(search_query, filter={"source_file": matched_source})
         else:
-            note = ""
-        return "\n\n".join(results)
+            docs = retriever.invoke(search_query)
+        return format_retrieved_docs(docs, matched_source)
+
+    # versão assíncrona usada por ainvoke (as outras tools rodam no executor padrão do loop)
+    retriever_tool.coroutine = aretriever_tool
     
     @tool
     def conversation_history_tool(query: str) -> str:
@@ -314,12 +1073,16 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         
         The query parameter can be:
         - A number (e.g., "10", "15") to specify how many recent messages to retrieve
+        - "search: <topic>" (or "busca: <topic>") to find the most relevant messages of the
+          WHOLE history about a topic (e.g., "search: metodologia do artigo 2"), ranked by
+          semantic similarity with a preference for recent messages
         - A general request (e.g., "últimas mensagens", "histórico recente")
         - Left as default to retrieve the last 20 messages
         
         Limitations:
         - Maximum of 20 messages can be retrieved per call
         - Minimum of 0 messages (returns empty if history doesn't exist)
+        - Search mode returns up to 8 messages, in chronological order
         
         Each message in the history follows the format:
         role::username::message_content
@@ -334,7 +1097,23 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         - Reference what participants have previously discussed
         - Identify who has been actively participating
         - Provide contextual responses based on prior messages
+        - Recover something discussed long ago (search mode) without pulling many messages
         """
+        search = re.match(r"\s*(?:search|busca|buscar)\s*:\s*(.+)", query or "", flags=re.IGNORECASE | re.DOTALL)
+        if search:
+            if not os.path.exists(history_path):
+                return "No conversation history found."
+            if history_index is None:
+                return "Semantic history search is not available for this agent."
+            topic = search.group(1).strip()
+            try:
+                hits = history_index.search(topic, k=8)
+            except Exception as e:
+                return f"Error searching history: {e}"
+            if not hits:
+                return f"No past messages related to '{topic}'."
+            lines = [f"[message {line_no + 1}] {line}" for line_no, line, _ in hits]
+            return f"[Relevant past messages for: {topic}]\n" + "\n".join(lines)
         try:
             n = int(query.strip()) if query and query.strip().isdigit() else 20
         except Exception:
@@ -343,12 +1122,10 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         if not os.path.exists(history_path):
             return "No conversation history found."
         try:
-            with open(history_path, "r", encoding="utf-8") as fh:
-                lines = fh.read().splitlines()
+            last_lines = history.lines(n)
         except Exception as e:
             return f"Error reading history file: {e}"
 
-        last_lines = lines[-n:]
         return "\n".join(last_lines) if last_lines else "No conversation history available."
 
     @tool
@@ -383,17 +1160,12 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         discussion_topics = []
         if os.path.exists(history_path):
             try:
-                with open(history_path, "r", encoding="utf-8") as fh:
-                    lines = fh.read().splitlines()
-                # Pegar últimas 50 mensagens para melhor contexto
-                recent_lines = lines[-50:] if len(lines) > 50 else lines
+                # Pegar últimas 50 mensagens para melhor contexto (do cache do histórico)
+                recent_lines = history.lines(50)
                 conversation_history = "\n".join(recent_lines) if recent_lines else ""
                 
                 # Extrair tópicos discutidos (mensagens de usuários)
-                for line in recent_lines:
-                    parts = line.split("::", 2)
-                    if len(parts) >= 3 and parts[0].strip().lower() == "user":
-                        discussion_topics.append(parts[2].strip())
+                discussion_topics = history.user_messages(50)
             except Exception as e:
                 conversation_history = f"Erro ao ler histórico: {e}"
 
@@ -402,59 +1174,29 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         sources_covered = set()
         
         try:
-            # Estratégia 1: Busca baseada no tópico principal
+            # Estratégia 1: Busca baseada no tópico principal, expandida com os termos
+            # mais característicos da discussão recente (TF-IDF em relação aos artigos)
             search_query = topic
-            if conversation_history:
-                # Extrair palavras-chave do histórico de forma mais inteligente
-                words = conversation_history.lower().split()
-                stopwords = {
-                    "o", "a", "os", "as", "de", "da", "do", "das", "dos", "em", "no", "na", 
-                    "que", "para", "com", "é", "um", "uma", "e", "ou", "se", "não", "ser", 
-                    "ter", "fazer", "dizer", "colaborai", "@colaborai", "user", "assistant",
-                    "sobre", "mais", "como", "mas", "por", "ao", "aos", "sua", "seu", "isso",
-                    "esse", "essa", "então", "já", "também", "onde", "quando", "qual"
-                }
-                
-                # Contar frequência de palavras relevantes
-                word_freq = {}
-                for w in words:
-                    if len(w) > 4 and w not in stopwords and w.isalpha():
-                        word_freq[w] = word_freq.get(w, 0) + 1
-                
-                # Pegar top 8 palavras mais frequentes
-                top_keywords = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)[:8]
-                if top_keywords:
-                    extra_keywords = " ".join([kw[0] for kw in top_keywords])
-                    search_query = f"{topic} {extra_keywords}".strip()
-            
-            # Busca principal
-            docs_main = retriever.invoke(search_query) if search_query else []
+            top_keywords = discussion_terms.top_keywords(8) if discussion_terms is not None else []
+            if top_keywords:
+                search_query = f"{topic} {' '.join(top_keywords)}".strip()
             
             # Estratégia 2: Busca complementar com termos da discussão
-            docs_discussion = []
-            if discussion_topics and len(discussion_topics) > 0:
-                # Usar últimas 3 mensagens de usuários para busca contextual
-                recent_discussion = " ".join(discussion_topics[-3:])
-                if recent_discussion.strip():
-                    docs_discussion = retriever.invoke(recent_discussion[:200])
+            # (últimas 3 mensagens de usuários para busca contextual)
+            recent_discussion = " ".join(discussion_topics[-3:])[:200] if discussion_topics else ""
             
             # Estratégia 3: Busca genérica para conceitos fundamentais
-            docs_general = retriever.invoke("principais conceitos metodologia resultados conclusões")
+            general_query = "principais conceitos metodologia resultados conclusões"
             
-            # Combinar e diversificar resultados
-            all_docs = []
-            # Priorizar docs da busca principal
-            for doc in docs_main[:10]:
-                if doc not in all_docs:
-                    all_docs.append(doc)
-            # Adicionar docs da discussão
-            for doc in docs_discussion[:5]:
-                if doc not in all_docs:
-                    all_docs.append(doc)
-            # Adicionar docs gerais
-            for doc in docs_general[:5]:
-                if doc not in all_docs:
-                    all_docs.append(doc)
+            # As três buscas de uma vez: embeddings das consultas num único encode e buscas em paralelo
+            docs_main, docs_discussion, docs_general = multi_query_retrieve(
+                retriever, [search_query, recent_discussion, general_query]
+            )
+            
+            # Combinar (dedup por hash) priorizando a busca principal, com diversidade de fontes
+            all_docs = merge_with_source_diversity(
+                [docs_main, docs_discussion, docs_general], limits=[10, 5, 5], max_total=12
+            )
                     
         except Exception as e:
             all_docs = []
@@ -464,8 +1206,10 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
                 "excerpt": f"Falha ao consultar repositório: {e}"
             })
 
-        # Processar documentos recuperados, garantindo diversidade de fontes
-        for doc in all_docs[:12]:  # Aumentar para 12 trechos
+        # Processar documentos recuperados (já balanceados por fonte), unindo trechos
+        # sobrepostos ou vizinhos da mesma página para não repetir texto
+        candidate_chunks = []
+        for doc in merge_chunks(all_docs):
             meta = getattr(doc, "metadata", {}) or {}
             source = meta.get("source_file", meta.get("source", "desconhecido"))
             page_no = meta.get("page_number", meta.get("page", "?"))
@@ -473,15 +1217,7 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
             
             if not snippet:
                 continue
-                
-            # Preferir diversidade de fontes
-            snippet_preview = snippet[:600] + ("..." if len(snippet) > 600 else "")
-            reference_chunks.append({
-                "source": source,
-                "page": page_no,
-                "excerpt": snippet_preview,
-            })
-            sources_covered.add(source)
+            candidate_chunks.append((source, page_no, snippet))
 
         # Resumo dos tópicos discutidos
         topics_summary = ""
@@ -491,13 +1227,22 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
             if significant_topics:
                 topics_summary = "\n".join([f"- {t[:150]}" for t in significant_topics])
 
+        # Termos que cada participante mais usou (para personalizar os exercícios)
+        participant_keywords = {}
+        if discussion_terms is not None:
+            try:
+                participant_keywords = discussion_terms.participant_keywords(3, participants)
+            except Exception:
+                participant_keywords = {}
+
         payload = {
             "topic": topic,
             "participants": participants,
             "num_participants": len(participants),
-            "conversation_history": conversation_history if conversation_history else "Nenhum histórico de conversa disponível.",
+            "conversation_history": "",
             "recent_topics_discussed": topics_summary if topics_summary else "Nenhum tópico específico identificado.",
-            "sources_available": list(sources_covered) if sources_covered else ["Nenhuma fonte identificada"],
+            "participant_keywords": participant_keywords,
+            "sources_available": [],
             "instructions": (
                 "Você deve criar exercícios de fixação PERSONALIZADOS E BEM ESTRUTURADOS para cada participante.\n\n"
                 "## DIRETRIZES OBRIGATÓRIAS:\n\n"
@@ -529,16 +1274,36 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
                 "2. [Questão 2]\n"
                 "[Repetir para cada participante]\n\n"
             ),
-            "reference_chunks": reference_chunks if reference_chunks else [
-                {"source": "N/A", "page": "-", "excerpt": "Nenhum trecho disponível dos artigos."}
-            ],
-            "metadata": {
-                "total_chunks": len(reference_chunks),
-                "sources_count": len(sources_covered),
-                "conversation_messages": len(conversation_history.splitlines()) if conversation_history else 0,
-            }
+            "reference_chunks": reference_chunks,
+            "metadata": {},
+        }
+
+        # Encaixar no orçamento de tokens, por prioridade: instruções e campos fixos, depois
+        # os trechos dos artigos (na ordem do ranking) e por fim as linhas mais recentes da conversa
+        budget = TokenBudget(token_budget("RAG_EXERCISE_TOKEN_BUDGET", 3500))
+        # (+60: reserva para sources_available e metadata, preenchidos no final)
+        budget.charge(count_tokens(compact_json(payload)) + 60)
+        for source, page_no, snippet in candidate_chunks:
+            entry = {"source": source, "page": page_no, "excerpt": ""}
+            budget.charge(count_tokens(compact_json(entry)) + (0 if source in sources_covered else count_tokens(str(source)) + 1))
+            excerpt = budget.fit(snippet, min_tokens=48, max_tokens=200)
+            if excerpt is None:
+                break
+            entry["excerpt"] = excerpt
+            reference_chunks.append(entry)
+            sources_covered.add(source)
+        history_lines = fit_newest(conversation_history.splitlines(), budget) if conversation_history else []
+
+        payload["conversation_history"] = "\n".join(history_lines) if history_lines else "Nenhum histórico de conversa disponível."
+        payload["sources_available"] = sorted(sources_covered) if sources_covered else ["Nenhuma fonte identificada"]
+        if not reference_chunks:
+            reference_chunks.append({"source": "N/A", "page": "-", "excerpt": "Nenhum trecho disponível dos artigos."})
+        payload["metadata"] = {
+            "total_chunks": len(reference_chunks),
+            "sources_count": len(sources_covered),
+            "conversation_messages": len(history_lines),
         }
-        return json.dumps(payload, ensure_ascii=False, indent=2)
+        return compact_json(payload)
 
     tools = [retriever_tool, conversation_history_tool, fixation_exercise_tool]
     llm_with_tools = llm.bind_tools(tools)
@@ -547,13 +1312,11 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         messages: Annotated[Sequence[BaseMessage], add_messages]
 
     def should_continue(state: AgentState):
-        # Inspect the last message's tool calls and return the tool name
+        # Any tool call goes to the dispatcher, which runs all of them in one step
         last = state["messages"][-1]
         if not hasattr(last, "tool_calls") or len(last.tool_calls) == 0:
             return False
-        # return the first tool name called (graph can decide routing based on this)
-        tool_name = last.tool_calls[0].get("name") if isinstance(last.tool_calls[0], dict) else getattr(last.tool_calls[0], "name", None)
-        return tool_name or False
+        return "tools"
 
     system_prompt = (
         "Você é um assistente que responde perguntas sobre os PDFs carregados na base de conhecimento. "
@@ -567,27 +1330,28 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
     )
 
     tools_dict = {t.name: t for t in tools}
+    tool_executor = get_tool_executor()
+    # cada chamada tem até tool_timeout segundos, contados a partir do despacho
+    tool_timeout = float(os.environ.get("RAG_TOOL_TIMEOUT", "120"))
+
+    def message_text(message) -> str:
+        """Texto de uma mensagem para a contagem de tokens (conteúdo e tool calls)."""
+        content = message.content
+        text = content if isinstance(content, str) else json.dumps(content, ensure_ascii=False, default=str)
+        calls = getattr(message, "tool_calls", None)
+        return text + (json.dumps(calls, ensure_ascii=False, default=str) if calls else "")
 
     def get_recent_history_messages(n: int = 5):
         """Lê as últimas N mensagens do histórico e converte para mensagens do LangChain."""
-        if not os.path.exists(history_path):
-            return []
         try:
-            with open(history_path, "r", encoding="utf-8") as fh:
-                lines = fh.read().splitlines()
-            recent_lines = lines[-n:] if len(lines) > n else lines
             history_messages = []
-            for line in recent_lines:
-                parts = line.split("::", 2)
-                if len(parts) < 3:
-                    continue
-                role, user, content = parts[0].strip(), parts[1].strip(), parts[2].strip()
-                if role.lower() == "user":
+            for record in history.records(n):
+                if record.role == "user":
                     # Formatar mensagem do usuário com o nome
-                    formatted_content = f"{user}: {content}" if user else content
+                    formatted_content = f"{record.user}: {record.content}" if record.user else record.content
                     history_messages.append(HumanMessage(content=formatted_content))
-                elif role.lower() == "assistant":
-                    history_messages.append(AIMessage(content=content))
+                elif record.role == "assistant":
+                    history_messages.append(AIMessage(content=record.content))
             return history_messages
         except Exception:
             return []
@@ -607,78 +1371,220 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         
         Fluxo: Entry Point → Decisão de roteamento
         """
+        msgs = build_llm_messages(state)
+        lookup = prepare_cache_lookup(state, msgs)
+        cached = cached_llm_response(lookup, embed_question(lookup))
+        if cached is not None:
+            return {"messages": [cached]}
+        message = llm_with_tools.invoke(msgs)
+        store_llm_response(lookup, message)
+        return {"messages": [message]}
+
+    async def anode_llm_processor(state: AgentState) -> AgentState:
+        """Versão assíncrona de node_llm_processor (usada por agent.ainvoke)."""
+        msgs = build_llm_messages(state)
+        lookup = prepare_cache_lookup(state, msgs)
+        # embedding da pergunta (CPU) e SQLite do cache fora do event loop
+        vector = await asyncio.to_thread(embed_question, lookup)
+        cached = await asyncio.to_thread(cached_llm_response, lookup, vector)
+        if cached is not None:
+            return {"messages": [cached]}
+        message = await llm_with_tools.ainvoke(msgs)
+        await asyncio.to_thread(store_llm_response, lookup, message)
+        return {"messages": [message]}
+
+    # ------------------------------------------------------------------------
+    # Cache de respostas do LLM (exato por prompt + semântico por pergunta)
+    # ------------------------------------------------------------------------
+    response_cache = get_llm_response_cache(index_dir)
+    llm_namespace = "|".join([
+        str(getattr(llm, "model_name", None) or getattr(llm, "model", None) or type(llm).__name__),
+        f"t={getattr(llm, 'temperature', None)}",
+        os.path.abspath(index_dir),
+        str(collection_name),
+    ])
+    # perguntas curtas ("e o artigo 2?") dependem do contexto da conversa: sem cache por pergunta
+    min_question_words = int(os.environ.get("RAG_LLM_CACHE_MIN_QUESTION_WORDS", "4"))
+    # respostas que usaram o histórico ou os participantes (exercícios) são pessoais e mudam
+    # com a discussão: só turnos sem tools ou só com o retriever entram no cache por pergunta
+    question_cache_tools = {"retriever_tool"}
+
+    def turn_tool_names(turn):
+        return {
+            tool_call_parts(call)[0]
+            for m in turn
+            if isinstance(m, AIMessage)
+            for call in (getattr(m, "tool_calls", None) or [])
+        }
+
+    def prepare_cache_lookup(state: AgentState, msgs):
+        if response_cache is None:
+            return None
+        turn = list(state["messages"])
+        turn_question = None
+        if turn and getattr(turn[0], "type", None) == "human" and isinstance(turn[0].content, str):
+            if len(turn[0].content.split()) >= min_question_words:
+                turn_question = turn[0].content
+        # o histórico recente entra no namespace das perguntas: a mesma pergunta num
+        # contexto de conversa diferente não reaproveita a resposta
+        context = msgs[1:len(msgs) - len(turn)]
+        return {
+            "key": messages_fingerprint(msgs, llm_namespace),
+            "namespace": messages_fingerprint(context, llm_namespace),
+            "generation": get_index_generation(index_dir),
+            # a pergunta do turno só é consultada na primeira chamada (antes de qualquer tool),
+            # mas a resposta final de qualquer rodada é gravada para ela
+            "question": turn_question if len(turn) == 1 else None,
+            "turn_question": turn_question if turn_tool_names(turn) <= question_cache_tools else None,
+            "vector": None,
+        }
+
+    def embed_text(text):
+        if not text or history_embeddings is None or not response_cache.semantic_threshold:
+            return None
+        try:
+            if hasattr(history_embeddings, "embed_query_array"):
+                return history_embeddings.embed_query_array(text)
+            return np.asarray(history_embeddings.embed_query(text), dtype=np.float32)
+        except Exception:
+            return None
+
+    def embed_question(lookup):
+        return embed_text(lookup["question"]) if lookup else None
+
+    def cached_llm_response(lookup, vector):
+        if lookup is None:
+            return None
+        lookup["vector"] = vector
+        try:
+            return response_cache.lookup(lookup["key"], lookup["generation"], lookup["namespace"], lookup["question"], vector)
+        except Exception:
+            return None
+
+    def store_llm_response(lookup, message):
+        if lookup is None:
+            return
+        # resposta final (sem tool calls) de uma pergunta fica também no cache por pergunta,
+        # a menos que o turno tenha usado tools dependentes da conversa (ver question_cache_tools)
+        question = lookup["turn_question"] if not getattr(message, "tool_calls", None) else None
+        try:
+            # o embedding da pergunta já está no LRU de consultas desde a primeira rodada
+            vector = (lookup["vector"] if lookup["vector"] is not None else embed_text(question)) if question else None
+            response_cache.store(lookup["key"], lookup["generation"], message, lookup["namespace"], question, vector)
+        except Exception:
+            pass
+
+    def build_llm_messages(state: AgentState):
         msgs = list(state["messages"])
-        # Adicionar últimas 5 mensagens do histórico para contexto
+        # Adicionar últimas 5 mensagens do histórico para contexto, só até onde couber no
+        # orçamento do prompt (RAG_PROMPT_TOKEN_BUDGET) depois do system prompt e da conversa atual
+        budget = TokenBudget(token_budget("RAG_PROMPT_TOKEN_BUDGET", 8000))
+        budget.charge(count_tokens(system_prompt) + sum(count_tokens(message_text(m)) for m in msgs))
         history_msgs = get_recent_history_messages(5)
+        kept = fit_newest([message_text(m) for m in history_msgs], budget)
+        history_msgs = [
+            type(m)(content=text) for m, text in zip(history_msgs[len(history_msgs) - len(kept):], kept)
+        ]
         # Combinar: system prompt + histórico + mensagens atuais
-        msgs = [SystemMessage(content=system_prompt)] + history_msgs + msgs
-        message = llm_with_tools.invoke(msgs)
-        return {"messages": [message]}
+        return [SystemMessage(content=system_prompt)] + history_msgs + msgs
 
-    def node_retriever_tool(state: AgentState) -> AgentState:
-        """
-        NÓ: Executor da Ferramenta de Busca Semântica
-        
-        Responsabilidade:
-        - Executa retriever_tool para buscar conteúdo nos PDFs indexados
-        - Retorna trechos relevantes com citações (fonte + página)
-        - Suporta busca geral e filtrada por documento específico
-        
-        Fluxo: LLM decide usar retriever_tool → Executa busca → Retorna ao LLM
-        """
-        tool_calls = state["messages"][-1].tool_calls
+    def tool_call_parts(call):
+        """(name, query, id) of a tool call given as a dict or an object."""
+        get = call.get if isinstance(call, dict) else lambda key: getattr(call, key, None)
+        args = get("args") or {}
+        return get("name"), args.get("query", ""), get("id")
+
+    def unknown_tool_message(name) -> str:
+        return f"Error: unknown tool '{name}'. Available: {', '.join(tools_dict)}"
+
+    def run_tool_call(call) -> str:
+        name, query, _ = tool_call_parts(call)
+        if name not in tools_dict:
+            return unknown_tool_message(name)
+        return str(tools_dict[name].invoke(query))
+
+    def saturated_tool_messages(tool_calls):
         results = []
         for t in tool_calls:
-            if t["name"] != "retriever_tool":
-                continue
-            tool_name = t["name"]
-            args_query = t["args"].get("query", "")
-            result = tools_dict[tool_name].invoke(args_query)
-            results.append(ToolMessage(tool_call_id=t["id"], name=tool_name, content=str(result)))
-        return {"messages": results}
+            tool_name, _, call_id = tool_call_parts(t)
+            content = f"Error: tool '{tool_name}' unavailable: all tool workers are busy with timed-out calls."
+            results.append(ToolMessage(tool_call_id=call_id, name=tool_name, content=content))
+        return results
 
-    def node_history_tool(state: AgentState) -> AgentState:
+    def node_tool_dispatcher(state: AgentState) -> AgentState:
         """
-        NÓ: Executor da Ferramenta de Histórico de Conversa
+        NÓ: Despachante de Ferramentas
         
         Responsabilidade:
-        - Executa conversation_history_tool para acessar mensagens anteriores
-        - Fornece contexto sobre discussões passadas e participantes
-        - Permite ao agente entender o fluxo da conversa
+        - Executa TODAS as tool calls da última mensagem do LLM (retriever_tool,
+          conversation_history_tool, fixation_exercise_tool) em paralelo, num pool limitado
+        - Isola erros e timeouts por chamada: uma tool que falha vira um ToolMessage de erro
+          e não derruba as outras
+        - Um timeout só abandona a chamada: a thread continua ocupando um worker até a tool
+          retornar; com todos os workers presos assim, novas chamadas falham na hora
+        - Retorna os ToolMessages na mesma ordem das tool calls
         
-        Fluxo: LLM decide usar conversation_history_tool → Lê histórico → Retorna ao LLM
+        Fluxo: LLM pede uma ou mais tools → Executa todas de uma vez → Retorna ao LLM
         """
-        tool_calls = state["messages"][-1].tool_calls
+        tool_calls = list(state["messages"][-1].tool_calls)
+        if tool_pool_saturated():
+            # todos os workers presos em chamadas que estouraram o timeout: falhar já,
+            # em vez de enfileirar e esperar mais tool_timeout segundos
+            return {"messages": saturated_tool_messages(tool_calls)}
+        futures = [tool_executor.submit(run_tool_call, t) for t in tool_calls]
+        deadline = time.monotonic() + tool_timeout
         results = []
-        for t in tool_calls:
-            if t["name"] != "conversation_history_tool":
-                continue
-            tool_name = t["name"]
-            args_query = t["args"].get("query", "")
-            result = tools_dict[tool_name].invoke(args_query)
-            results.append(ToolMessage(tool_call_id=t["id"], name=tool_name, content=str(result)))
+        for t, future in zip(tool_calls, futures):
+            tool_name, _, call_id = tool_call_parts(t)
+            try:
+                content = future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except FutureTimeoutError:
+                # a chamada é abandonada, mas o worker só é liberado quando ela terminar
+                abandon_tool_call(future)
+                content = f"Error: tool '{tool_name}' timed out after {tool_timeout:.0f}s."
+            except Exception as e:
+                content = f"Error: tool '{tool_name}' failed: {e}"
+            results.append(ToolMessage(tool_call_id=call_id, name=tool_name, content=content))
         return {"messages": results}
 
-    def node_exercise_tool(state: AgentState) -> AgentState:
-        """
-        NÓ: Executor da Ferramenta de Geração de Exercícios
-        
-        Responsabilidade:
-        - Executa fixation_exercise_tool para gerar exercícios personalizados
-        - Combina conteúdo dos artigos com histórico de discussão
-        - Cria questões contextualizadas para cada participante
-        
-        Fluxo: LLM decide usar fixation_exercise_tool → Gera payload → Retorna ao LLM
-        """
-        tool_calls = state["messages"][-1].tool_calls
+    async def anode_tool_dispatcher(state: AgentState) -> AgentState:
+        """Versão assíncrona de node_tool_dispatcher. Tools com corrotina própria (retriever)
+        rodam no event loop, limitadas por um semáforo do tamanho do pool; as síncronas vão
+        para o mesmo pool de node_tool_dispatcher, com o mesmo tratamento de timeout e de
+        pool saturado."""
+        tool_calls = list(state["messages"][-1].tool_calls)
+        if tool_pool_saturated():
+            return {"messages": saturated_tool_messages(tool_calls)}
+        semaphore = asyncio.Semaphore(_TOOL_WORKERS)
+
+        async def native(tool_name, query):
+            async with semaphore:
+                return str(await tools_dict[tool_name].ainvoke(query))
+
+        async def run(call):
+            tool_name, query, _ = tool_call_parts(call)
+            if tool_name not in tools_dict:
+                return unknown_tool_message(tool_name)
+            try:
+                if getattr(tools_dict[tool_name], "coroutine", None) is not None:
+                    return await asyncio.wait_for(native(tool_name, query), timeout=tool_timeout)
+                future = tool_executor.submit(run_tool_call, call)
+                # shield: o timeout não deve cancelar o future; abandon_tool_call decide
+                try:
+                    return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=tool_timeout)
+                except asyncio.TimeoutError:
+                    abandon_tool_call(future)
+                    raise
+            except asyncio.TimeoutError:
+                return f"Error: tool '{tool_name}' timed out after {tool_timeout:.0f}s."
+            except Exception as e:
+                return f"Error: tool '{tool_name}' failed: {e}"
+
+        contents = await asyncio.gather(*(run(t) for t in tool_calls))
         results = []
-        for t in tool_calls:
-            if t["name"] != "fixation_exercise_tool":
-                continue
-            tool_name = t["name"]
-            args_query = t["args"].get("query", "")
-            result = tools_dict[tool_name].invoke(args_query)
-            results.append(ToolMessage(tool_call_id=t["id"], name=tool_name, content=str(result)))
+        for t, content in zip(tool_calls, contents):
+            tool_name, _, call_id = tool_call_parts(t)
+            results.append(ToolMessage(tool_call_id=call_id, name=tool_name, content=content))
         return {"messages": results}
 
     # ============================================================================
@@ -687,10 +1593,9 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
     
     graph = StateGraph(AgentState)
     
-    graph.add_node("llm_processor", node_llm_processor)
-    graph.add_node("retriever_executor", node_retriever_tool)
-    graph.add_node("history_executor", node_history_tool)
-    graph.add_node("exercise_executor", node_exercise_tool)
+    # cada nó tem versão síncrona (agent.invoke) e assíncrona (agent.ainvoke)
+    graph.add_node("llm_processor", RunnableLambda(node_llm_processor, afunc=anode_llm_processor))
+    graph.add_node("tool_dispatcher", RunnableLambda(node_tool_dispatcher, afunc=anode_tool_dispatcher))
     
     graph.set_entry_point("llm_processor")
     
@@ -698,38 +1603,143 @@ def build_agent(retriever, llm, history_file: Optional[str] = None):
         "llm_processor",
         should_continue,
         {
-            "retriever_tool": "retriever_executor",
-            "conversation_history_tool": "history_executor",
-            "fixation_exercise_tool": "exercise_executor",
+            "tools": "tool_dispatcher",
             False: END,  # Sem tool calls = resposta final
         },
     )
     
-    graph.add_edge("retriever_executor", "llm_processor")
-    graph.add_edge("history_executor", "llm_processor")
-    graph.add_edge("exercise_executor", "llm_processor")
+    graph.add_edge("tool_dispatcher", "llm_processor")
     
     return graph.compile()
 
 
-def run_rag_agent_cli(file_path: str = "file.pdf", persist_directory: str = "./vdb"):
+_AGENT_LOOP = None
+_AGENT_LOOP_LOCK = threading.Lock()
+
+
+def get_agent_event_loop() -> asyncio.AbstractEventLoop:
+    """Process-wide event loop, running in a daemon thread, for `agent.ainvoke` calls.
+
+    Synchronous callers (Streamlit script threads) submit coroutines to it with
+    `run_agent_coroutine`, so every session's LLM requests and tool calls are multiplexed
+    on one loop (and one async HTTP client) instead of each holding a blocked thread.
+    """
+    global _AGENT_LOOP
+    with _AGENT_LOOP_LOCK:
+        if _AGENT_LOOP is None or _AGENT_LOOP.is_closed():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="agent-event-loop", daemon=True).start()
+            _AGENT_LOOP = loop
+        return _AGENT_LOOP
+
+
+def run_agent_coroutine(coro, timeout: Optional[float] = None):
+    """Run `coro` on the shared agent event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coro, get_agent_event_loop()).result(timeout)
+
+
+async def astream_agent_events(agent, inputs: dict):
+    """Stream one agent turn as events (async generator over `agent.astream`).
+
+    Yields dicts:
+    - `{"type": "token", "content": str}`: a token of the assistant's text, as generated;
+    - `{"type": "tool_start", "tools": [names]}`: the LLM asked for these tools;
+    - `{"type": "tool_end", "tool": name, "ok": bool}`: a tool call finished;
+    - `{"type": "final", "content": str}`: the complete final answer (last event).
+
+    Tokens come from LangGraph's "messages" stream mode, which streams the chat model
+    even though the node calls `ainvoke`; tool progress comes from the "updates" mode.
+    """
+    async for mode, payload in agent.astream(inputs, stream_mode=["messages", "updates"]):
+        if mode == "messages":
+            chunk, meta = payload
+            if (meta or {}).get("langgraph_node") != "llm_processor":
+                continue
+            text = chunk.content if isinstance(getattr(chunk, "content", None), str) else ""
+            if text and not getattr(chunk, "tool_call_chunks", None):
+                yield {"type": "token", "content": text}
+            continue
+        for node, update in (payload or {}).items():
+            for message in (update or {}).get("messages", []):
+                if node == "llm_processor":
+                    tool_calls = getattr(message, "tool_calls", None)
+                    if tool_calls:
+                        names = [c.get("name") if isinstance(c, dict) else getattr(c, "name", None) for c in tool_calls]
+                        yield {"type": "tool_start", "tools": names}
+                    else:
+                        content = message.content if isinstance(message.content, str) else str(message.content)
+                        yield {"type": "final", "content": content}
+                elif node == "tool_dispatcher":
+                    ok = not str(getattr(message, "content", "")).startswith("Error:")
+                    yield {"type": "tool_end", "tool": getattr(message, "name", None), "ok": ok}
+
+
+_STREAM_END = object()
+
+
+def stream_agent_events(agent, inputs: dict):
+    """Synchronous generator over `astream_agent_events`, run on the shared agent event loop.
+
+    For callers without an event loop of their own (Streamlit script threads, `st.write_stream`).
+    Closing the generator early cancels the turn.
+    """
+    events = queue.Queue()
+
+    async def pump():
+        try:
+            async for event in astream_agent_events(agent, inputs):
+                events.put(event)
+        except BaseException as e:
+            events.put(e)
+            raise
+        finally:
+            events.put(_STREAM_END)
+
+    future = asyncio.run_coroutine_threadsafe(pump(), get_agent_event_loop())
+    try:
+        while True:
+            item = events.get()
+            if item is _STREAM_END:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        future.cancel()
+
+
+async def arun_rag_agent_cli(file_path: str = "file.pdf", persist_directory: str = "./vdb"):
     load_dotenv()
     llm = build_llm()
     embeddings = build_embeddings()
-    pages = load_pdf_pages(file_path)
-    vectorstore = build_vectorstore_from_pages(pages, embeddings, persist_directory=persist_directory)
+    # reindexação incremental: um file.pdf inalterado nem é reprocessado
+    vectorstore = await asyncio.to_thread(index_pdf_files, [(file_path, None)], embeddings, persist_directory=persist_directory)
     retriever = build_retriever(vectorstore)
     agent = build_agent(retriever, llm)
 
     print("======= RAG AGENT ======")
     while True:
-        user_input = input("\nQuestion: ")
+        user_input = await asyncio.to_thread(input, "\nQuestion: ")
         if user_input.lower() in ["exit", "quit"]:
             break
         messages = [HumanMessage(content=user_input)]
-        result = agent.invoke({"messages": messages})
         print("\n==== ANSWER =====")
-        print(result["messages"][-1].content)
+        # tokens da chamada atual do LLM ficam no buffer: se ela terminar pedindo tools, o
+        # texto parcial ("Vou consultar...") é descartado em vez de ficar no terminal
+        buffered = []
+        async for event in astream_agent_events(agent, {"messages": messages}):
+            if event["type"] == "token":
+                buffered.append(event["content"])
+            elif event["type"] == "tool_start":
+                buffered.clear()
+                print(f"[tools: {', '.join(t for t in event['tools'] if t)}]", flush=True)
+            elif event["type"] == "final":
+                print(event["content"] or "".join(buffered), flush=True)
+                buffered.clear()
+
+
+def run_rag_agent_cli(file_path: str = "file.pdf", persist_directory: str = "./vdb"):
+    asyncio.run(arun_rag_agent_cli(file_path, persist_directory))
 
 if __name__ == "__main__":
     run_rag_agent_cli()
@@ -8,12 +8,17 @@ from dotenv import load_dotenv
 from agent_rag import (
     build_llm,
     build_embeddings,
-    build_vectorstore_from_pages,
     build_retriever,
     build_agent,
-    load_pdf_pages,
+    index_pdf_files,
     load_vectorstore_from_persist,
+    read_index_manifest,
+    stream_agent_events,
+    warmup_embeddings,
 )
+from history_search import get_history_vector_index
+from llm_cache import get_llm_response_cache
+from history_store import get_history_store
 
 USERS = ["Artur", "Pedro", "João", "Rebeca", "Lucas"]
 
@@ -24,6 +29,18 @@ def get_shared_vectorstore_dir() -> str:
     return base
 
 
+@st.cache_resource(show_spinner=False)
+def start_embedding_warmup():
+    """Load the embedding model once per server process, in the background.
+
+    Controlled by `RAG_EAGER_WARMUP` (default on); `st.cache_resource` guarantees the
+    warm-up is triggered only by the first session, not on every rerun.
+    """
+    if os.environ.get("RAG_EAGER_WARMUP", "1").strip().lower() in ("0", "false", "no"):
+        return None
+    return warmup_embeddings(background=True)
+
+
 def ensure_session_state():
     """Initialize all session variables"""
     if "session_id" not in st.session_state:
@@ -42,55 +59,39 @@ def get_history_file_path() -> str:
     return os.path.join(get_shared_vectorstore_dir(), "conversation_history.txt")
 
 
-def get_index_registry_path() -> str:
-    return os.path.join(get_shared_vectorstore_dir(), "indexed_files.txt")
-
-
 def read_indexed_files() -> list:
-    path = get_index_registry_path()
-    if not os.path.exists(path):
-        return []
     try:
-        with open(path, "r", encoding="utf-8") as fh:
-            lines = [l.strip() for l in fh.read().splitlines() if l.strip()]
-        return lines
+        manifest = read_index_manifest(get_shared_vectorstore_dir())
     except Exception:
         return []
-
-
-def add_indexed_file(filename: str):
-    path = get_index_registry_path()
-    files = set(read_indexed_files())
-    if filename in files:
-        return
-    try:
-        with open(path, "a", encoding="utf-8") as fh:
-            fh.write(f"{filename}\n")
-    except Exception:
-        pass
+    return list(manifest.get("files", {}).keys())
 
 
 def append_history_to_file(message: dict):
-    path = get_history_file_path()
     try:
-        role = message.get("role", "")
-        user = message.get("user", "")
-        content = message.get("content", "").replace("\n", " ")
-        with open(path, "a", encoding="utf-8") as fh:
-            fh.write(f"{role}::{user}::{content}\n")
+        get_history_store(get_history_file_path()).append(
+            message.get("role", ""), message.get("user", ""), message.get("content", "")
+        )
+        # indexar a nova mensagem para a busca semântica no histórico, fora da thread do script
+        embeddings = getattr(getattr(st.session_state.retriever, "vectorstore", None), "embeddings", None)
+        if embeddings is not None:
+            get_history_vector_index(get_history_file_path(), embeddings).schedule_sync()
     except Exception as e:
         st.error(f"Failed to write history: {e}")
 
-def build_or_update_index_from_uploads(uploaded_files):
+def build_or_update_index_from_uploads(uploaded_files, progress_callback=None):
     """Build or update the vectorstore from a list of uploaded files.
 
     `uploaded_files` is expected to be a list of Streamlit UploadedFile objects.
-    The function writes each upload to a temp file, loads pages using the original
-    filename as `source_name` (so metadata keeps the real filename), indexes all
-    pages together, and registers the filenames in `indexed_files.txt`.
+    The function writes each upload to a temp file and hands all of them to
+    `index_pdf_files`, which parses/chunks them in parallel using the original
+    filename as `source_name` (so metadata keeps the real filename). Indexing is
+    incremental: unchanged files are skipped and the index manifest (hash, chunk
+    count, embedding model) is updated by the indexer. `progress_callback` receives
+    the per-batch progress dicts emitted by `index_pdf_files`.
     """
     temp_paths = []
-    all_pages = []
+    files_to_index = []
 
     # Normalize single-file case
     if uploaded_files is None:
@@ -108,18 +109,16 @@ def build_or_update_index_from_uploads(uploaded_files):
                 tmp.write(content)
                 tmp_path = tmp.name
             temp_paths.append(tmp_path)
-            # load pages with correct source name and extend
-            all_pages.extend(load_pdf_pages(tmp_path, source_name=filename))
-            # register the indexed filename so the UI can show it
-            if filename:
-                add_indexed_file(filename)
+            # keep the original filename as the source name of the temp file
+            files_to_index.append((tmp_path, filename))
 
         embeddings = build_embeddings()
-        vectorstore = build_vectorstore_from_pages(
-            all_pages,
+        vectorstore = index_pdf_files(
+            files_to_index,
             embeddings,
             persist_directory=get_shared_vectorstore_dir(),
             collection_name="book",
+            progress_callback=progress_callback,
         )
         retriever = build_retriever(vectorstore)
         return retriever
@@ -137,6 +136,7 @@ def main():
     load_dotenv()
     st.set_page_config(page_title="Chat Colaborativo RAG", page_icon="📄")
     ensure_session_state()
+    start_embedding_warmup()
 
     # Auto-connect to an existing persisted vectorstore if present
     shared_dir = get_shared_vectorstore_dir()
@@ -171,8 +171,23 @@ def main():
         uploaded_files = st.file_uploader("Enviar PDF(s)", type=["pdf"], accept_multiple_files=True, help="Carregue 1 a 5 artigos científicos.")
         if uploaded_files:
             if st.button("Construir/Atualizar índice", type="primary"):
-                with st.spinner("Gerando índice compartilhado..."):
-                    st.session_state.retriever = build_or_update_index_from_uploads(uploaded_files)
+                progress_bar = st.progress(0.0, text="Gerando índice compartilhado...")
+
+                def show_progress(p):
+                    # fração por arquivos concluídos + páginas do arquivo em andamento
+                    files_total = max(1, p["files_total"])
+                    in_progress = p["pages_done"] / p["pages_total"] if p["pages_done"] < p["pages_total"] else 0.0
+                    frac = min(1.0, (p["files_done"] + in_progress) / files_total)
+                    progress_bar.progress(
+                        frac,
+                        text=(
+                            f"`{p['source'] or '-'}`: página {p['pages_done']}/{p['pages_total']} · "
+                            f"{p['chunks_indexed']} trechos ({p['chunks_embedded']} novos)"
+                        ),
+                    )
+
+                st.session_state.retriever = build_or_update_index_from_uploads(uploaded_files, progress_callback=show_progress)
+                progress_bar.progress(1.0, text="Índice atualizado.")
                 st.success("Índice criado a partir dos arquivos enviados.")
         
         st.divider()
@@ -196,6 +211,15 @@ def main():
                 history_file = get_history_file_path()
                 st.session_state.agent = build_agent(retriever, llm, history_file=history_file)
                 st.success("Agente pronto para colaborar.")
+        response_cache = get_llm_response_cache(shared_dir)
+        if response_cache is not None:
+            cache_stats = response_cache.stats()
+            if cache_stats["hits"] + cache_stats["misses"]:
+                st.caption(
+                    f"Cache de respostas: {cache_stats['hit_rate']:.0%} de acerto "
+                    f"({cache_stats['hits']} de {cache_stats['hits'] + cache_stats['misses']}, "
+                    f"{cache_stats['semantic_hits']} por similaridade)"
+                )
 
     # Chat area
     st.subheader("Espaço de discussão. Para chamar o agente, escreva @colaborai na mensagem.")
@@ -216,14 +240,48 @@ def main():
                     st.warning("Crie o agente na barra lateral antes de fazer perguntas.")
             else:
                 with st.chat_message("assistant"):
-                    with st.spinner("Pensando..."):
-                        result = st.session_state.agent.invoke({
-                            "messages": [
-                                {"type": "human", "content": prompt.replace("@colaborai", "").strip()}
-                            ]
-                        })
-                        content = result["messages"][-1].content
-                        st.markdown(content)
+                    progress = st.empty()
+                    progress.caption("Pensando...")
+                    inputs = {"messages": [{"type": "human", "content": prompt.replace("@colaborai", "").strip()}]}
+                    events = iter(stream_agent_events(st.session_state.agent, inputs))
+                    turn = {"content": "", "tools": False}
+
+                    def call_tokens():
+                        # tokens de uma chamada do LLM; para no pedido de tools ou na resposta final
+                        for event in events:
+                            if event["type"] == "token":
+                                progress.empty()
+                                yield event["content"]
+                            elif event["type"] == "tool_start":
+                                turn["tools"] = True
+                                progress.caption(f"Consultando: {', '.join(t for t in event['tools'] if t)}...")
+                                return
+                            elif event["type"] == "tool_end" and not event["ok"]:
+                                progress.caption(f"Falha em {event['tool']}, continuando...")
+                            elif event["type"] == "final":
+                                turn["content"] = event["content"]
+                                return
+
+                    answer = st.empty()
+                    try:
+                        while True:
+                            # um st.write_stream por chamada do LLM: se ela terminar pedindo tools,
+                            # o texto parcial ("Vou consultar...") é apagado e o stream recomeça
+                            turn["tools"] = False
+                            with answer.container():
+                                streamed = st.write_stream(call_tokens())
+                            if not turn["tools"]:
+                                break
+                            answer.empty()
+                    except Exception as e:
+                        progress.empty()
+                        answer.empty()
+                        st.error(f"Falha ao gerar a resposta: {e}")
+                    else:
+                        progress.empty()
+                        # a tela termina com o mesmo texto (e formato) que vai para o histórico
+                        content = turn["content"] or (streamed if isinstance(streamed, str) else "")
+                        answer.markdown(f"**Assistente**: {content}")
                         assistant_msg = {"role": "assistant", "content": content}
                         st.session_state.messages.append(assistant_msg)
                         append_history_to_file(assistant_msg)
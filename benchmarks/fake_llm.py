@@ -0,0 +1,108 @@
+"""Deterministic local chat model for end-to-end agent benchmarks (replaces OpenRouter).
+
+`ScriptedChatModel` looks at the last user question of the prompt, picks the first
+script entry whose `match` substring it contains and replays that entry's tool-call
+rounds: round i is emitted after i tool rounds of the current turn have completed, then
+the scripted answer is returned. Decisions depend only on the prompt, so concurrent
+turns and re-runs behave identically. Every call records the prompt size (estimated
+tokens, see `context_budget.count_tokens`) and can sleep `latency_ms` to emulate a
+remote model.
+"""
+import threading
+import time
+from typing import Any, List, Optional, Sequence
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import PrivateAttr
+
+from context_budget import count_tokens
+
+
+DEFAULT_SCRIPT = [
+    {
+        "match": "compare",
+        "rounds": [[("retriever_tool", "{topic}"), ("retriever_tool", "{other_topic}")]],
+        "answer": "Comparação simulada entre {topic} e {other_topic} (source: sintetico_0.pdf, page: 1).",
+    },
+    {
+        "match": "discutimos",
+        "rounds": [[("conversation_history_tool", "search: {topic}")]],
+        "answer": "Resumo simulado do que o grupo discutiu sobre {topic}.",
+    },
+    {
+        "match": "exercícios",
+        "rounds": [[("fixation_exercise_tool", "{topic}")]],
+        "answer": "### EXERCÍCIOS DE FIXAÇÃO\n**Tópico:** {topic}\n1. Questão simulada.\n\nGABARITO: resposta simulada.",
+    },
+    {
+        "match": "",
+        "rounds": [[("retriever_tool", "{question}")]],
+        "answer": "Resposta simulada sobre {topic} (source: sintetico_0.pdf, page: 1).",
+    },
+]
+
+
+def _text(message: BaseMessage) -> str:
+    content = message.content
+    return content if isinstance(content, str) else str(content)
+
+
+class ScriptedChatModel(BaseChatModel):
+    """Chat model that replays scripted tool calls and answers (see the module docstring)."""
+
+    script: List[dict] = DEFAULT_SCRIPT
+    latency_ms: float = 0.0
+    _calls: list = PrivateAttr(default_factory=list)
+    _lock: Any = PrivateAttr(default_factory=threading.Lock)
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted-fake"
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        # o roteiro já sabe quais tools chamar; as definições não são necessárias
+        return self
+
+    @staticmethod
+    def _slots(question: str) -> dict:
+        """Template values: the question and the topics it mentions ("... sobre X e Y")."""
+        tail = question.split(" sobre ", 1)[-1].rstrip("?. ")
+        parts = [p.strip() for p in tail.split(" e ", 1)]
+        return {"question": question, "topic": parts[0], "other_topic": parts[-1]}
+
+    def _turn(self, messages: List[BaseMessage]):
+        """(last user question, number of tool rounds already done in this turn)."""
+        start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=-1)
+        question = _text(messages[start]) if start >= 0 else ""
+        rounds = sum(1 for m in messages[start + 1:] if isinstance(m, AIMessage) and m.tool_calls)
+        return question, rounds
+
+    def _reply(self, messages: List[BaseMessage]) -> AIMessage:
+        question, done = self._turn(messages)
+        entry = next(e for e in self.script if e["match"].lower() in question.lower())
+        slots = self._slots(question)
+        if done < len(entry["rounds"]):
+            calls = [
+                {"name": name, "args": {"query": query.format(**slots)}, "id": f"call_{done}_{i}", "type": "tool_call"}
+                for i, (name, query) in enumerate(entry["rounds"][done])
+            ]
+            return AIMessage(content="", tool_calls=calls)
+        tool_chars = sum(len(_text(m)) for m in messages if isinstance(m, ToolMessage))
+        return AIMessage(content=entry["answer"].format(**slots) + f"\n\n[{tool_chars} caracteres de contexto]")
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt_tokens = sum(count_tokens(_text(m)) for m in messages)
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000.0)
+        message = self._reply(messages)
+        with self._lock:
+            self._calls.append({"prompt_tokens": prompt_tokens, "tool_calls": len(message.tool_calls)})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def drain_calls(self) -> List[dict]:
+        """Calls recorded since the last drain (prompt tokens and tool calls of each)."""
+        with self._lock:
+            calls, self._calls = self._calls, []
+        return calls
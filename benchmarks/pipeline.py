@@ -0,0 +1,351 @@
+"""End-to-end benchmarks: ingestion throughput, retrieval latency and full agent turns.
+
+Three suites, each optional (`--suites`):
+
+- ingest: writes synthetic PDFs (see `benchmarks.synthetic`) and times each stage:
+  parse (`iter_pdf_pages`), chunk (`split_pages_into_chunks`), embed, upsert
+  (`build_vectorstore_from_pages` with the embeddings precomputed, minus chunking), the
+  whole `index_pdf_files` pipeline and a re-index of unchanged files;
+- retrieval: indexes synthetic corpora of several sizes and reports `retriever.invoke`
+  p50/p99 per retrieval mode ("similarity", "hybrid", "mmr", "hybrid_mmr", optionally
+  with "+lexical" or "+cross-encoder" reranking), with the retrieval cache off;
+- agent: runs `build_agent(...).invoke` turns against `ScriptedChatModel`, a
+  deterministic local model that issues scripted tool calls instead of OpenRouter,
+  and reports turn latency, LLM calls and prompt/tool-output tokens per kind of turn.
+
+Embeddings are the hash-based `HashEmbeddings` by default (no model download, measures
+the pipeline itself); `--model all-MiniLM-L6-v2` uses the real SentenceTransformer. The
+persistent embedding cache and the LLM response cache are disabled so runs are
+comparable. The report is JSON and includes the git commit, so results of two commits
+can be diffed directly.
+
+    python -m benchmarks.pipeline --suites ingest retrieval agent --output bench.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+# antes de importar o agente: caches persistentes distorceriam a comparação entre execuções
+os.environ.setdefault("RAG_EMBED_CACHE_DIR", "off")
+os.environ.setdefault("RAG_LLM_CACHE", "off")
+
+from langchain_core.messages import HumanMessage, ToolMessage
+
+from agent_rag import build_agent, build_embeddings, build_retriever, build_vectorstore_from_pages, index_pdf_files
+from benchmarks.fake_llm import ScriptedChatModel
+from benchmarks.synthetic import TOPICS, synthetic_pages, synthetic_queries, write_synthetic_pdfs
+from benchmarks.vector_backends import HashEmbeddings
+from context_budget import count_tokens
+from history_store import get_history_store
+from ingestion import iter_pdf_pages, split_pages_into_chunks
+from lexical_index import get_lexical_index
+from numpy_store import _encode_texts
+
+
+def _ms_stats(seconds) -> dict:
+    values = np.asarray(seconds, dtype=np.float64) * 1000.0
+    if not len(values):
+        return {}
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "max_ms": float(values.max()),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+class PrecomputedEmbeddings:
+    """Serves vectors computed earlier (by text) so an upsert can be timed without the model."""
+
+    def __init__(self, inner, vectors: dict):
+        self.inner = inner
+        self.vectors = vectors
+        self.model_name = getattr(inner, "model_name", type(inner).__name__)
+
+    def encode(self, texts):
+        texts = list(texts)
+        missing = [t for t in texts if t not in self.vectors]
+        if missing:
+            self.vectors.update(zip(missing, _encode_texts(self.inner, missing)))
+        dim = len(next(iter(self.vectors.values()))) if self.vectors else 0
+        return np.stack([self.vectors[t] for t in texts]) if texts else np.empty((0, dim), dtype=np.float32)
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query_array(self, text):
+        return _encode_texts(self.inner, [text])[0]
+
+    def embed_query(self, text):
+        return self.embed_query_array(text).tolist()
+
+
+def _clear_query_cache(embeddings):
+    cache = getattr(embeddings, "query_cache", None)
+    if cache is not None:
+        cache.clear()
+
+
+# ---------------------------------------------------------------------- ingest
+def bench_ingest(workdir, embeddings, n_pdfs, pages_per_pdf, words_per_page, backend, batch_size):
+    t0 = time.perf_counter()
+    paths = write_synthetic_pdfs(os.path.join(workdir, "pdfs"), n_pdfs, pages_per_pdf, words_per_page)
+    generate_s = time.perf_counter() - t0
+    pdf_bytes = sum(os.path.getsize(p) for p in paths)
+    files = [(p, os.path.basename(p)) for p in paths]
+
+    t0 = time.perf_counter()
+    pages = [page for path, name in files for page in iter_pdf_pages(path, source_name=name)]
+    parse_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    chunks = split_pages_into_chunks(pages)
+    chunk_s = time.perf_counter() - t0
+
+    texts = [c.page_content for c in chunks]
+    t0 = time.perf_counter()
+    vectors = _encode_texts(embeddings, texts)
+    embed_s = time.perf_counter() - t0
+
+    # upsert isolado: mesmas páginas, vetores já calculados (o tempo de chunking é descontado)
+    precomputed = PrecomputedEmbeddings(embeddings, dict(zip(texts, vectors)))
+    t0 = time.perf_counter()
+    build_vectorstore_from_pages(pages, precomputed, persist_directory=os.path.join(workdir, "upsert"), collection_name="bench", batch_size=batch_size, backend=backend)
+    upsert_s = max(time.perf_counter() - t0 - chunk_s, 1e-9)
+
+    e2e_dir = os.path.join(workdir, "e2e")
+    t0 = time.perf_counter()
+    index_pdf_files(files, embeddings, persist_directory=e2e_dir, collection_name="bench", batch_size=batch_size, backend=backend)
+    pipeline_s = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    index_pdf_files(files, embeddings, persist_directory=e2e_dir, collection_name="bench", batch_size=batch_size, backend=backend)
+    reindex_s = time.perf_counter() - t0
+
+    return {
+        "pdfs": n_pdfs,
+        "pages": len(pages),
+        "chunks": len(chunks),
+        "pdf_mb": pdf_bytes / 2 ** 20,
+        "generate_seconds": generate_s,
+        "parse_pages_per_second": len(pages) / parse_s,
+        "parse_mb_per_second": pdf_bytes / 2 ** 20 / parse_s,
+        "chunk_chunks_per_second": len(chunks) / chunk_s,
+        "embed_chunks_per_second": len(chunks) / embed_s,
+        "upsert_chunks_per_second": len(chunks) / upsert_s,
+        "pipeline_seconds": pipeline_s,
+        "pipeline_pages_per_second": len(pages) / pipeline_s,
+        "reindex_unchanged_seconds": reindex_s,
+    }
+
+
+# ---------------------------------------------------------------------- retrieval
+def _retriever_for(vectorstore, k, spec, cache=False):
+    """`build_retriever` from a spec like "hybrid_mmr+lexical" (mode, then optional reranker)."""
+    mode, _, rerank = spec.partition("+")
+    mmr = mode in ("mmr", "hybrid_mmr")
+    return build_retriever(vectorstore, k=k, mode=mode, cache=cache, mmr=mmr, rerank=rerank or "off")
+
+
+def bench_retrieval(workdir, embeddings, sizes, n_queries, k, modes, backend, words_per_page, batch_size):
+    results = []
+    queries = synthetic_queries(n_queries)
+    for n_pages in sizes:
+        store_dir = os.path.join(workdir, f"retrieval-{n_pages}")
+        t0 = time.perf_counter()
+        vectorstore = build_vectorstore_from_pages(
+            synthetic_pages(n_pages, words_per_page), embeddings, persist_directory=store_dir, collection_name="bench", batch_size=batch_size, backend=backend
+        )
+        index_s = time.perf_counter() - t0
+        n_chunks = len(get_lexical_index(store_dir, "bench"))
+        for spec in modes:
+            retriever = _retriever_for(vectorstore, k, spec)
+            # aquecimento (modelo, páginas do SQLite/memmap), fora da medição
+            retriever.invoke(queries[0])
+            _clear_query_cache(embeddings)
+            latencies, returned = [], []
+            for q in queries:
+                t0 = time.perf_counter()
+                docs = retriever.invoke(q)
+                latencies.append(time.perf_counter() - t0)
+                returned.append(len({(d.metadata or {}).get("source_file") for d in docs}))
+            results.append({
+                "pages": n_pages,
+                "chunks": n_chunks,
+                "mode": spec,
+                "index_seconds": index_s,
+                "queries_per_second": len(queries) / sum(latencies),
+                "mean_distinct_sources": float(np.mean(returned)),
+                **_ms_stats(latencies),
+            })
+    return results
+
+
+# ---------------------------------------------------------------------- agent
+def agent_questions(n: int):
+    """(kind, question) pairs cycling through the scripted kinds of turn and the topics."""
+    topics = list(TOPICS)
+    kinds = [
+        ("retrieval", "O que os artigos dizem sobre {a}?"),
+        ("compare", "Compare o que os artigos dizem sobre {a} e {b}"),
+        ("history", "O que discutimos sobre {a}?"),
+        ("exercise", "Crie exercícios sobre {a}"),
+    ]
+    questions = []
+    for i in range(n):
+        kind, template = kinds[i % len(kinds)]
+        a, b = topics[(i // len(kinds)) % len(topics)], topics[(i // len(kinds) + 3) % len(topics)]
+        questions.append((kind, template.format(a=a, b=b)))
+    return questions
+
+
+def _seed_history(store, n_messages):
+    users = ["Artur", "Pedro", "João", "Rebeca", "Lucas"]
+    queries = synthetic_queries(n_messages, seed=7)
+    records = []
+    for i, q in enumerate(queries):
+        if i % 2:
+            records.append(("assistant", "", f"Segundo os artigos, {q.split(' sobre ', 1)[-1]} aparece na metodologia (source: sintetico_0.pdf, page: 1)."))
+        else:
+            records.append(("user", users[i % len(users)], f"@colaborai {q}?"))
+    store.append_many(records)
+
+
+def bench_agent(workdir, embeddings, n_pages, turns, history_messages, latency_ms, mode, backend, words_per_page, batch_size):
+    store_dir = os.path.join(workdir, "agent")
+    vectorstore = build_vectorstore_from_pages(
+        synthetic_pages(n_pages, words_per_page), embeddings, persist_directory=store_dir, collection_name="bench", batch_size=batch_size, backend=backend
+    )
+    history_path = os.path.join(store_dir, "conversation_history.txt")
+    store = get_history_store(history_path)
+    _seed_history(store, history_messages)
+    llm = ScriptedChatModel(latency_ms=latency_ms)
+    agent = build_agent(_retriever_for(vectorstore, 7, mode, cache=True), llm, history_file=history_path, index_dir=store_dir)
+
+    questions = agent_questions(turns)
+    agent.invoke({"messages": [HumanMessage(content=questions[0][1])]})
+    llm.drain_calls()
+
+    per_kind = {}
+    all_turns = []
+    for i, (kind, question) in enumerate(questions):
+        t0 = time.perf_counter()
+        result = agent.invoke({"messages": [HumanMessage(content=question)]})
+        elapsed = time.perf_counter() - t0
+        calls = llm.drain_calls()
+        tool_tokens = sum(count_tokens(m.content) for m in result["messages"] if isinstance(m, ToolMessage) and isinstance(m.content, str))
+        # como o app: pergunta e resposta entram no histórico para os próximos turnos
+        store.append("user", ["Artur", "Pedro", "Rebeca"][i % 3], question)
+        store.append("assistant", "", result["messages"][-1].content)
+        turn = {
+            "seconds": elapsed,
+            "llm_calls": len(calls),
+            "tool_calls": sum(c["tool_calls"] for c in calls),
+            "prompt_tokens": sum(c["prompt_tokens"] for c in calls),
+            "max_prompt_tokens": max((c["prompt_tokens"] for c in calls), default=0),
+            "tool_output_tokens": tool_tokens,
+        }
+        per_kind.setdefault(kind, []).append(turn)
+        all_turns.append(turn)
+
+    def summarize(items):
+        return {
+            "turns": len(items),
+            **_ms_stats([t["seconds"] for t in items]),
+            "mean_llm_calls": float(np.mean([t["llm_calls"] for t in items])),
+            "mean_tool_calls": float(np.mean([t["tool_calls"] for t in items])),
+            "mean_prompt_tokens": float(np.mean([t["prompt_tokens"] for t in items])),
+            "max_prompt_tokens": int(max(t["max_prompt_tokens"] for t in items)),
+            "mean_tool_output_tokens": float(np.mean([t["tool_output_tokens"] for t in items])),
+        }
+
+    return {
+        "pages": n_pages,
+        "mode": mode,
+        "llm_latency_ms": latency_ms,
+        "seed_history_messages": history_messages,
+        "overall": summarize(all_turns),
+        "by_kind": {kind: summarize(items) for kind, items in per_kind.items()},
+    }
+
+
+# ---------------------------------------------------------------------- main
+def run(args) -> dict:
+    embeddings = build_embeddings(args.model) if args.model else HashEmbeddings(args.dim)
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "embeddings": getattr(embeddings, "model_name", type(embeddings).__name__),
+        "backend": args.backend,
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+    }
+    workdir = tempfile.mkdtemp(prefix="bench-pipeline-")
+    try:
+        if "ingest" in args.suites:
+            report["ingest"] = bench_ingest(
+                os.path.join(workdir, "ingest"), embeddings, args.pdfs, args.pages_per_pdf, args.words_per_page, args.backend, args.batch_size
+            )
+        if "retrieval" in args.suites:
+            report["retrieval"] = bench_retrieval(
+                os.path.join(workdir, "retrieval"), embeddings, args.corpus_pages, args.queries, args.k, args.modes, args.backend, args.corpus_words_per_page, args.batch_size
+            )
+        if "agent" in args.suites:
+            report["agent"] = bench_agent(
+                os.path.join(workdir, "agent"), embeddings, args.agent_pages, args.turns, args.history, args.llm_latency_ms,
+                args.agent_mode, args.backend, args.corpus_words_per_page, args.batch_size,
+            )
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--suites", nargs="+", choices=["ingest", "retrieval", "agent"], default=["ingest", "retrieval", "agent"])
+    parser.add_argument("--model", help="SentenceTransformer model (default: hash embeddings, no download)")
+    parser.add_argument("--dim", type=int, default=384, help="dimension of the hash embeddings")
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma")
+    parser.add_argument("--batch-size", type=int, default=256, help="upsert batch size")
+    parser.add_argument("--pdfs", type=int, default=5)
+    parser.add_argument("--pages-per-pdf", type=int, default=40)
+    parser.add_argument("--words-per-page", type=int, default=450)
+    parser.add_argument("--corpus-pages", type=int, nargs="+", default=[500, 2000, 8000])
+    parser.add_argument("--corpus-words-per-page", type=int, default=140)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=7)
+    parser.add_argument("--modes", nargs="+", default=["similarity", "hybrid", "hybrid_mmr", "hybrid+lexical"])
+    parser.add_argument("--agent-pages", type=int, default=1000)
+    parser.add_argument("--agent-mode", default="hybrid")
+    parser.add_argument("--turns", type=int, default=24)
+    parser.add_argument("--history", type=int, default=200, help="messages seeded into the conversation history")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="simulated latency of each LLM call")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+    text = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
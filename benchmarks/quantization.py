@@ -0,0 +1,107 @@
+"""Memory and recall@k of the quantized NumpyVectorStore modes against the float32 path.
+
+Builds one store per mode over the same synthetic, clustered embeddings (so that
+neighbours are meaningful), uses the float32 store as ground truth and reports, for
+float32 / float16 / int8, with and without exact re-scoring: bytes held in memory for
+search, recall@k and query latency. Results are printed as JSON.
+
+    python -m benchmarks.quantization --chunks 5000 --queries 200 --k 5
+"""
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from numpy_store import NumpyVectorStore
+
+
+class ClusteredEmbeddings:
+    """Texts "t<topic> v<variant>" map to a topic centroid plus Gaussian noise."""
+
+    def __init__(self, dim: int = 384, topics: int = 50, noise: float = 0.6, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.dim = dim
+        self.noise = noise
+        self.centroids = rng.standard_normal((topics, dim)).astype(np.float32)
+        self.model_name = f"clustered-{dim}"
+
+    def _vector(self, text: str) -> np.ndarray:
+        topic, variant = (int(part[1:]) for part in text.split()[:2])
+        rng = np.random.default_rng(hash((topic, variant)) & 0xFFFFFFFF)
+        vec = self.centroids[topic % len(self.centroids)] + self.noise * rng.standard_normal(self.dim).astype(np.float32)
+        return vec / np.linalg.norm(vec)
+
+    def encode(self, texts):
+        return np.stack([self._vector(t) for t in texts]).astype(np.float32)
+
+    def embed_query_array(self, text):
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self._vector(text).tolist()
+
+
+def run(n_chunks, n_queries, k, dim):
+    embeddings = ClusteredEmbeddings(dim)
+    texts = [f"t{i % 50} v{i}" for i in range(n_chunks)]
+    ids = [f"id-{i}" for i in range(n_chunks)]
+    metadatas = [{"source_file": f"doc{i % 5}.pdf"} for i in range(n_chunks)]
+    queries = embeddings.encode([f"t{j % 50} v{n_chunks + j}" for j in range(n_queries)])
+
+    workdir = tempfile.mkdtemp(prefix="bench-quant-")
+    try:
+        NumpyVectorStore.from_texts(texts, embeddings, metadatas=metadatas, ids=ids, persist_directory=workdir, collection_name="bench")
+        truth = None
+        report = {"chunks": n_chunks, "queries": n_queries, "k": k, "dim": dim, "results": []}
+        for mode, rescore in [(None, False), ("float16", False), ("float16", True), ("int8", False), ("int8", True)]:
+            store = NumpyVectorStore(embeddings, persist_directory=workdir, collection_name="bench", quantization=mode, rescore=rescore)
+            latencies = []
+            hits = []
+            for q in queries:
+                t0 = time.perf_counter()
+                found = store.similarity_search_by_vectors(q[None, :], k=k)[0]
+                latencies.append(time.perf_counter() - t0)
+                hits.append([doc.id for doc, _ in found])
+            if truth is None:
+                truth = hits
+            recall = float(np.mean([len(set(h) & set(t)) / k for h, t in zip(hits, truth)]))
+            footprint = store.memory_footprint()
+            report["results"].append({
+                "mode": mode or "float32",
+                "rescore": rescore,
+                "search_bytes": footprint["search_bytes"],
+                "compression": footprint["float32_bytes"] / max(1, footprint["search_bytes"]),
+                f"recall@{k}": recall,
+                "query_p50_ms": float(np.percentile(latencies, 50) * 1000.0),
+                "query_p99_ms": float(np.percentile(latencies, 99) * 1000.0),
+            })
+        return report
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+    text = json.dumps(run(args.chunks, args.queries, args.k, args.dim), indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
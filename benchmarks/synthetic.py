@@ -0,0 +1,170 @@
+"""Deterministic synthetic corpus for the benchmarks: topical Portuguese-like text and PDFs.
+
+Pages are built from a handful of topics (each with its own vocabulary) mixed with
+general academic words, so vector, lexical and reranked retrieval all have something
+meaningful to find. PDFs are written by hand (Helvetica, WinAnsi encoding, one
+content stream per page), so no PDF library beyond pypdf's reader is needed.
+
+    python -m benchmarks.synthetic --out /tmp/pdfs --pdfs 3 --pages 20
+"""
+import argparse
+import os
+import random
+import sys
+from typing import List
+
+from langchain_core.documents import Document
+
+
+TOPICS = {
+    "aprendizado federado": "federado clientes agregação gradientes servidor rodadas heterogeneidade comunicação privacidade pesos local global",
+    "privacidade diferencial": "privacidade ruído orçamento epsilon sensibilidade mecanismo laplaciano gaussiano garantia vazamento consulta agregado",
+    "redes neurais convolucionais": "convolução filtros camadas pooling ativação imagens retropropagação gradiente profundidade kernels mapas treinamento",
+    "processamento de linguagem natural": "tokens embeddings atenção transformer vocabulário sentenças corpus contexto modelo linguagem tradução sumarização",
+    "aprendizado por reforço": "agente recompensa política ambiente estados ações exploração valor episódios desconto trajetória simulação",
+    "sistemas de recomendação": "usuários itens avaliações filtragem colaborativa fatoração matriz preferências ranking cliques esparsidade implícito",
+    "visão computacional": "detecção segmentação objetos pixels anotações caixas imagens câmera rastreamento profundidade rótulos dataset",
+    "computação quântica": "qubits superposição emaranhamento portas circuito medição decoerência algoritmo amplitude fase hamiltoniano erro",
+}
+
+GENERAL = (
+    "metodologia resultados análise estudo proposta experimentos avaliação desempenho abordagem conjunto dados "
+    "trabalho seção tabela figura comparação método técnica modelo parâmetros hipótese conclusões limitações "
+    "contribuição literatura revisão implementação métricas precisão acurácia base referência cenário etapa"
+).split()
+
+CONNECTORS = "de a o que e do da em para com os as no na por uma um ao se mais como".split()
+
+
+def _topic_words(topic: str) -> List[str]:
+    return topic.split() + TOPICS[topic].split()
+
+
+def page_text(page_index: int, words: int = 400, seed: int = 0) -> str:
+    """Text of one synthetic page: mostly its topic's vocabulary, plus general words and connectors."""
+    rng = random.Random(seed * 1_000_003 + page_index)
+    topics = list(TOPICS)
+    topic = topics[page_index % len(topics)]
+    vocab = _topic_words(topic)
+    sentences, current = [], []
+    for _ in range(words):
+        roll = rng.random()
+        if roll < 0.45:
+            current.append(rng.choice(vocab))
+        elif roll < 0.7:
+            current.append(rng.choice(GENERAL))
+        else:
+            current.append(rng.choice(CONNECTORS))
+        if len(current) >= rng.randint(10, 18):
+            sentences.append(" ".join(current).capitalize() + ".")
+            current = []
+    if current:
+        sentences.append(" ".join(current).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def synthetic_pages(n_pages: int, words_per_page: int = 140, n_sources: int = 5, seed: int = 0) -> List[Document]:
+    """`n_pages` page Documents spread over `n_sources` fake PDFs (metadata like `iter_pdf_pages`)."""
+    pages = []
+    for i in range(n_pages):
+        source = f"sintetico_{i % n_sources}.pdf"
+        pages.append(Document(
+            page_content=page_text(i, words_per_page, seed),
+            metadata={"source_file": source, "page_number": i // n_sources + 1, "file_hash": f"synthetic-{seed}-{n_pages}-{words_per_page}-{i % n_sources}"},
+        ))
+    return pages
+
+
+def synthetic_queries(n: int, seed: int = 0) -> List[str]:
+    """Questions mixing a topic name with a few of its terms (what users ask in the chat)."""
+    rng = random.Random(seed + 1)
+    topics = list(TOPICS)
+    queries = []
+    for i in range(n):
+        topic = topics[i % len(topics)]
+        terms = rng.sample(TOPICS[topic].split(), 3)
+        queries.append(f"o que os artigos dizem sobre {topic} e {' '.join(terms)}")
+    return queries
+
+
+def _pdf_escape(line: str) -> bytes:
+    raw = line.encode("cp1252", errors="replace")
+    return raw.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def _wrap(text: str, width: int = 95) -> List[str]:
+    lines, current = [], ""
+    for word in text.split():
+        if current and len(current) + 1 + len(word) > width:
+            lines.append(current)
+            current = word
+        else:
+            current = f"{current} {word}" if current else word
+    if current:
+        lines.append(current)
+    return lines
+
+
+def write_pdf(path: str, page_texts: List[str]):
+    """Write a minimal valid PDF with one page per text (A4, Helvetica 10pt)."""
+    objects = {}
+    n_pages = len(page_texts)
+    page_ids = [4 + 2 * i for i in range(n_pages)]
+    objects[1] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids).encode()
+    objects[2] = b"<< /Type /Pages /Kids [" + kids + b"] /Count " + str(n_pages).encode() + b" >>"
+    objects[3] = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"
+    for pid, text in zip(page_ids, page_texts):
+        lines = _wrap(text)
+        leading = min(12.0, 760.0 / max(1, len(lines)))
+        stream = [b"BT", b"/F1 10 Tf", f"{leading:.2f} TL".encode(), b"40 800 Td"]
+        for line in lines:
+            stream.append(b"(" + _pdf_escape(line) + b") Tj T*")
+        stream.append(b"ET")
+        content = b"\n".join(stream)
+        objects[pid] = (
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents "
+            + f"{pid + 1} 0 R".encode() + b" >>"
+        )
+        objects[pid + 1] = b"<< /Length " + str(len(content)).encode() + b" >>\nstream\n" + content + b"\nendstream"
+    out = bytearray(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+    offsets = {}
+    for obj_id in sorted(objects):
+        offsets[obj_id] = len(out)
+        out += f"{obj_id} 0 obj\n".encode() + objects[obj_id] + b"\nendobj\n"
+    xref = len(out)
+    size = max(objects) + 1
+    out += f"xref\n0 {size}\n".encode() + b"0000000000 65535 f \n"
+    for obj_id in range(1, size):
+        out += f"{offsets[obj_id]:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {size} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, "wb") as fh:
+        fh.write(bytes(out))
+
+
+def write_synthetic_pdfs(directory: str, n_pdfs: int, pages_per_pdf: int, words_per_page: int = 400, seed: int = 0) -> List[str]:
+    """Write `n_pdfs` PDFs of `pages_per_pdf` pages into `directory`; returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for d in range(n_pdfs):
+        texts = [page_text(d * pages_per_pdf + p, words_per_page, seed) for p in range(pages_per_pdf)]
+        path = os.path.join(directory, f"artigo_sintetico_{d}.pdf")
+        write_pdf(path, texts)
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--pdfs", type=int, default=3)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--words-per-page", type=int, default=400)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for path in write_synthetic_pdfs(args.out, args.pdfs, args.pages, args.words_per_page, args.seed):
+        print(path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
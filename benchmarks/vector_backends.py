@@ -0,0 +1,130 @@
+"""Latency benchmark: NumpyVectorStore vs Chroma on synthetic chunks.
+
+Uses deterministic hash-based embeddings (no model download), so it measures only
+the vector store: indexing time, single-query p50/p99 and batched multi-query
+throughput. Results are printed as JSON.
+
+    python -m benchmarks.vector_backends --chunks 2000 5000 --queries 200
+"""
+import argparse
+import hashlib
+import json
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from numpy_store import NumpyVectorStore
+
+
+class HashEmbeddings:
+    """Deterministic pseudo-embeddings: one normalized Gaussian vector per text."""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+        self.model_name = f"hash-{dim}"
+
+    def _vector(self, text: str) -> np.ndarray:
+        seed = int(hashlib.sha1(text.encode("utf-8")).hexdigest()[:8], 16)
+        vec = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vec / np.linalg.norm(vec)
+
+    def encode(self, texts):
+        return np.stack([self._vector(t) for t in texts]) if texts else np.empty((0, self.dim), dtype=np.float32)
+
+    def embed_query_array(self, text):
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        return self.encode(texts).tolist()
+
+    def embed_query(self, text):
+        return self._vector(text).tolist()
+
+
+def _percentile(values, q):
+    return float(np.percentile(np.asarray(values) * 1000.0, q))
+
+
+def bench_store(store, texts, metadatas, ids, queries, k, batch_size=256):
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch_size):
+        store.add_texts(texts[i:i + batch_size], metadatas=metadatas[i:i + batch_size], ids=ids[i:i + batch_size])
+    index_s = time.perf_counter() - start
+
+    latencies = []
+    for q in queries:
+        t0 = time.perf_counter()
+        store.similarity_search(q, k=k)
+        latencies.append(time.perf_counter() - t0)
+
+    filtered = []
+    for q in queries:
+        t0 = time.perf_counter()
+        store.similarity_search(q, k=k, filter={"source_file": "doc0.pdf"})
+        filtered.append(time.perf_counter() - t0)
+
+    result = {
+        "index_seconds": index_s,
+        "query_p50_ms": _percentile(latencies, 50),
+        "query_p99_ms": _percentile(latencies, 99),
+        "filtered_query_p50_ms": _percentile(filtered, 50),
+        "filtered_query_p99_ms": _percentile(filtered, 99),
+    }
+    if hasattr(store, "batch_similarity_search"):
+        t0 = time.perf_counter()
+        store.batch_similarity_search(queries, k=k)
+        result["batch_queries_per_second"] = len(queries) / (time.perf_counter() - t0)
+    return result
+
+
+def run(chunk_counts, n_queries, k, dim, backends):
+    embeddings = HashEmbeddings(dim)
+    report = {"dim": dim, "k": k, "queries": n_queries, "results": []}
+    for n in chunk_counts:
+        texts = [f"chunk {i} sobre o tópico {i % 97} do artigo {i % 5}" for i in range(n)]
+        metadatas = [{"source_file": f"doc{i % 5}.pdf", "page_number": i % 40 + 1} for i in range(n)]
+        ids = [f"id-{i}" for i in range(n)]
+        queries = [f"pergunta {j} sobre o tópico {j % 97}" for j in range(n_queries)]
+        for backend in backends:
+            workdir = tempfile.mkdtemp(prefix=f"bench-{backend}-")
+            try:
+                if backend == "numpy":
+                    store = NumpyVectorStore(embeddings, persist_directory=workdir, collection_name="bench")
+                else:
+                    try:
+                        from langchain_chroma import Chroma
+                    except ImportError:
+                        report["results"].append({"backend": backend, "chunks": n, "skipped": "langchain_chroma not installed"})
+                        continue
+                    store = Chroma(persist_directory=workdir, collection_name="bench", embedding_function=embeddings)
+                entry = {"backend": backend, "chunks": n}
+                entry.update(bench_store(store, texts, metadatas, ids, queries, k))
+                report["results"].append(entry)
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--backends", nargs="+", default=["numpy", "chroma"])
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+    report = run(args.chunks, args.queries, args.k, args.dim, args.backends)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            fh.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+import os
+import re
+import json
+import math
+import threading
+from functools import lru_cache
+from typing import Iterable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]", flags=re.UNICODE)
+
+_ENCODING = None
+_ENCODING_LOCK = threading.Lock()
+
+
+def _tiktoken_encoding():
+    """tiktoken encoding (`RAG_TIKTOKEN_ENCODING`, default cl100k_base), or False to estimate.
+
+    tiktoken (in requirements.txt) downloads the BPE file once and keeps it in
+    `TIKTOKEN_CACHE_DIR`, which defaults here to a persistent directory next to the
+    embedding cache instead of tiktoken's temporary one, so later runs count tokens
+    offline. If tiktoken is missing or the first download fails, the word-based
+    estimate is used for the rest of the process.
+    """
+    global _ENCODING
+    with _ENCODING_LOCK:
+        if _ENCODING is None:
+            os.environ.setdefault(
+                "TIKTOKEN_CACHE_DIR",
+                os.path.join(os.path.expanduser("~"), ".cache", "rag-chat-colab", "tiktoken"),
+            )
+            try:
+                import tiktoken
+
+                _ENCODING = tiktoken.get_encoding(os.environ.get("RAG_TIKTOKEN_ENCODING", "cl100k_base"))
+            except Exception:
+                # sem tiktoken, ou falha no primeiro download do arquivo BPE: estimativa por palavras
+                _ENCODING = False
+        return _ENCODING
+
+
+def _piece_tokens(piece: str) -> int:
+    # BPE quebra palavras longas (ainda mais em português) em pedaços de ~4 caracteres
+    return max(1, math.ceil(len(piece) / 4)) if piece[0].isalnum() or piece[0] == "_" else 1
+
+
+# só textos curtos (mensagens, trechos de payload) vão para o cache: prompts e saídas de
+# tools inteiros teriam dezenas de KB por entrada
+_CACHED_TEXT_CHARS = 2048
+
+
+def count_tokens(text: str) -> int:
+    """Number of LLM tokens of `text`: exact with tiktoken, otherwise a word-based estimate."""
+    if not text:
+        return 0
+    if len(text) <= _CACHED_TEXT_CHARS:
+        return _count_tokens_cached(text)
+    return _count_tokens(text)
+
+
+@lru_cache(maxsize=8192)
+def _count_tokens_cached(text: str) -> int:
+    return _count_tokens(text)
+
+
+def _count_tokens(text: str) -> int:
+    encoding = _tiktoken_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return sum(_piece_tokens(p) for p in _PIECE_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, ellipsis: str = "...") -> str:
+    """`text` cut to at most `max_tokens` tokens (at a word boundary when estimating)."""
+    if max_tokens <= 0 or not text:
+        return ""
+    if count_tokens(text) <= max_tokens:
+        return text
+    room = max(0, max_tokens - count_tokens(ellipsis))
+    encoding = _tiktoken_encoding()
+    if encoding:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:room]).rstrip() + ellipsis
+    used, end = 0, 0
+    for match in _PIECE_RE.finditer(text):
+        used += _piece_tokens(match.group())
+        if used > room:
+            break
+        end = match.end()
+    return text[:end].rstrip() + ellipsis
+
+
+class TokenBudget:
+    """Running token allowance: `fit` charges what it keeps and refuses what does not fit."""
+
+    def __init__(self, max_tokens: int):
+        self.max_tokens = max(0, int(max_tokens))
+        self.used = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(0, self.max_tokens - self.used)
+
+    def charge(self, tokens: int):
+        self.used += max(0, int(tokens))
+
+    def fit(self, text: str, min_tokens: int = 32, max_tokens: Optional[int] = None) -> Optional[str]:
+        """`text`, truncated to the remaining budget (and `max_tokens`), or None if less than `min_tokens` is left."""
+        if not text:
+            return text
+        limit = self.remaining if max_tokens is None else min(self.remaining, max_tokens)
+        tokens = count_tokens(text)
+        if tokens > limit:
+            if limit < min(min_tokens, tokens):
+                return None
+            text = truncate_to_tokens(text, limit)
+            tokens = count_tokens(text)
+        self.charge(tokens)
+        return text
+
+
+def token_budget(env_var: str, default: int) -> int:
+    """Token budget read from `env_var` (0 or negative disables the limit)."""
+    value = int(os.environ.get(env_var, str(default)))
+    return value if value > 0 else 10 ** 9
+
+
+# ---------------------------------------------------------------------- chunk merging
+def _page_key(doc: Document):
+    meta = getattr(doc, "metadata", {}) or {}
+    return (meta.get("source_file", meta.get("source")), meta.get("page_number", meta.get("page")))
+
+
+def _text_overlap(left: str, right: str, min_overlap: int) -> int:
+    """Length of the longest suffix of `left` that is a prefix of `right` (0 if < `min_overlap`)."""
+    for size in range(min(len(left), len(right)), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _join(first: dict, second: dict, min_overlap: int) -> Optional[dict]:
+    """Merge two pieces of the same page if one contains, overlaps or touches the other."""
+    a, b = first["text"], second["text"]
+    if first["start"] is not None and second["start"] is not None:
+        if second["start"] < first["start"]:
+            first, second, a, b = second, first, b, a
+        end = first["start"] + len(a)
+        if second["start"] > end + 2:
+            return None
+        if second["start"] >= end:
+            # trechos vizinhos, separados só pelo espaço removido no corte
+            text = f"{a} {b}"
+        else:
+            text = a + b[end - second["start"]:]
+        return {"text": text, "start": first["start"], "rank": min(first["rank"], second["rank"]), "doc": first["doc"]}
+    if b in a:
+        return {**first, "rank": min(first["rank"], second["rank"])}
+    if a in b:
+        return {**second, "rank": min(first["rank"], second["rank"])}
+    for left, right in ((first, second), (second, first)):
+        size = _text_overlap(left["text"], right["text"], min_overlap)
+        if size:
+            return {
+                "text": left["text"] + right["text"][size:],
+                "start": None,
+                "rank": min(first["rank"], second["rank"]),
+                "doc": left["doc"],
+            }
+    return None
+
+
+def merge_chunks(docs: Sequence[Document], min_overlap: int = 20) -> List[Document]:
+    """Merge retrieved chunks of the same page that overlap, touch or contain one another.
+
+    Chunks are cut with an overlap (200 characters by default), so neighbouring hits
+    repeat text. Pieces of the same (source, page) are joined on their `start_index`
+    metadata when both have it, otherwise on the longest suffix/prefix overlap of at
+    least `min_overlap` characters; contained chunks are dropped. The result keeps the
+    rank order of the best chunk of each merged piece.
+    """
+    groups = {}
+    for rank, doc in enumerate(docs):
+        text = (doc.page_content or "").strip()
+        if not text:
+            continue
+        start = (doc.metadata or {}).get("start_index")
+        piece = {"text": text, "start": start if isinstance(start, int) else None, "rank": rank, "doc": doc}
+        pieces = groups.setdefault(_page_key(doc), [])
+        merged = True
+        while merged:
+            merged = False
+            for i, other in enumerate(pieces):
+                joined = _join(other, piece, min_overlap)
+                if joined is not None:
+                    # o trecho unido pode agora encostar em outro da mesma página
+                    piece = joined
+                    del pieces[i]
+                    merged = True
+                    break
+        pieces.append(piece)
+    ordered = sorted((p for pieces in groups.values() for p in pieces), key=lambda p: p["rank"])
+    results = []
+    for piece in ordered:
+        doc = piece["doc"]
+        if piece["text"] == (doc.page_content or "").strip():
+            results.append(doc)
+        else:
+            metadata = dict(doc.metadata or {})
+            if piece["start"] is not None:
+                metadata["start_index"] = piece["start"]
+            results.append(Document(page_content=piece["text"], metadata=metadata))
+    return results
+
+
+# ---------------------------------------------------------------------- output
+def compact_json(payload) -> str:
+    """JSON without indentation or spaces after separators (about a third fewer tokens than indent=2)."""
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def fit_newest(texts: Iterable[str], budget: TokenBudget, min_tokens: int = 16) -> List[str]:
+    """The most recent `texts` (last = newest) that fit in `budget`, in their original order.
+
+    The oldest kept text may be truncated; anything older than it is dropped.
+    """
+    kept = []
+    for text in reversed(list(texts)):
+        fitted = budget.fit(text, min_tokens=min_tokens)
+        if fitted is None:
+            break
+        kept.append(fitted)
+        if fitted != text:
+            break
+    kept.reverse()
+    return kept
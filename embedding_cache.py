@@ -0,0 +1,235 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Collapse whitespace so that re-extracted text with different spacing hits the same entry."""
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def normalized_text_hash(text: str) -> str:
+    return hashlib.sha1(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Content-addressed, on-disk embedding cache shared by every index.
+
+    Layout inside `cache_dir`:
+    - `index.sqlite`: one row per (model_key, text_hash) with the slot of its vector and
+      the last access time (used for LRU eviction);
+    - `<model>-<dim>.f32`: a flat float32 matrix per model, read through `np.memmap`.
+
+    When the stored vectors exceed `max_bytes`, the least recently used entries are
+    evicted and their slots are reused by the next inserts, so the blob files stay around
+    the configured size instead of growing with every rebuild.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_bytes)
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._memmaps = {}
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " model_key TEXT NOT NULL, text_hash TEXT NOT NULL, slot INTEGER NOT NULL,"
+            " last_access REAL NOT NULL, PRIMARY KEY (model_key, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            " model_key TEXT PRIMARY KEY, dim INTEGER NOT NULL, next_slot INTEGER NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS free_slots ("
+            " model_key TEXT NOT NULL, slot INTEGER NOT NULL, PRIMARY KEY (model_key, slot))"
+        )
+
+    def _blob_path(self, model_key: str, dim: int) -> str:
+        safe = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_key)
+        digest = hashlib.sha1(model_key.encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.cache_dir, f"{safe}-{digest}-{dim}.f32")
+
+    def _matrix(self, model_key: str, dim: int, rows_needed: int):
+        """Memory-mapped view of the blob, remapped only when it has grown."""
+        path = self._blob_path(model_key, dim)
+        rows = os.path.getsize(path) // (4 * dim) if os.path.exists(path) else 0
+        cached = self._memmaps.get(path)
+        if cached is not None and cached.shape[0] >= rows_needed:
+            return cached
+        if rows == 0:
+            return None
+        mm = np.memmap(path, dtype=np.float32, mode="r", shape=(rows, dim))
+        self._memmaps[path] = mm
+        return mm
+
+    def get_many(self, model_key: str, hashes: Sequence[str], dim: int):
+        """Return (vectors, found) where `found[i]` tells whether `hashes[i]` was cached."""
+        vectors = np.zeros((len(hashes), dim), dtype=np.float32)
+        found = np.zeros(len(hashes), dtype=bool)
+        if not hashes:
+            return vectors, found
+        with self._lock:
+            # a leitura dos slots e do memmap fica numa transação de escrita: um put_many de
+            # outro processo (que grava o blob dentro da sua) não pode despejar e reutilizar
+            # um slot entre as duas leituras
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                slots = {}
+                unique = list(dict.fromkeys(hashes))
+                # consultas em blocos para respeitar o limite de parâmetros do SQLite
+                for start in range(0, len(unique), 500):
+                    block = unique[start:start + 500]
+                    marks = ",".join("?" * len(block))
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, slot FROM entries WHERE model_key = ? AND text_hash IN ({marks})",
+                        [model_key, *block],
+                    ).fetchall()
+                    slots.update(rows)
+                if slots:
+                    matrix = self._matrix(model_key, dim, max(slots.values()) + 1)
+                    now = time.time()
+                    for i, h in enumerate(hashes):
+                        slot = slots.get(h)
+                        if slot is None or matrix is None or slot >= matrix.shape[0]:
+                            continue
+                        vectors[i] = matrix[slot]
+                        found[i] = True
+                    self._conn.executemany(
+                        "UPDATE entries SET last_access = ? WHERE model_key = ? AND text_hash = ?",
+                        [(now, model_key, h) for h in slots],
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.hits += int(found.sum())
+            self.misses += int(len(hashes) - found.sum())
+        return vectors, found
+
+    def put_many(self, model_key: str, hashes: Sequence[str], vectors: np.ndarray):
+        if not len(hashes):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        dim = int(vectors.shape[1])
+        path = self._blob_path(model_key, dim)
+        with self._lock:
+            conn = self._conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT dim, next_slot FROM blobs WHERE model_key = ?", (model_key,)).fetchone()
+                next_slot = row[1] if row else 0
+                if row is None:
+                    conn.execute("INSERT INTO blobs (model_key, dim, next_slot) VALUES (?, ?, 0)", (model_key, dim))
+                existing = set()
+                for start in range(0, len(hashes), 500):
+                    block = list(hashes[start:start + 500])
+                    marks = ",".join("?" * len(block))
+                    existing.update(h for (h,) in conn.execute(
+                        f"SELECT text_hash FROM entries WHERE model_key = ? AND text_hash IN ({marks})",
+                        [model_key, *block],
+                    ))
+                pending = []
+                for h, vec in zip(hashes, vectors):
+                    if h in existing:
+                        continue
+                    existing.add(h)
+                    free = conn.execute("SELECT slot FROM free_slots WHERE model_key = ? LIMIT 1", (model_key,)).fetchone()
+                    if free:
+                        slot = free[0]
+                        conn.execute("DELETE FROM free_slots WHERE model_key = ? AND slot = ?", (model_key, slot))
+                    else:
+                        slot = next_slot
+                        next_slot += 1
+                    pending.append((h, slot, vec))
+                if pending:
+                    mode = "r+b" if os.path.exists(path) else "w+b"
+                    with open(path, mode) as fh:
+                        for _, slot, vec in sorted(pending, key=lambda p: p[1]):
+                            fh.seek(slot * dim * 4)
+                            fh.write(vec.tobytes())
+                    now = time.time()
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO entries (model_key, text_hash, slot, last_access) VALUES (?, ?, ?, ?)",
+                        [(model_key, h, slot, now) for h, slot, _ in pending],
+                    )
+                    conn.execute("UPDATE blobs SET next_slot = ? WHERE model_key = ?", (next_slot, model_key))
+                self._evict()
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _evict(self):
+        """Drop least recently used entries while the cache is above `max_bytes`.
+
+        Each model's entries weigh `4 * dim` bytes, with `dim` from its `blobs` row, so
+        models of different sizes share the budget correctly.
+        """
+        used = self._conn.execute(
+            "SELECT COALESCE(SUM(4 * b.dim), 0) FROM entries e JOIN blobs b ON b.model_key = e.model_key"
+        ).fetchone()[0]
+        excess = used - self.max_bytes
+        while excess > 0:
+            victims = self._conn.execute(
+                "SELECT e.model_key, e.text_hash, e.slot, 4 * b.dim FROM entries e JOIN blobs b ON b.model_key = e.model_key"
+                " ORDER BY e.last_access ASC LIMIT 500"
+            ).fetchall()
+            if not victims:
+                return
+            chosen = []
+            for victim in victims:
+                chosen.append(victim)
+                excess -= victim[3]
+                if excess <= 0:
+                    break
+            self._conn.executemany("DELETE FROM entries WHERE model_key = ? AND text_hash = ?", [(m, h) for m, h, _, _ in chosen])
+            self._conn.executemany("INSERT OR IGNORE INTO free_slots (model_key, slot) VALUES (?, ?)", [(m, slot) for m, _, slot, _ in chosen])
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {"entries": count, "hits": self.hits, "misses": self.misses, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self._memmaps.clear()
+            self._conn.close()
+
+
+_CACHE_REGISTRY: dict = {}
+_CACHE_REGISTRY_LOCK = threading.Lock()
+
+
+def get_embedding_cache(cache_dir: Optional[str] = None, max_bytes: Optional[int] = None) -> Optional[EmbeddingCache]:
+    """Return the process-wide cache for `cache_dir` (env `RAG_EMBED_CACHE_DIR`), or None if disabled.
+
+    Set `RAG_EMBED_CACHE_DIR=off` to disable the cache; `RAG_EMBED_CACHE_MAX_MB` sets its size.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get(
+            "RAG_EMBED_CACHE_DIR",
+            os.path.join(os.path.expanduser("~"), ".cache", "rag-chat-colab", "embeddings"),
+        )
+    if not cache_dir or cache_dir.strip().lower() in ("off", "0", "false", "none"):
+        return None
+    if max_bytes is None:
+        max_bytes = int(float(os.environ.get("RAG_EMBED_CACHE_MAX_MB", "512")) * 1024 * 1024)
+    key = os.path.abspath(cache_dir)
+    with _CACHE_REGISTRY_LOCK:
+        cache = _CACHE_REGISTRY.get(key)
+        if cache is None:
+            cache = EmbeddingCache(key, max_bytes=max_bytes)
+            _CACHE_REGISTRY[key] = cache
+        return cache
@@ -0,0 +1,49 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: sem flock, apenas exclusão entre threads do processo
+    fcntl = None
+
+
+_THREAD_LOCKS = {}
+_THREAD_LOCKS_GUARD = threading.Lock()
+
+
+def _thread_lock(path: str) -> threading.Lock:
+    with _THREAD_LOCKS_GUARD:
+        lock = _THREAD_LOCKS.get(path)
+        if lock is None:
+            lock = threading.Lock()
+            _THREAD_LOCKS[path] = lock
+        return lock
+
+
+@contextmanager
+def file_lock(path: str, shared: bool = False):
+    """Advisory lock on `path`, held through the sidecar `<path>.lock`.
+
+    Uses `flock`, so it serializes every process on the machine that goes through this
+    helper (each Streamlit session, the CLI, background indexers) as well as threads of
+    the same process, since each call opens its own descriptor. `shared=True` takes a
+    read lock. Where `fcntl` is unavailable it degrades to a per-path thread lock.
+    """
+    lock_path = f"{os.path.abspath(path)}.lock"
+    if fcntl is None:
+        with _thread_lock(lock_path):
+            yield
+        return
+    parent = os.path.dirname(lock_path)
+    if parent:
+        os.makedirs(parent, exist_ok=True)
+    fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
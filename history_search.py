@@ -0,0 +1,173 @@
+import os
+import hashlib
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from file_locks import file_lock
+from history_store import HistoryRecord, HistoryStore, get_history_store, parse_history_line
+from numpy_store import _encode_query, _encode_texts, _normalize_rows
+
+
+def _record_text(record: Optional[HistoryRecord]) -> str:
+    if record is None:
+        return ""
+    return f"{record.user}: {record.content}" if record.role == "user" and record.user else record.content
+
+
+class HistoryVectorIndex:
+    """Embeddings of every conversation message, for semantic search over the whole history.
+
+    Row i of `<log>.<model>.f32` is the (normalized, float32) embedding of line i of the
+    history log, so no id mapping is needed: `sync` embeds only the lines appended since
+    the last call, in one batch, with the embedding model already loaded for the
+    articles, and appends them under the vectors file's advisory lock (one process embeds
+    a given message once). If the log shrank, the file is rebuilt. The matrix is
+    kept in memory and small (about 1.5 MB per thousand messages with MiniLM).
+
+    `search` ranks messages by cosine similarity blended with recency:
+    `(1 - recency_weight) * similarity + recency_weight * 0.5 ** (age / half_life)`, where
+    age is the number of messages since then (the log has no timestamps).
+    """
+
+    def __init__(self, store: HistoryStore, embeddings, half_life: float = 200.0, recency_weight: float = 0.2):
+        self.store = store
+        self.embeddings = embeddings
+        self.half_life = max(1.0, float(half_life))
+        self.recency_weight = min(1.0, max(0.0, float(recency_weight)))
+        model_key = getattr(embeddings, "cache_key", None) or getattr(embeddings, "model_name", None) or type(embeddings).__name__
+        digest = hashlib.sha1(str(model_key).encode("utf-8")).hexdigest()[:12]
+        self.vectors_path = f"{store.path}.{digest}.f32"
+        self._matrix: Optional[np.ndarray] = None
+        self._lock = threading.Lock()
+        # agendamento separado do _lock: sync segura _lock durante todo o embedding
+        self._schedule_lock = threading.Lock()
+        self._sync_thread = None
+        self._sync_pending = False
+
+    def _dimension(self) -> int:
+        dim = getattr(self.embeddings, "dimension", None)
+        if dim:
+            return int(dim)
+        return int(_encode_query(self.embeddings, "dimension probe").shape[-1])
+
+    def _embed_lines(self, lines: List[str], dim: int) -> np.ndarray:
+        texts = [_record_text(parse_history_line(line)) for line in lines]
+        vectors = np.zeros((len(texts), dim), dtype=np.float32)
+        keep = [i for i, t in enumerate(texts) if t]
+        if keep:
+            # linhas malformadas ficam com vetor nulo (similaridade 0), mantendo o alinhamento linha ↔ linha
+            vectors[keep] = _normalize_rows(_encode_texts(self.embeddings, [texts[i] for i in keep]))
+        return vectors
+
+    def sync(self) -> int:
+        """Embed the messages appended since the last sync; returns the number of indexed messages."""
+        with self._lock:
+            dim = self._dimension()
+            row_bytes = dim * 4
+            if not os.path.exists(self.store.path):
+                self._matrix = np.zeros((0, dim), dtype=np.float32)
+                return 0
+            # lock próprio do arquivo de vetores (o do log é tomado por store.refresh); a
+            # contagem é lida já com ele, então outro processo só pode ter gravado linhas
+            # até uma contagem menor ou igual: mais linhas que `count` significa log encolhido
+            with file_lock(self.vectors_path):
+                count = self.store.refresh()
+                with open(self.vectors_path, "a+b") as fh:
+                    size = fh.seek(0, os.SEEK_END)
+                    rows = size // row_bytes
+                    if size % row_bytes or rows > count:
+                        # escrita interrompida ou log encolhido/substituído: reconstruir
+                        rows = 0 if rows > count else rows
+                        fh.truncate(rows * row_bytes)
+                        self._matrix = None
+                    if rows < count:
+                        fh.seek(0, os.SEEK_END)
+                        fh.write(self._embed_lines(self.store.lines_range(rows, count), dim).tobytes())
+                        fh.flush()
+                if self._matrix is not None and len(self._matrix) > count:
+                    # outro processo reconstruiu o arquivo
+                    self._matrix = None
+                have = 0 if self._matrix is None else len(self._matrix)
+                if have < count:
+                    fresh = np.fromfile(self.vectors_path, dtype=np.float32, count=(count - have) * dim, offset=have * row_bytes)
+                    fresh = fresh.reshape(-1, dim)
+                    self._matrix = fresh if self._matrix is None else np.concatenate([self._matrix, fresh])
+            return count
+
+    def schedule_sync(self):
+        """Run `sync` in a background thread without waiting for a sync in progress.
+
+        If one is already running, it is asked to run again once it finishes, so the
+        messages appended meanwhile are embedded too.
+        """
+        with self._schedule_lock:
+            if self._sync_thread is not None and self._sync_thread.is_alive():
+                self._sync_pending = True
+                return self._sync_thread
+            self._sync_pending = False
+            self._sync_thread = threading.Thread(target=self._safe_sync, name="history-embeddings", daemon=True)
+            self._sync_thread.start()
+            return self._sync_thread
+
+    def _safe_sync(self):
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                pass
+            with self._schedule_lock:
+                if not self._sync_pending:
+                    self._sync_thread = None
+                    return
+                self._sync_pending = False
+
+    def search(self, query: str, k: int = 8, min_similarity: float = 0.2) -> List[Tuple[int, str, float]]:
+        """The `k` most relevant messages as (line number, raw line, score), in chronological order."""
+        count = self.sync()
+        if count == 0 or k <= 0 or not (query or "").strip():
+            return []
+        matrix = self._matrix[:count]
+        q = _normalize_rows(_encode_query(self.embeddings, query)[None, :])[0]
+        similarity = matrix @ q
+        age = (count - 1) - np.arange(count, dtype=np.float32)
+        recency = np.power(0.5, age / self.half_life)
+        scores = (1.0 - self.recency_weight) * similarity + self.recency_weight * recency
+        scores = np.where(similarity >= min_similarity, scores, -np.inf)
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        results = []
+        for i in sorted(int(i) for i in top):
+            lines = self.store.lines_range(i, i + 1)
+            if lines:
+                results.append((i, lines[0], float(scores[i])))
+        return results
+
+
+_HISTORY_INDEXES = {}
+_HISTORY_INDEXES_LOCK = threading.Lock()
+
+
+def get_history_vector_index(history_path: str, embeddings) -> HistoryVectorIndex:
+    """Process-wide HistoryVectorIndex for (`history_path`, embedding model).
+
+    `RAG_HISTORY_HALF_LIFE` (messages, default 200) and `RAG_HISTORY_RECENCY_WEIGHT`
+    (default 0.2) tune the time decay of `search`.
+    """
+    store = get_history_store(history_path)
+    model_key = getattr(embeddings, "cache_key", None) or getattr(embeddings, "model_name", None) or id(embeddings)
+    key = (store.path, model_key)
+    with _HISTORY_INDEXES_LOCK:
+        index = _HISTORY_INDEXES.get(key)
+        if index is None:
+            index = HistoryVectorIndex(
+                store,
+                embeddings,
+                half_life=float(os.environ.get("RAG_HISTORY_HALF_LIFE", "200")),
+                recency_weight=float(os.environ.get("RAG_HISTORY_RECENCY_WEIGHT", "0.2")),
+            )
+            _HISTORY_INDEXES[key] = index
+        return index
@@ -0,0 +1,410 @@
+import os
+import queue
+import struct
+import threading
+from collections import deque
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from file_locks import file_lock
+
+
+_OFFSET = struct.Struct("<Q")
+_SCAN_BLOCK = 1 << 20
+
+
+class HistoryRecord(NamedTuple):
+    role: str
+    user: str
+    content: str
+
+
+def format_history_line(role: str, user: str, content: str) -> str:
+    """One history record in the `role::user::content` log format (newlines flattened)."""
+    content = (content or "").replace("\r", " ").replace("\n", " ")
+    return f"{role or ''}::{user or ''}::{content}\n"
+
+
+def parse_history_line(line: str) -> Optional[HistoryRecord]:
+    parts = line.rstrip("\r\n").split("::", 2)
+    if len(parts) < 3:
+        return None
+    return HistoryRecord(parts[0].strip().lower(), parts[1].strip(), parts[2].strip())
+
+
+class HistoryStore:
+    """Append-only conversation log with a sidecar line-offset index for O(k) tail reads.
+
+    The log keeps the original `role::user::content` text format (one record per line),
+    so existing `conversation_history.txt` files and anything that reads them keep
+    working. Next to it, `<log>.idx` stores the end offset of every complete line as a
+    little-endian uint64; the last k records are found by reading the last k offsets and
+    then one contiguous byte range of the log.
+
+    The index follows the log lazily: on every read the log size is compared with the
+    last indexed offset and only the appended bytes are scanned. A legacy file without an
+    index is migrated by a single sequential scan on first use; a log that shrank or was
+    replaced is re-indexed from scratch.
+
+    Appends go through a `GroupCommitWriter`, and both the log appends and the index
+    maintenance hold the advisory lock of the log, so several processes (one per
+    Streamlit session) can share the same history safely.
+    """
+
+    def __init__(self, path: str, index_path: Optional[str] = None, fsync: bool = True):
+        self.path = path
+        self.index_path = index_path or f"{path}.idx"
+        self.writer = GroupCommitWriter(path, fsync=fsync)
+        self._lock = threading.RLock()
+
+    # ------------------------------------------------------------------ index
+    def _indexed_end(self, idx) -> int:
+        size = idx.seek(0, os.SEEK_END)
+        if size < _OFFSET.size:
+            return 0
+        idx.seek(size - size % _OFFSET.size - _OFFSET.size)
+        return _OFFSET.unpack(idx.read(_OFFSET.size))[0]
+
+    def _scan(self, log, idx, start: int, end: int):
+        """Append to the index the end offset of every line terminated in log[start:end]."""
+        log.seek(start)
+        pos = start
+        offsets = bytearray()
+        while pos < end:
+            block = log.read(min(_SCAN_BLOCK, end - pos))
+            if not block:
+                break
+            nl = block.find(b"\n")
+            while nl != -1:
+                offsets += _OFFSET.pack(pos + nl + 1)
+                nl = block.find(b"\n", nl + 1)
+            pos += len(block)
+        if offsets:
+            idx.seek(0, os.SEEK_END)
+            idx.write(offsets)
+            idx.flush()
+
+    def _is_consistent(self, log, indexed_end: int, log_size: int) -> bool:
+        if indexed_end == 0:
+            return True
+        if indexed_end > log_size:
+            return False
+        log.seek(indexed_end - 1)
+        return log.read(1) == b"\n"
+
+    def _sync_index(self, write: bool) -> Optional[int]:
+        """Record count if the index is current; otherwise None (read-only) or fix it (`write`)."""
+        if not write and not os.path.exists(self.index_path):
+            return None
+        with open(self.path, "rb") as log, open(self.index_path, "a+b" if write else "rb") as idx:
+            log_size = os.fstat(log.fileno()).st_size
+            size = idx.seek(0, os.SEEK_END)
+            if size % _OFFSET.size:
+                if not write:
+                    return None
+                # escrita interrompida no meio de um offset: descartar o resto
+                idx.truncate(size - size % _OFFSET.size)
+            indexed_end = self._indexed_end(idx)
+            consistent = self._is_consistent(log, indexed_end, log_size)
+            # bytes após o último "\n" são uma linha ainda incompleta, não um atraso do índice
+            if consistent and (log_size == indexed_end or self._tail_is_partial(log, indexed_end, log_size)):
+                return idx.seek(0, os.SEEK_END) // _OFFSET.size
+            if not write:
+                return None
+            if not consistent:
+                idx.truncate(0)
+                indexed_end = 0
+            if log_size > indexed_end:
+                self._scan(log, idx, indexed_end, log_size)
+            return idx.seek(0, os.SEEK_END) // _OFFSET.size
+
+    def _tail_is_partial(self, log, indexed_end: int, log_size: int) -> bool:
+        if log_size - indexed_end > _SCAN_BLOCK:
+            return False
+        log.seek(indexed_end)
+        return b"\n" not in log.read(log_size - indexed_end)
+
+    def refresh(self) -> int:
+        """Bring the sidecar index up to date with the log; returns the number of records."""
+        with self._lock:
+            if not os.path.exists(self.path):
+                return 0
+            count = self._sync_index(write=False)
+            if count is None:
+                # só quem altera o índice precisa do lock entre processos
+                with file_lock(self.path):
+                    count = self._sync_index(write=True)
+            return count
+
+    def __len__(self) -> int:
+        return self.refresh()
+
+    # ------------------------------------------------------------------ reads
+    def tail_lines(self, n: int) -> List[str]:
+        """The last `n` raw lines of the log (without line terminators)."""
+        return self.read_tail(n)[0]
+
+    def read_tail(self, n: int) -> Tuple[List[str], int]:
+        """The last `n` raw lines and the log offset right after the last of them."""
+        with self._lock:
+            count = self.refresh()
+            if count == 0 or n <= 0:
+                return [], self._indexed_size()
+            return self._read_range(count - min(n, count), count)
+
+    def lines_range(self, start: int, end: int) -> List[str]:
+        """Raw lines `start` (inclusive) to `end` (exclusive), by record number."""
+        with self._lock:
+            count = self.refresh()
+            start, end = max(0, start), min(end, count)
+            if start >= end:
+                return []
+            return self._read_range(start, end)[0]
+
+    def _read_range(self, first: int, last: int) -> Tuple[List[str], int]:
+        n = last - first
+        with open(self.index_path, "rb") as idx:
+            # offset final da linha anterior à primeira pedida = início do trecho
+            idx.seek((first - 1) * _OFFSET.size if first else 0)
+            raw = idx.read((n + 1 if first else n) * _OFFSET.size)
+        offsets = [o for (o,) in _OFFSET.iter_unpack(raw)]
+        start = offsets[0] if first else 0
+        end = offsets[-1]
+        with open(self.path, "rb") as log:
+            log.seek(start)
+            data = log.read(end - start)
+        return data.decode("utf-8", errors="replace").splitlines(), end
+
+    def _indexed_size(self) -> int:
+        if not os.path.exists(self.index_path):
+            return 0
+        with open(self.index_path, "rb") as idx:
+            return self._indexed_end(idx)
+
+    def tail(self, n: int) -> List[HistoryRecord]:
+        """The last `n` records, parsed; malformed lines are skipped."""
+        records = []
+        for line in self.tail_lines(n):
+            record = parse_history_line(line)
+            if record is not None:
+                records.append(record)
+        return records
+
+    # ------------------------------------------------------------------ writes
+    def append(self, role: str, user: str, content: str, wait: bool = True):
+        """Append one record; with `wait`, return only once it is durably on disk."""
+        self.writer.submit(format_history_line(role, user, content).encode("utf-8"), wait=wait)
+
+    def append_many(self, records: Iterable[Tuple[str, str, str]], wait: bool = True):
+        data = b"".join(format_history_line(*record).encode("utf-8") for record in records)
+        if data:
+            self.writer.submit(data, wait=wait)
+
+
+class _PendingWrite:
+    __slots__ = ("data", "done", "error")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitWriter:
+    """Appends to one file from a single background thread, with group commit.
+
+    Callers enqueue complete records and (optionally) wait. The writer thread takes
+    everything that queued up while the previous batch was being written, and appends
+    it with one `write` and one `fsync` under the file's advisory lock. Under a burst of
+    messages from several sessions this means one fsync per batch, not one per message.
+    Because each batch is a single O_APPEND write done under the lock, records from
+    different processes never interleave.
+    """
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self.batches = 0
+        self.records = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_thread(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name=f"history-writer:{os.path.basename(self.path)}", daemon=True)
+                self._thread.start()
+
+    def submit(self, data: bytes, wait: bool = True, timeout: Optional[float] = None):
+        item = _PendingWrite(data)
+        self._queue.put(item)
+        self._ensure_thread()
+        if wait:
+            if not item.done.wait(timeout):
+                raise TimeoutError(f"Timed out waiting for write to {self.path}")
+            if item.error is not None:
+                raise item.error
+        return item
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(b"".join(item.data for item in batch))
+                self.batches += 1
+                self.records += len(batch)
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            finally:
+                for item in batch:
+                    item.done.set()
+
+    def _write(self, data: bytes):
+        parent = os.path.dirname(self.path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        with file_lock(self.path):
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                size = os.fstat(fd).st_size
+                if size and os.pread(fd, 1, size - 1) != b"\n":
+                    # linha incompleta deixada por uma escrita interrompida: não colar o novo registro nela
+                    data = b"\n" + data
+                view = memoryview(data)
+                while view:
+                    written = os.write(fd, view)
+                    view = view[written:]
+                if self.fsync:
+                    os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class HistoryCache:
+    """Parsed tail of a HistoryStore kept in memory, with derived views.
+
+    Holds the last `max_records` lines as (raw line, HistoryRecord or None) and refreshes
+    on access by comparing the log's (inode, size, mtime) with the last stat: unchanged
+    means no I/O at all, growth means reading only the appended bytes, anything else
+    (truncation, replacement) reloads the tail through the store's offset index. Derived
+    views (participants) are computed once per change, so the LLM node and every tool of
+    a turn share a single read of the history file.
+    """
+
+    def __init__(self, store: HistoryStore, max_records: int = 200):
+        self.store = store
+        self.max_records = max(1, int(max_records))
+        self._entries = deque(maxlen=self.max_records)
+        self._position = 0
+        self._stat_key = None
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def _load_tail(self):
+        lines, end = self.store.read_tail(self.max_records)
+        self._entries.clear()
+        self._entries.extend((line, parse_history_line(line)) for line in lines)
+        self._position = end
+
+    def _read_appended(self, size: int) -> bool:
+        with open(self.store.path, "rb") as log:
+            log.seek(self._position)
+            data = log.read(size - self._position)
+        # só linhas completas; uma escrita em andamento é lida na próxima vez
+        complete = data[:data.rfind(b"\n") + 1]
+        if not complete:
+            return False
+        for line in complete.decode("utf-8", errors="replace").splitlines():
+            self._entries.append((line, parse_history_line(line)))
+        self._position += len(complete)
+        return True
+
+    def refresh(self):
+        with self._lock:
+            try:
+                st = os.stat(self.store.path)
+            except FileNotFoundError:
+                if self._stat_key is not None or self._entries:
+                    self._entries.clear()
+                    self._position = 0
+                    self._stat_key = None
+                    self._views.clear()
+                return
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if key == self._stat_key:
+                return
+            same_file = self._stat_key is not None and self._stat_key[0] == st.st_ino
+            if same_file and st.st_size >= self._position:
+                changed = self._read_appended(st.st_size) if st.st_size > self._position else False
+            else:
+                self._load_tail()
+                changed = True
+            self._stat_key = key
+            if changed:
+                self._views.clear()
+
+    def _view(self, name, build):
+        self.refresh()
+        with self._lock:
+            if name not in self._views:
+                self._views[name] = build(list(self._entries))
+            return self._views[name]
+
+    def lines(self, n: int) -> List[str]:
+        """The last `n` raw lines (at most `max_records`)."""
+        if n <= 0:
+            return []
+        return [line for line, _ in self._view("entries", lambda entries: entries)[-n:]]
+
+    def records(self, n: int) -> List[HistoryRecord]:
+        """Parsed records among the last `n` lines; malformed lines are skipped."""
+        if n <= 0:
+            return []
+        return [record for _, record in self._view("entries", lambda entries: entries)[-n:] if record is not None]
+
+    def participants(self, max_messages: Optional[int] = None) -> List[str]:
+        """Distinct participants (in order of first appearance) among the last messages."""
+        max_messages = self.max_records if max_messages is None else max_messages
+
+        def build(entries):
+            participants, seen = [], set()
+            for _, record in entries[-max_messages:] if max_messages > 0 else []:
+                if record is None or record.role != "user":
+                    continue
+                user = record.user or "Usuário"
+                if user not in seen:
+                    seen.add(user)
+                    participants.append(user)
+            return participants
+
+        return list(self._view(("participants", max_messages), build))
+
+    def user_messages(self, n: int) -> List[str]:
+        """Contents of the user messages among the last `n` lines."""
+        return [record.content for record in self.records(n) if record.role == "user"]
+
+
+_HISTORY_STORES = {}
+_HISTORY_STORES_LOCK = threading.Lock()
+
+
+def get_history_store(path: str) -> HistoryStore:
+    """Process-wide HistoryStore for `path` (every session shares the same index and writer).
+
+    `RAG_HISTORY_FSYNC=0` skips the fsync of each batch (faster, but the last messages may
+    be lost on a power failure).
+    """
+    key = os.path.abspath(path)
+    with _HISTORY_STORES_LOCK:
+        store = _HISTORY_STORES.get(key)
+        if store is None:
+            fsync = os.environ.get("RAG_HISTORY_FSYNC", "1").strip().lower() not in ("0", "false", "no")
+            store = HistoryStore(key, fsync=fsync)
+            _HISTORY_STORES[key] = store
+        return store
@@ -0,0 +1,259 @@
+import os
+import atexit
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from pypdf import PdfReader
+
+# Módulo leve (sem torch/sentence-transformers): é importado pelos processos do pool
+# de ingestão, que só fazem parsing e chunking dos PDFs.
+
+def file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as fh:
+        for block in iter(lambda: fh.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_sha1(text: str) -> str:
+    return hashlib.sha1((text or "").strip().encode("utf-8")).hexdigest()
+
+
+def count_pdf_pages(file_path: str) -> int:
+    return len(PdfReader(file_path).pages)
+
+
+def iter_pdf_pages(
+    file_path: str,
+    source_name: Optional[str] = None,
+    file_hash: Optional[str] = None,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterator[Document]:
+    """Yield pages `start..end` (0-based, end exclusive) of a PDF one at a time.
+
+    Each page carries `source_file` (the provided `source_name`, so temporary upload
+    paths do not leak into metadata), a 1-based `page_number` and the file's `file_hash`.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"File not found: {file_path}")
+    reader = PdfReader(file_path)
+    basename = source_name or os.path.basename(file_path)
+    file_hash = file_hash or file_sha256(file_path)
+    total = len(reader.pages)
+    end = total if end is None else min(end, total)
+    for idx in range(start, end):
+        text = reader.pages[idx].extract_text() or ""
+        yield Document(
+            page_content=text,
+            metadata={
+                "source": file_path,
+                "page": idx,
+                "source_file": basename,
+                "page_number": idx + 1,
+                "file_hash": file_hash,
+            },
+        )
+
+
+def load_pdf_pages(file_path: str, source_name: Optional[str] = None, file_hash: Optional[str] = None):
+    """Load pages from a PDF and annotate each page's metadata with a stable source name.
+
+    If `source_name` is provided, it will be used for `source_file` in metadata. This
+    prevents temporary filenames from leaking into chunk metadata when files are
+    uploaded and written to temporary paths. The SHA-256 of the file is stored as
+    `file_hash` so the indexer can skip files that did not change. Prefer
+    `iter_pdf_pages` for large files.
+    """
+    return list(iter_pdf_pages(file_path, source_name=source_name, file_hash=file_hash))
+
+
+def make_chunk_id(source_file: str, page_number, text: str) -> str:
+    """Deterministic chunk ID derived from source, page and a hash of the chunk text."""
+    key = f"{source_file}\x1f{page_number}\x1f{text_sha1(text)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def iter_page_chunks(pages: Iterable[Document], chunk_size: int = 1000, chunk_overlap: int = 200) -> Iterator[Document]:
+    """Split pages lazily, one page at a time, keeping the page metadata on each chunk."""
+    # start_index (posição do chunk na página) permite unir trechos vizinhos na hora de montar o contexto
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=True)
+    # Split each page individually so that chunk metadata keeps the originating page metadata
+    for page in pages:
+        page_chunks = splitter.split_documents([page])
+        for ch in page_chunks:
+            # ensure chunk metadata contains source_file and page_number
+            try:
+                ch_meta = ch.metadata or {}
+            except Exception:
+                ch_meta = {}
+            # overlay page metadata (page metadata takes precedence)
+            page_meta = getattr(page, "metadata", {}) or {}
+            merged = {**ch_meta, **page_meta}
+            merged["chunk_hash"] = text_sha1(ch.page_content)
+            merged["chunk_id"] = make_chunk_id(merged.get("source_file", "unknown"), merged.get("page_number", "?"), ch.page_content)
+            ch.metadata = merged
+            yield ch
+
+
+def split_pages_into_chunks(pages, chunk_size: int = 1000, chunk_overlap: int = 200):
+    return list(iter_page_chunks(pages, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+
+
+def iter_batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def parse_and_chunk_page_range(file_path: str, source_name: str, file_hash: str, start: int, end: int):
+    """Worker: parse pages `start..end` of one PDF and return their chunks.
+
+    Runs inside the ingestion process pool; chunks keep `source_file`/`page_number`
+    metadata and their deterministic `chunk_id`.
+    """
+    pages = iter_pdf_pages(file_path, source_name=source_name, file_hash=file_hash, start=start, end=end)
+    return list(iter_page_chunks(pages))
+
+
+_PARSE_POOL = None
+_PARSE_POOL_WORKERS = 0
+_PARSE_POOL_LOCK = threading.Lock()
+
+
+def _shutdown_parse_pool():
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is not None:
+            _PARSE_POOL.shutdown(wait=False, cancel_futures=True)
+            _PARSE_POOL = None
+
+
+atexit.register(_shutdown_parse_pool)
+
+
+def get_parse_pool(max_workers: int) -> ProcessPoolExecutor:
+    """Process-wide pool that parses and chunks PDF page ranges, created on first use.
+
+    Workers come from a forkserver that preloads only this module (spawn where
+    forkserver is unavailable), never from a fork of the caller: the Streamlit process
+    is multithreaded and has torch/tokenizers loaded. multiprocessing still imports the
+    caller's main script once in each new worker, so that script must keep its work
+    under `if __name__ == "__main__":` (agent_rag.py, app.py and the benchmarks do);
+    the pool is long-lived, so this happens once per worker, not once per upload.
+    """
+    global _PARSE_POOL, _PARSE_POOL_WORKERS
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is None or _PARSE_POOL_WORKERS != max_workers:
+            if _PARSE_POOL is not None:
+                _PARSE_POOL.shutdown(wait=False)
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["ingestion"])
+            else:
+                context = multiprocessing.get_context("spawn")
+            _PARSE_POOL = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+            _PARSE_POOL_WORKERS = max_workers
+        return _PARSE_POOL
+
+
+def _discard_parse_pool(pool: ProcessPoolExecutor):
+    global _PARSE_POOL
+    with _PARSE_POOL_LOCK:
+        if _PARSE_POOL is pool:
+            _PARSE_POOL = None
+    pool.shutdown(wait=False)
+
+
+def iter_chunk_stream(
+    files: Sequence[Tuple[str, str, str]],
+    max_workers: Optional[int] = None,
+    pages_per_task: Optional[int] = None,
+) -> Iterator[tuple]:
+    """Stream the chunks of `files` = [(path, source_name, file_hash), ...] in file/page order.
+
+    Each file is cut into page ranges parsed/chunked by the shared process pool
+    (`get_parse_pool`, `max_workers` processes). At most
+    `2 * max_workers` ranges are in flight, so a slow consumer (embedding) applies
+    backpressure and memory stays bounded regardless of document size, while the
+    pool keeps parsing ahead of the consumer.
+
+    Yields `("chunks", source, file_hash, chunks, pages_done, pages_total)` per range
+    and `("file_done", source, file_hash, None, pages_total, pages_total)` after the
+    last range of each file.
+    """
+    if max_workers is None:
+        max_workers = int(os.environ.get("RAG_INGEST_WORKERS", "0")) or (os.cpu_count() or 1)
+    if pages_per_task is None:
+        pages_per_task = int(os.environ.get("RAG_INGEST_PAGES_PER_TASK", "8"))
+    pages_per_task = max(1, pages_per_task)
+
+    tasks = []
+    for path, source, file_hash in files:
+        total = count_pdf_pages(path)
+        ranges = [(s, min(s + pages_per_task, total)) for s in range(0, total, pages_per_task)]
+        for i, (start, end) in enumerate(ranges):
+            tasks.append((path, source, file_hash, start, end, total, i == len(ranges) - 1))
+        if not ranges:
+            tasks.append((path, source, file_hash, 0, 0, 0, True))
+    if not tasks:
+        return
+
+    max_workers = max(1, max_workers)
+
+    def _events(task, chunks):
+        _, source, file_hash, _, end, total, last = task
+        yield ("chunks", source, file_hash, chunks, end, total)
+        if last:
+            yield ("file_done", source, file_hash, None, total, total)
+
+    if max_workers == 1 or len(tasks) == 1:
+        for task in tasks:
+            path, source, file_hash, start, end = task[:5]
+            chunks = parse_and_chunk_page_range(path, source, file_hash, start, end) if end > start else []
+            yield from _events(task, chunks)
+        return
+
+    pool = get_parse_pool(max_workers)
+    in_flight = deque()
+    pending = iter(tasks)
+    window = 2 * min(max_workers, len(tasks))
+
+    def _submit_next():
+        task = next(pending, None)
+        if task is None:
+            return False
+        path, source, file_hash, start, end = task[:5]
+        in_flight.append((task, pool.submit(parse_and_chunk_page_range, path, source, file_hash, start, end)))
+        return True
+
+    try:
+        while len(in_flight) < window and _submit_next():
+            pass
+        while in_flight:
+            task, fut = in_flight.popleft()
+            try:
+                chunks = fut.result()
+            except BrokenProcessPool:
+                # um worker morreu: o próximo upload cria um pool novo
+                _discard_parse_pool(pool)
+                raise
+            _submit_next()
+            yield from _events(task, chunks)
+    finally:
+        # consumidor parou antes do fim (erro, upload cancelado): liberar o pool compartilhado
+        for _, fut in in_flight:
+            fut.cancel()
@@ -0,0 +1,187 @@
+import os
+import re
+import json
+import math
+import heapq
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+
+_TOKEN_RE = re.compile(r"\w+", flags=re.UNICODE)
+
+
+def fold_accents(text: str) -> str:
+    """Lowercase `text` and strip its diacritics ("Conclusões" -> "conclusoes")."""
+    folded = unicodedata.normalize("NFKD", (text or "").lower())
+    return "".join(c for c in folded if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, accent-folded word tokens (keeps acronyms, numbers and names intact)."""
+    return [t for t in _TOKEN_RE.findall(fold_accents(text)) if len(t) > 1 or t.isdigit()]
+
+
+class BM25Index:
+    """Persistent BM25 inverted index of the chunks of one collection.
+
+    Stored in SQLite next to the Chroma collection (`lexical_<collection>.sqlite`):
+    `chunks` keeps each chunk's text/metadata and length, `postings` maps
+    term -> (chunk_id, tf). Chunks are added/removed incrementally by the indexer, and
+    IDF/average length are computed at query time, so there is no rebuild step.
+    """
+
+    def __init__(self, db_path: str, k1: float = 1.5, b: float = 0.75):
+        self.db_path = db_path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            " chunk_id TEXT PRIMARY KEY, source_file TEXT, length INTEGER NOT NULL,"
+            " content TEXT NOT NULL, metadata TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source_file)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            " term TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL,"
+            " PRIMARY KEY (term, chunk_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def missing_ids(self, chunk_ids: Iterable[str]) -> set:
+        chunk_ids = list(chunk_ids)
+        present = set()
+        with self._lock:
+            for start in range(0, len(chunk_ids), 500):
+                block = chunk_ids[start:start + 500]
+                marks = ",".join("?" * len(block))
+                present.update(r[0] for r in self._conn.execute(f"SELECT chunk_id FROM chunks WHERE chunk_id IN ({marks})", block))
+        return set(chunk_ids) - present
+
+    def add_documents(self, documents: Iterable[Document], ids: Iterable[str]):
+        rows, postings = [], []
+        for doc, chunk_id in zip(documents, ids):
+            meta = dict(getattr(doc, "metadata", {}) or {})
+            tokens = tokenize(doc.page_content)
+            rows.append((chunk_id, meta.get("source_file"), len(tokens), doc.page_content, json.dumps(meta, ensure_ascii=False, default=str)))
+            postings.extend((term, chunk_id, tf) for term, tf in Counter(tokens).items())
+        if not rows:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                # substituição: remove postings antigos de chunks reindexados
+                self._conn.executemany("DELETE FROM postings WHERE chunk_id = ?", [(r[0],) for r in rows])
+                self._conn.executemany("INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?, ?)", rows)
+                self._conn.executemany("INSERT OR REPLACE INTO postings VALUES (?, ?, ?)", postings)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def delete(self, ids: Iterable[str]):
+        ids = [(i,) for i in ids]
+        if not ids:
+            return
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany("DELETE FROM postings WHERE chunk_id = ?", ids)
+                self._conn.executemany("DELETE FROM chunks WHERE chunk_id = ?", ids)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def document_frequencies(self, terms: Iterable[str]) -> Tuple[int, dict]:
+        """(number of chunks, {term: number of chunks containing it}) for tokenized `terms`."""
+        terms = list(dict.fromkeys(terms))
+        with self._lock:
+            n_docs = self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            df = dict.fromkeys(terms, 0)
+            # em lotes, abaixo do limite de parâmetros do SQLite
+            for i in range(0, len(terms), 500):
+                batch = terms[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                for term, count in self._conn.execute(
+                    f"SELECT term, COUNT(*) FROM postings WHERE term IN ({marks}) GROUP BY term", batch
+                ):
+                    df[term] = count
+        return n_docs, df
+
+    def search(self, query: str, k: int = 10, source_file: Optional[str] = None) -> List[Tuple[Document, float]]:
+        """Return the top-k (Document, BM25 score) for `query`, optionally within one source file."""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or k <= 0:
+            return []
+        scores = Counter()
+        with self._lock:
+            n_docs, avgdl = self._conn.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+            if not n_docs:
+                return []
+            avgdl = avgdl or 1.0
+            for term in terms:
+                df = self._conn.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0]
+                if not df:
+                    continue
+                idf = math.log(1.0 + (n_docs - df + 0.5) / (df + 0.5))
+                sql = "SELECT p.chunk_id, p.tf, c.length FROM postings p JOIN chunks c ON c.chunk_id = p.chunk_id WHERE p.term = ?"
+                params = [term]
+                if source_file:
+                    sql += " AND c.source_file = ?"
+                    params.append(source_file)
+                for chunk_id, tf, length in self._conn.execute(sql, params):
+                    denom = tf + self.k1 * (1 - self.b + self.b * length / avgdl)
+                    scores[chunk_id] += idf * tf * (self.k1 + 1) / denom
+            top = heapq.nlargest(k, scores.items(), key=lambda kv: kv[1])
+            if not top:
+                return []
+            marks = ",".join("?" * len(top))
+            stored = {
+                r[0]: (r[1], r[2])
+                for r in self._conn.execute(f"SELECT chunk_id, content, metadata FROM chunks WHERE chunk_id IN ({marks})", [c for c, _ in top])
+            }
+        results = []
+        for chunk_id, score in top:
+            content, meta = stored[chunk_id]
+            results.append((Document(page_content=content, metadata=json.loads(meta)), float(score)))
+        return results
+
+    def sync_from_vectorstore(self, vectorstore, batch_size: int = 500):
+        """Fill the index from an existing Chroma collection (indexes created before BM25)."""
+        offset = 0
+        while True:
+            got = vectorstore.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            ids = got.get("ids") or []
+            if not ids:
+                break
+            docs = [Document(page_content=text or "", metadata=meta or {}) for text, meta in zip(got["documents"], got["metadatas"])]
+            self.add_documents(docs, ids)
+            offset += len(ids)
+
+
+_LEXICAL_REGISTRY: dict = {}
+_LEXICAL_REGISTRY_LOCK = threading.Lock()
+
+
+def get_lexical_index(persist_directory: str, collection_name: str = "book") -> BM25Index:
+    """Process-wide BM25 index stored next to the collection in `persist_directory`."""
+    os.makedirs(persist_directory, exist_ok=True)
+    path = os.path.abspath(os.path.join(persist_directory, f"lexical_{collection_name}.sqlite"))
+    with _LEXICAL_REGISTRY_LOCK:
+        index = _LEXICAL_REGISTRY.get(path)
+        if index is None:
+            index = BM25Index(path)
+            _LEXICAL_REGISTRY[path] = index
+        return index
@@ -0,0 +1,271 @@
+import os
+import re
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Optional, Sequence
+
+import numpy as np
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+
+
+def _normalize(text) -> str:
+    if not isinstance(text, str):
+        text = json.dumps(text, ensure_ascii=False, sort_keys=True, default=str)
+    return " ".join(text.split())
+
+
+def normalize_question(text: str) -> str:
+    """Case/whitespace-insensitive form of a user question (key of the semantic entries)."""
+    return _normalize(text).lower()
+
+
+_SIGNATURE_RE = re.compile(r"[\w-]+\.(?:pdf|txt|md|docx?)\b|\d+", flags=re.IGNORECASE)
+
+
+def question_signature(text: str) -> frozenset:
+    """Numbers and file names mentioned in a question.
+
+    Embeddings barely tell "metodologia do artigo 2" from "... do artigo 3", so a
+    semantic match is only accepted when both questions mention the same ones.
+    """
+    return frozenset(m.lower() for m in _SIGNATURE_RE.findall(text or ""))
+
+
+def messages_fingerprint(messages: Sequence[BaseMessage], namespace: str = "") -> str:
+    """Hash of a prompt: message types, normalized contents, tool calls and tool outputs.
+
+    Message and tool-call ids are left out, so the same conversation with the same tool
+    results hits the same entry on every turn.
+    """
+    h = hashlib.sha256(namespace.encode("utf-8"))
+    for msg in messages:
+        parts = [msg.type, _normalize(msg.content)]
+        for call in getattr(msg, "tool_calls", None) or []:
+            parts.append(f"call:{call.get('name')}:{json.dumps(call.get('args'), ensure_ascii=False, sort_keys=True, default=str)}")
+        if msg.type == "tool":
+            parts.append(f"tool:{getattr(msg, 'name', '')}")
+        h.update("\x1f".join(parts).encode("utf-8"))
+        h.update(b"\x1e")
+    return h.hexdigest()
+
+
+class LLMResponseCache:
+    """Persistent cache of LLM responses, with exact and semantic lookups.
+
+    Stored in SQLite (WAL, shared by every session/process):
+    - `responses`: exact entries, keyed by `messages_fingerprint` of the whole prompt
+      (system prompt, history, question, tool calls and tool outputs);
+    - `questions`: final answers keyed by the user question, with its embedding, for the
+      optional semantic lookup (cosine >= `semantic_threshold`, off by default). A
+      semantic match must mention the same numbers and file names as the question
+      (`question_signature`). Callers put the conversation context in `namespace`, so
+      a question is only answered from entries stored under the same context.
+
+    Every entry records the index generation it was produced under and lookups only
+    match the current generation, so answers computed before new PDFs were indexed are
+    never served. Entries expire after `ttl` seconds and the least recently used ones are
+    evicted above `max_entries` per table.
+    """
+
+    def __init__(self, db_path: str, max_entries: int = 2000, ttl: Optional[float] = 7 * 24 * 3600, semantic_threshold: Optional[float] = None):
+        self.db_path = db_path
+        self.max_entries = max(1, int(max_entries))
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._vectors = {}
+        self._writes = 0
+        parent = os.path.dirname(db_path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY, generation INTEGER NOT NULL, message TEXT NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses (last_access)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS questions ("
+            " namespace TEXT NOT NULL, generation INTEGER NOT NULL, question TEXT NOT NULL,"
+            " vector BLOB, message TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL,"
+            " PRIMARY KEY (namespace, generation, question))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS questions_lru ON questions (last_access)")
+
+    def _fresh_after(self) -> float:
+        return time.time() - self.ttl if self.ttl else 0.0
+
+    # ------------------------------------------------------------------ lookups
+    def lookup(self, key: str, generation: int, namespace: str = "", question: Optional[str] = None, vector: Optional[np.ndarray] = None) -> Optional[BaseMessage]:
+        """Cached response for a prompt, or None.
+
+        Tries the exact prompt `key` first; if `question` is given, then the final answer
+        stored for the same normalized question and, with `vector`, for the most similar
+        question above `semantic_threshold`. Counts one hit or miss per call.
+        """
+        with self._lock:
+            payload = self._exact(key, generation)
+            semantic = False
+            if payload is None and question:
+                payload, semantic = self._answer(namespace, generation, question, vector)
+            if payload is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.semantic_hits += int(semantic)
+        return messages_from_dict([json.loads(payload)])[0]
+
+    def _exact(self, key: str, generation: int) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT message FROM responses WHERE key = ? AND generation = ? AND created_at >= ?",
+            (key, generation, self._fresh_after()),
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def _answer(self, namespace: str, generation: int, question: str, vector: Optional[np.ndarray]):
+        normalized = normalize_question(question)
+        semantic = False
+        row = self._conn.execute(
+            "SELECT message FROM questions WHERE namespace = ? AND generation = ? AND question = ? AND created_at >= ?",
+            (namespace, generation, normalized, self._fresh_after()),
+        ).fetchone()
+        if row is None and vector is not None and self.semantic_threshold:
+            questions, matrix = self._question_matrix(namespace, generation)
+            vector = np.asarray(vector, dtype=np.float32)
+            if matrix is not None and matrix.shape[1] == vector.shape[-1]:
+                scores = matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+                signature = question_signature(normalized)
+                # "artigo 2" e "artigo 3" ficam próximos no embedding: só perguntas com os
+                # mesmos números e nomes de arquivo podem ser reaproveitadas
+                scores = np.where([question_signature(q) == signature for q in questions], scores, -np.inf)
+                best = int(np.argmax(scores))
+                if scores[best] >= self.semantic_threshold:
+                    normalized = questions[best]
+                    row = self._conn.execute(
+                        "SELECT message FROM questions WHERE namespace = ? AND generation = ? AND question = ?",
+                        (namespace, generation, normalized),
+                    ).fetchone()
+                    semantic = row is not None
+        if row is None:
+            return None, False
+        self._conn.execute(
+            "UPDATE questions SET last_access = ? WHERE namespace = ? AND generation = ? AND question = ?",
+            (time.time(), namespace, generation, normalized),
+        )
+        return row[0], semantic
+
+    def _question_matrix(self, namespace: str, generation: int):
+        """(questions, normalized vectors) of a namespace/generation, reloaded only after writes."""
+        version = (self._conn.execute("PRAGMA data_version").fetchone()[0], self._writes)
+        cached = self._vectors.get((namespace, generation))
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+        rows = self._conn.execute(
+            "SELECT question, vector FROM questions WHERE namespace = ? AND generation = ? AND vector IS NOT NULL AND created_at >= ?",
+            (namespace, generation, self._fresh_after()),
+        ).fetchall()
+        questions = [q for q, _ in rows]
+        matrix = np.stack([np.frombuffer(v, dtype=np.float32) for _, v in rows]) if rows else None
+        # só a geração atual interessa: as anteriores nunca mais são consultadas
+        self._vectors = {(namespace, generation): (version, questions, matrix)}
+        return questions, matrix
+
+    # ------------------------------------------------------------------ writes
+    def store(self, key: str, generation: int, message: BaseMessage, namespace: str = "", question: Optional[str] = None, vector: Optional[np.ndarray] = None):
+        """Cache `message` for the prompt `key`; with `question`, also as that question's final answer."""
+        now = time.time()
+        payload = json.dumps(message_to_dict(message), ensure_ascii=False, default=str)
+        blob = None
+        if question and vector is not None:
+            vector = np.asarray(vector, dtype=np.float32)
+            blob = (vector / (np.linalg.norm(vector) or 1.0)).astype(np.float32).tobytes()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, generation, message, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                    (key, generation, payload, now, now),
+                )
+                if question:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO questions (namespace, generation, question, vector, message, created_at, last_access)"
+                        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (namespace, generation, normalize_question(question), blob, payload, now, now),
+                    )
+                self._evict("responses")
+                self._evict("questions")
+                self._conn.execute("COMMIT")
+                self._writes += 1
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # ------------------------------------------------------------------ housekeeping
+    def _evict(self, table: str):
+        """Drop expired entries, then the least recently used ones above `max_entries`."""
+        if self.ttl:
+            self._conn.execute(f"DELETE FROM {table} WHERE created_at < ?", (self._fresh_after(),))
+        count = self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self._conn.execute(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY last_access ASC LIMIT ?)",
+                (excess,),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            responses = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            questions = self._conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+        total = self.hits + self.misses
+        return {
+            "responses": responses,
+            "questions": questions,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_LLM_CACHES: dict = {}
+_LLM_CACHES_LOCK = threading.Lock()
+
+
+def get_llm_response_cache(persist_directory: str) -> Optional[LLMResponseCache]:
+    """Process-wide response cache stored in `persist_directory/llm_cache.sqlite`, or None if disabled.
+
+    `RAG_LLM_CACHE=off` disables it; `RAG_LLM_CACHE_SIZE` (entries, default 2000),
+    `RAG_LLM_CACHE_TTL` (seconds, default 7 days) and `RAG_LLM_CACHE_SEMANTIC_THRESHOLD`
+    (cosine, e.g. 0.95; default 0, semantic lookup off) tune it.
+    """
+    if os.environ.get("RAG_LLM_CACHE", "on").strip().lower() in ("0", "off", "false", "no"):
+        return None
+    path = os.path.abspath(os.path.join(persist_directory, "llm_cache.sqlite"))
+    with _LLM_CACHES_LOCK:
+        cache = _LLM_CACHES.get(path)
+        if cache is None:
+            ttl = float(os.environ.get("RAG_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+            cache = LLMResponseCache(
+                path,
+                max_entries=int(os.environ.get("RAG_LLM_CACHE_SIZE", "2000")),
+                ttl=ttl if ttl > 0 else None,
+                semantic_threshold=float(os.environ.get("RAG_LLM_CACHE_SEMANTIC_THRESHOLD", "0")) or None,
+            )
+            _LLM_CACHES[path] = cache
+        return cache
@@ -0,0 +1,494 @@
+import os
+import json
+import threading
+import uuid
+from typing import Any, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from file_locks import file_lock
+
+
+def _encode_texts(embedding, texts: Sequence[str]) -> np.ndarray:
+    # caminho NumPy quando disponível (SentenceTransformerEmbeddings.encode), listas caso contrário
+    if hasattr(embedding, "encode"):
+        return np.ascontiguousarray(embedding.encode(list(texts)), dtype=np.float32)
+    return np.asarray(embedding.embed_documents(list(texts)), dtype=np.float32)
+
+
+def _encode_query(embedding, text: str) -> np.ndarray:
+    if hasattr(embedding, "embed_query_array"):
+        vector = embedding.embed_query_array(text)
+    else:
+        vector = embedding.embed_query(text)
+    return np.asarray(vector, dtype=np.float32)
+
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class NumpyVectorStore(VectorStore):
+    """Exact in-process vector store for small corpora (a few thousand chunks).
+
+    Layout of `<persist_directory>/numpy_<collection_name>/`:
+    - `manifest.json`: current generation and dimension;
+    - `vectors.<gen>.f32`: L2-normalized float32 rows, opened with `np.memmap`;
+    - `rows.<gen>.jsonl`: append-only log, one line per added row (id, text, metadata;
+      a repeated id replaces the previous row) or per delete (`{"delete": [ids]}`).
+
+    Writes append only the new vectors and log lines, under the store's advisory lock,
+    so batched ingestion does O(batch) I/O and instances in other threads or processes
+    pick up just the appended lines on their next call (readers refresh under a shared
+    lock). Vectors are written first and a row exists only once its log line is
+    complete, so an interrupted write leaves no misaligned rows.
+
+    Top-k is a single matrix-vector product plus `argpartition` (cosine similarity, since
+    rows and queries are normalized); `similarity_search_by_vectors` answers a batch of
+    queries with one matrix-matrix product. Deletes only mark rows inactive; when more
+    than a quarter are, both files are rewritten as the next generation and swapped in
+    together by replacing `manifest.json`. Exposes the subset of Chroma's `get`/`delete`
+    API used by the indexer.
+
+    `quantization` ("int8" with a per-dimension scale, or "float16") keeps only a
+    compressed copy of the matrix in memory and searches on it; the float32 file stays
+    on disk. With `rescore`, the best `rescore_factor * k` candidates are re-scored
+    exactly against their float32 rows (read from the memmap), which keeps recall close
+    to the float path. The compressed copy is rebuilt from the float32 file on load.
+    """
+
+    QUANTIZATION_MODES = (None, "int8", "float16")
+
+    def __init__(
+        self,
+        embedding_function: Embeddings,
+        persist_directory: str = "./vdb",
+        collection_name: str = "book",
+        quantization: Optional[str] = None,
+        rescore: bool = True,
+        rescore_factor: int = 4,
+    ):
+        if quantization not in self.QUANTIZATION_MODES:
+            raise ValueError(f"Unknown quantization '{quantization}'. Available: int8, float16")
+        self._embedding = embedding_function
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.quantization = quantization
+        self.rescore = rescore
+        self.rescore_factor = max(1, int(rescore_factor))
+        self._q_matrix = None
+        self._q_scale = None
+        self.path = os.path.join(persist_directory, f"numpy_{collection_name}")
+        os.makedirs(self.path, exist_ok=True)
+        self._manifest_path = os.path.join(self.path, "manifest.json")
+        self._lock = threading.RLock()
+        self._generation = 0
+        self._manifest_stamp = None
+        self._log_offset = 0
+        self._vectors_path = self._generation_path("vectors", 0)
+        self._rows_path = self._generation_path("rows", 0)
+        if not os.path.exists(self._manifest_path) and os.path.exists(os.path.join(self.path, "rows.json")):
+            with file_lock(self._manifest_path):
+                self._migrate_legacy()
+        with self._lock, file_lock(self._manifest_path, shared=True):
+            self._load()
+
+    # ------------------------------------------------------------------ storage
+
+    def _generation_path(self, kind: str, generation: int) -> str:
+        return os.path.join(self.path, f"{kind}.{generation}.{'f32' if kind == 'vectors' else 'jsonl'}")
+
+    def _stat_manifest(self):
+        try:
+            st = os.stat(self._manifest_path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except OSError:
+            return None
+
+    def _log_size(self) -> int:
+        try:
+            return os.path.getsize(self._rows_path)
+        except OSError:
+            return 0
+
+    def _write_manifest(self, generation: int):
+        # nome temporário único: outra instância pode estar gravando ao mesmo tempo
+        tmp_path = f"{self._manifest_path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump({"generation": generation, "dim": self.dim}, fh)
+        os.replace(tmp_path, self._manifest_path)
+
+    def _load(self):
+        """Full load of the current generation (caller holds the file lock)."""
+        manifest = {}
+        if os.path.exists(self._manifest_path):
+            with open(self._manifest_path, "r", encoding="utf-8") as fh:
+                manifest = json.load(fh)
+        self._manifest_stamp = self._stat_manifest()
+        self._generation = int(manifest.get("generation") or 0)
+        self.dim = int(manifest.get("dim") or 0)
+        self._vectors_path = self._generation_path("vectors", self._generation)
+        self._rows_path = self._generation_path("rows", self._generation)
+        self._ids, self._texts, self._metadatas = [], [], []
+        self._active = np.zeros(0, dtype=bool)
+        self._id_to_row = {}
+        self._sources = np.empty(0, dtype=object)
+        self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._q_matrix = None
+        self._log_offset = 0
+        self._read_log_tail()
+        self._build_quantized()
+
+    def _read_log_tail(self):
+        """Apply the complete log lines appended since the last read (caller holds the file lock)."""
+        try:
+            with open(self._rows_path, "rb") as fh:
+                fh.seek(self._log_offset)
+                data = fh.read()
+        except FileNotFoundError:
+            return
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return
+        first_new = len(self._ids)
+        deactivated = []
+        for line in data[:end].split(b"\n"):
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if "delete" in entry:
+                deactivated.extend(self._id_to_row.pop(rid) for rid in entry["delete"] if rid in self._id_to_row)
+                continue
+            rid = entry["id"]
+            if rid in self._id_to_row:
+                # upsert: a linha antiga do mesmo id deixa de valer
+                deactivated.append(self._id_to_row[rid])
+            self._id_to_row[rid] = len(self._ids)
+            self._ids.append(rid)
+            self._texts.append(entry["text"])
+            self._metadatas.append(entry.get("metadata") or {})
+        self._log_offset += end
+        added = len(self._ids) - first_new
+        if added:
+            self._active = np.concatenate([self._active, np.ones(added, dtype=bool)])
+            self._sources = np.concatenate([self._sources, np.array([m.get("source_file") for m in self._metadatas[first_new:]], dtype=object)])
+        if deactivated:
+            self._active[deactivated] = False
+        if added:
+            self._remap()
+            if self._q_matrix is not None:
+                self._append_quantized(np.asarray(self._matrix[first_new:], dtype=np.float32))
+
+    def _refresh(self):
+        """Catch up with other writers (caller holds the file lock)."""
+        if self._stat_manifest() != self._manifest_stamp:
+            # compactação (nova geração) ou primeira escrita: recarregar tudo
+            self._load()
+        elif self._log_size() != self._log_offset:
+            self._read_log_tail()
+
+    def _maybe_reload(self):
+        # outra instância (thread ou processo) pode ter gravado na coleção
+        if self._stat_manifest() != self._manifest_stamp or self._log_size() != self._log_offset:
+            with file_lock(self._manifest_path, shared=True):
+                self._refresh()
+
+    def _append_log(self, entries: List[dict]):
+        """Append `entries` to the row log, dropping a partial line left by an interrupted write."""
+        payload = "".join(json.dumps(e, ensure_ascii=False, default=str) + "\n" for e in entries).encode("utf-8")
+        mode = "r+b" if os.path.exists(self._rows_path) else "wb"
+        with open(self._rows_path, mode) as fh:
+            fh.truncate(self._log_offset)
+            fh.seek(self._log_offset)
+            fh.write(payload)
+
+    def _write_vectors(self, start: int, vectors: np.ndarray):
+        """Write `vectors` as rows `start...` of the vectors file, dropping anything past `start` first.
+
+        Rows are placed by offset rather than appended, so bytes left by a failed or
+        interrupted write never shift the matrix out of step with the row log.
+        """
+        mode = "r+b" if os.path.exists(self._vectors_path) else "wb"
+        with open(self._vectors_path, mode) as fh:
+            offset = start * self.dim * np.dtype(np.float32).itemsize
+            fh.truncate(offset)
+            fh.seek(offset)
+            fh.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+
+    def _remap(self):
+        n = len(self._ids)
+        if n and self.dim:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(n, self.dim))
+        else:
+            self._matrix = np.empty((0, self.dim), dtype=np.float32)
+
+    def _migrate_legacy(self):
+        """Convert a `rows.json` + `vectors.f32` collection to the log layout (caller holds the lock)."""
+        legacy_rows = os.path.join(self.path, "rows.json")
+        if os.path.exists(self._manifest_path) or not os.path.exists(legacy_rows):
+            return
+        with open(legacy_rows, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        rows = data.get("rows") or []
+        self.dim = int(data.get("dim") or 0)
+        active_ids = {r["id"] for r in rows if r.get("active", True)}
+        entries = [{"id": r["id"], "text": r["text"], "metadata": r.get("metadata") or {}} for r in rows]
+        dropped = sorted({r["id"] for r in rows} - active_ids)
+        if dropped:
+            entries.append({"delete": dropped})
+        self._log_offset = 0
+        self._rows_path = self._generation_path("rows", 0)
+        self._append_log(entries)
+        legacy_vectors = os.path.join(self.path, "vectors.f32")
+        if os.path.exists(legacy_vectors):
+            os.replace(legacy_vectors, self._generation_path("vectors", 0))
+        self._write_manifest(0)
+        os.remove(legacy_rows)
+
+    # ------------------------------------------------------------- quantization
+
+    _BLOCK_ROWS = 4096
+
+    def _iter_float_blocks(self, start: int = 0):
+        """Read `vectors.f32` sequentially in blocks (does not map the whole file into memory)."""
+        n = len(self._ids)
+        with open(self._vectors_path, "rb") as fh:
+            fh.seek(start * self.dim * 4)
+            for block_start in range(start, n, self._BLOCK_ROWS):
+                rows = min(self._BLOCK_ROWS, n - block_start)
+                yield block_start, np.fromfile(fh, dtype=np.float32, count=rows * self.dim).reshape(rows, self.dim)
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.quantization == "float16":
+            return vectors.astype(np.float16)
+        return np.clip(np.rint(vectors / self._q_scale), -127, 127).astype(np.int8)
+
+    def _build_quantized(self):
+        if self.quantization is None:
+            self._q_matrix = None
+            return
+        n = len(self._ids)
+        dtype = np.float16 if self.quantization == "float16" else np.int8
+        if not n or not self.dim:
+            self._q_matrix = np.empty((0, self.dim), dtype=dtype)
+            self._q_scale = np.ones(self.dim, dtype=np.float32)
+            return
+        if self.quantization == "int8":
+            max_abs = np.zeros(self.dim, dtype=np.float32)
+            for _, block in self._iter_float_blocks():
+                np.maximum(max_abs, np.abs(block).max(axis=0), out=max_abs)
+            max_abs[max_abs == 0] = 1.0
+            self._q_scale = (max_abs / 127.0).astype(np.float32)
+        q_matrix = np.empty((n, self.dim), dtype=dtype)
+        for start, block in self._iter_float_blocks():
+            q_matrix[start:start + len(block)] = self._quantize(block)
+        self._q_matrix = q_matrix
+
+    def _append_quantized(self, vectors: np.ndarray):
+        if self.quantization is None:
+            return
+        if self._q_matrix is None or not len(self._q_matrix):
+            self._build_quantized()
+            return
+        if self.quantization == "int8" and np.any(np.abs(vectors) > self._q_scale * 127.0):
+            # novos vetores fora da escala atual: requantizar tudo com a nova escala
+            self._build_quantized()
+            return
+        self._q_matrix = np.concatenate([self._q_matrix, self._quantize(vectors)])
+
+    def _approx_scores(self, queries: np.ndarray) -> np.ndarray:
+        """Scores against the compressed matrix, decompressing one block of rows at a time."""
+        n = len(self._q_matrix)
+        scores = np.empty((len(queries), n), dtype=np.float32)
+        scaled = queries * self._q_scale if self.quantization == "int8" else queries
+        for start in range(0, n, self._BLOCK_ROWS):
+            block = self._q_matrix[start:start + self._BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = scaled @ block.T
+        return scores
+
+    def memory_footprint(self) -> dict:
+        """Bytes held in memory for search vs. what the float32 matrix would take."""
+        n = int(self._active.size)
+        float_bytes = n * self.dim * 4
+        if self.quantization is None:
+            search_bytes = float_bytes
+        else:
+            search_bytes = int(self._q_matrix.nbytes) + (int(self._q_scale.nbytes) if self._q_scale is not None else 0)
+        return {"rows": n, "dim": self.dim, "quantization": self.quantization or "float32", "search_bytes": search_bytes, "float32_bytes": float_bytes}
+
+    def _compact(self):
+        """Rewrite the active rows as the next generation and swap it in (caller holds the file lock).
+
+        Both new files are complete before `manifest.json` points at them, so readers
+        see either the old generation or the new one, never a mix.
+        """
+        keep = np.flatnonzero(self._active)
+        generation = self._generation + 1
+        vectors_path = self._generation_path("vectors", generation)
+        rows_path = self._generation_path("rows", generation)
+        for path, write in (
+            (vectors_path, lambda fh: np.ascontiguousarray(self._matrix[keep], dtype=np.float32).tofile(fh)),
+            (rows_path, lambda fh: fh.write("".join(
+                json.dumps({"id": self._ids[i], "text": self._texts[i], "metadata": self._metadatas[i]}, ensure_ascii=False, default=str) + "\n"
+                for i in keep
+            ).encode("utf-8"))),
+        ):
+            tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as fh:
+                write(fh)
+            os.replace(tmp_path, path)
+        old_paths = (self._vectors_path, self._rows_path)
+        self._matrix = np.empty((0, self.dim), dtype=np.float32)
+        self._write_manifest(generation)
+        for path in old_paths:
+            # leitores com memmap aberto continuam com o inode antigo até recarregar
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._load()
+
+    # ---------------------------------------------------------- VectorStore API
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in texts]
+        ids = list(ids) if ids is not None else [str(uuid.uuid4()) for _ in texts]
+        vectors = _normalize_rows(_encode_texts(self._embedding, texts)).astype(np.float32)
+        # o lock de arquivo cobre recarga, escrita dos vetores e do log: outras instâncias
+        # (threads, sessões, processos) gravando a mesma coleção esperam
+        with self._lock, file_lock(self._manifest_path):
+            self._refresh()
+            if not self.dim:
+                self.dim = int(vectors.shape[1])
+                self._write_manifest(self._generation)
+                self._manifest_stamp = self._stat_manifest()
+            # vetores primeiro: uma linha só passa a existir quando a entrada do log está completa
+            self._write_vectors(len(self._ids), vectors)
+            self._append_log([
+                {"id": rid, "text": text, "metadata": dict(meta or {})}
+                for rid, text, meta in zip(ids, texts, metadatas)
+            ])
+            self._read_log_tail()
+        return ids
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        if not ids:
+            return False
+        with self._lock, file_lock(self._manifest_path):
+            self._refresh()
+            if not any(rid in self._id_to_row for rid in ids):
+                return True
+            self._append_log([{"delete": list(ids)}])
+            self._read_log_tail()
+            if len(self._active) and (~self._active).sum() > len(self._active) // 4:
+                self._compact()
+        return True
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[dict] = None, limit: Optional[int] = None, offset: int = 0, include: Sequence[str] = ("documents", "metadatas")) -> dict:
+        """Chroma-compatible `get` over the active rows (equality filters only)."""
+        with self._lock:
+            self._maybe_reload()
+            rows = np.flatnonzero(self._mask(where))
+            if ids is not None:
+                wanted = np.fromiter((self._id_to_row[i] for i in ids if i in self._id_to_row), dtype=int)
+                rows = rows[np.isin(rows, wanted)]
+            rows = rows[offset:offset + limit] if limit is not None else rows[offset:]
+            result = {"ids": [self._ids[r] for r in rows]}
+            if "documents" in include:
+                result["documents"] = [self._texts[r] for r in rows]
+            if "metadatas" in include:
+                result["metadatas"] = [self._metadatas[r] for r in rows]
+            if "embeddings" in include:
+                result["embeddings"] = np.array(self._matrix[rows]) if len(rows) else np.empty((0, self.dim), dtype=np.float32)
+        return result
+
+    def _mask(self, where: Optional[dict]) -> np.ndarray:
+        mask = self._active.copy()
+        for key, value in (where or {}).items():
+            if isinstance(value, dict) and "$eq" in value:
+                value = value["$eq"]
+            if key == "source_file":
+                mask &= self._sources == value
+            else:
+                mask &= np.array([m.get(key) == value for m in self._metadatas], dtype=bool)
+        return mask
+
+    def _top_k(self, scores: np.ndarray, k: int) -> np.ndarray:
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k <= 0:
+            return np.empty(0, dtype=int)
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    def similarity_search_by_vectors(self, queries: np.ndarray, k: int = 4, filter: Optional[dict] = None) -> List[List[Tuple[Document, float]]]:
+        """Batched top-k for a (n_queries, dim) matrix with a single matrix-matrix product."""
+        queries = _normalize_rows(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        with self._lock:
+            self._maybe_reload()
+            if not len(self._ids):
+                return [[] for _ in range(len(queries))]
+            mask = self._mask(filter)
+            if self.quantization is None:
+                scores = queries @ np.asarray(self._matrix).T
+            else:
+                scores = self._approx_scores(queries)
+            scores[:, ~mask] = -np.inf
+            rescore = self.quantization is not None and self.rescore
+            fetch_k = k * self.rescore_factor if rescore else k
+            results = []
+            for qi, row_scores in enumerate(scores):
+                top = self._top_k(row_scores, fetch_k)
+                if rescore and len(top):
+                    # re-score exato: só as linhas candidatas do float32 em disco (em ordem de arquivo)
+                    rows = np.sort(top)
+                    exact = np.asarray(self._matrix[rows], dtype=np.float32) @ queries[qi]
+                    best = np.argsort(-exact)[:k]
+                    top, top_scores = rows[best], exact[best]
+                else:
+                    top_scores = row_scores[top]
+                results.append([
+                    (Document(page_content=self._texts[r], metadata=dict(self._metadatas[r]), id=self._ids[r]), float(score))
+                    for r, score in zip(top, top_scores)
+                ])
+        return results
+
+    def similarity_search_by_vector_with_score(self, embedding: Sequence[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vectors(np.asarray(embedding, dtype=np.float32)[None, :], k=k, filter=filter)[0]
+
+    def similarity_search_by_vector(self, embedding: Sequence[float], k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, filter=filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Tuple[Document, float]]:
+        return self.similarity_search_by_vector_with_score(_encode_query(self._embedding, query), k=k, filter=filter)
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[dict] = None, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, filter=filter)]
+
+    def batch_similarity_search(self, queries: Sequence[str], k: int = 4, filter: Optional[dict] = None) -> List[List[Document]]:
+        """Embed all `queries` in one encode call and search them with one product."""
+        if not queries:
+            return []
+        matrix = _encode_texts(self._embedding, list(queries))
+        return [[doc for doc, _ in hits] for hits in self.similarity_search_by_vectors(matrix, k=k, filter=filter)]
+
+    def _select_relevance_score_fn(self):
+        # similaridade de cosseno em [-1, 1] -> relevância em [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None, ids: Optional[List[str]] = None, persist_directory: str = "./vdb", collection_name: str = "book", **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(embedding, persist_directory=persist_directory, collection_name=collection_name)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
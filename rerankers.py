@@ -0,0 +1,239 @@
+import os
+import math
+import time
+import asyncio
+import threading
+from collections import Counter
+from typing import Any, List, Optional, Sequence
+
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from caching import LRUCache
+from ingestion import text_sha1
+from lexical_index import tokenize
+from retrievers import document_key
+
+
+class LexicalReranker:
+    """Cheap (query, chunk) scorer: BM25 of the chunk for the query plus query-term coverage.
+
+    IDF comes from the collection's BM25 index when one is given (cached per term for
+    `idf_ttl` seconds), otherwise every term weighs 1; the fraction of distinct query
+    terms the chunk contains is added on top, so a chunk that mentions all the technical
+    terms of a question beats one that repeats a single term. Each pair's score depends
+    only on the pair, so it can be cached. Pure Python, microseconds per pair.
+    """
+
+    name = "lexical"
+
+    def __init__(self, lexical_index=None, k1: float = 1.2, b: float = 0.75, avgdl: float = 150.0, coverage_weight: float = 1.0, idf_ttl: float = 600.0):
+        self.lexical_index = lexical_index
+        self.model_name = getattr(lexical_index, "db_path", "")
+        self.k1 = k1
+        self.b = b
+        self.avgdl = avgdl
+        self.coverage_weight = coverage_weight
+        self._idf = LRUCache(maxsize=8192, ttl=idf_ttl)
+
+    def load(self):
+        return None
+
+    def _idfs(self, terms: List[str]) -> dict:
+        idf = {t: self._idf.get(t) for t in terms}
+        missing = [t for t, v in idf.items() if v is None]
+        if missing:
+            n_docs, df = self.lexical_index.document_frequencies(missing) if self.lexical_index is not None else (0, {})
+            for t in missing:
+                idf[t] = math.log(1.0 + (n_docs - df.get(t, 0) + 0.5) / (df.get(t, 0) + 0.5)) if n_docs else 1.0
+                self._idf.put(t, idf[t])
+        return idf
+
+    def score(self, query: str, texts: Sequence[str]) -> List[float]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not texts:
+            return [0.0] * len(texts)
+        idf = self._idfs(terms)
+        scores = []
+        for text in texts:
+            counts = Counter(tokenize(text))
+            length = sum(counts.values())
+            bm25 = 0.0
+            for t in terms:
+                tf = counts.get(t, 0)
+                if tf:
+                    bm25 += idf[t] * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.avgdl))
+            coverage = sum(1 for t in terms if t in counts) / len(terms)
+            scores.append(bm25 + self.coverage_weight * coverage)
+        return scores
+
+
+class CrossEncoderReranker:
+    """Local CPU cross-encoder (sentence-transformers `CrossEncoder`), loaded on first use.
+
+    The default model is a small multilingual MiniLM trained on mMARCO, which handles
+    Portuguese questions over Portuguese or English articles. Pairs are scored in
+    batches of `batch_size`.
+    """
+
+    name = "cross-encoder"
+
+    def __init__(self, model_name: str = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1", device: str = "cpu", batch_size: int = 16, max_length: int = 384):
+        self.model_name = model_name
+        self.device = device
+        self.batch_size = max(1, int(batch_size))
+        self.max_length = max_length
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError as e:
+                    raise RuntimeError("The cross-encoder reranker requires sentence-transformers (pip install sentence-transformers).") from e
+                self._model = CrossEncoder(self.model_name, device=self.device, max_length=self.max_length)
+            return self._model
+
+    def score(self, query: str, texts: Sequence[str]) -> List[float]:
+        if not texts:
+            return []
+        model = self.load()
+        scores = model.predict([(query, t) for t in texts], batch_size=self.batch_size, show_progress_bar=False)
+        return [float(s) for s in scores]
+
+
+class Reranker:
+    """Second-stage reranking with a pair-score cache and a latency budget.
+
+    Scores are cached per (scorer, normalized query, chunk) in an LRU, so the same chunk
+    is never re-scored for a repeated question (exercise and follow-up turns re-ask the
+    same queries). At most `max_candidates` are reranked, and fewer when the average
+    cost per pair measured so far says the uncached pairs would not fit in `budget_ms`;
+    scoring runs in batches and stops at the deadline. Candidates left unscored keep
+    their first-stage order after the reranked ones.
+    """
+
+    def __init__(self, scorer, max_candidates: int = 30, budget_ms: Optional[float] = 300.0, batch_size: int = 16, cache_size: int = 4096):
+        self.scorer = scorer
+        self.max_candidates = max(1, int(max_candidates))
+        self.budget_ms = budget_ms
+        self.batch_size = max(1, int(batch_size))
+        self.cache = LRUCache(maxsize=cache_size)
+        self._pair_ms = None
+        self._lock = threading.Lock()
+
+    def _cache_key(self, query_key: str, doc: Document):
+        return (self.scorer.name, getattr(self.scorer, "model_name", ""), query_key, document_key(doc))
+
+    def _record_cost(self, elapsed_ms: float, pairs: int):
+        per_pair = elapsed_ms / max(1, pairs)
+        with self._lock:
+            # média móvel do custo por par, usada para decidir quantos candidatos cabem no orçamento
+            self._pair_ms = per_pair if self._pair_ms is None else 0.7 * self._pair_ms + 0.3 * per_pair
+
+    def rerank(self, query: str, docs: Sequence[Document], k: Optional[int] = None) -> List[Document]:
+        """`docs` reordered by the scorer (best first), cut to `k`."""
+        docs = list(docs)
+        k = len(docs) if k is None else k
+        if len(docs) <= 1 or not (query or "").strip():
+            return docs[:k]
+        query_key = text_sha1(" ".join(query.lower().split()))
+        head = docs[:self.max_candidates]
+        scores = [self.cache.get(self._cache_key(query_key, doc)) for doc in head]
+        pending = [i for i, s in enumerate(scores) if s is None]
+        if pending:
+            # carregar o modelo antes de medir: o primeiro load não conta no orçamento
+            self.scorer.load()
+        if pending and self.budget_ms and self._pair_ms:
+            # só os pares que cabem no orçamento, segundo o custo médio medido até agora
+            pending = pending[:max(1, int(self.budget_ms / self._pair_ms))]
+        deadline = time.perf_counter() + self.budget_ms / 1000.0 if self.budget_ms else None
+        for start in range(0, len(pending), self.batch_size):
+            if deadline is not None and start and time.perf_counter() >= deadline:
+                break
+            batch = pending[start:start + self.batch_size]
+            t0 = time.perf_counter()
+            batch_scores = self.scorer.score(query, [head[i].page_content for i in batch])
+            self._record_cost((time.perf_counter() - t0) * 1000.0, len(batch))
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+                self.cache.put(self._cache_key(query_key, head[i]), score)
+        scored = sorted((i for i, s in enumerate(scores) if s is not None), key=lambda i: scores[i], reverse=True)
+        unscored = [i for i, s in enumerate(scores) if s is None]
+        ordered = [head[i] for i in scored + unscored] + docs[len(head):]
+        return ordered[:k]
+
+
+class RerankingRetriever(BaseRetriever):
+    """Runs an inner retriever for `fetch_multiplier * k` candidates and keeps the `k` best by `reranker`.
+
+    If the scorer fails (e.g. the cross-encoder cannot be loaded), the first-stage
+    ranking is returned, so retrieval never breaks because of the second stage.
+    """
+
+    inner: BaseRetriever
+    reranker: Any
+    vectorstore: Any = None
+    search_kwargs: dict = {"k": 7}
+    fetch_multiplier: int = 3
+
+    def _fetch_args(self, kwargs):
+        search_kwargs = {**self.search_kwargs, **kwargs}
+        k = int(search_kwargs.pop("k", 7))
+        return k, {**search_kwargs, "k": max(k, k * self.fetch_multiplier)}
+
+    def _rerank(self, query: str, docs: List[Document], k: int) -> List[Document]:
+        try:
+            return self.reranker.rerank(query, docs, k)
+        except Exception:
+            return list(docs)[:k]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        k, fetch_kwargs = self._fetch_args(kwargs)
+        return self._rerank(query, self.inner.invoke(query, **fetch_kwargs), k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        k, fetch_kwargs = self._fetch_args(kwargs)
+        docs = await self.inner.ainvoke(query, **fetch_kwargs)
+        # o cross-encoder é CPU-bound: fora do event loop
+        return await asyncio.to_thread(self._rerank, query, docs, k)
+
+
+_RERANKERS = {}
+_RERANKERS_LOCK = threading.Lock()
+
+
+def get_reranker(kind: Optional[str] = None, lexical_index=None) -> Optional[Reranker]:
+    """Process-wide Reranker of the given kind, or None when reranking is off.
+
+    `kind` (default: `RAG_RERANKER`, "off"): "lexical" (IDF from `lexical_index`) or
+    "cross-encoder". The
+    cross-encoder model is `RAG_RERANK_MODEL`; `RAG_RERANK_MAX_CANDIDATES` (default 30),
+    `RAG_RERANK_BUDGET_MS` (default 300; 0 = unlimited) and `RAG_RERANK_BATCH_SIZE`
+    (default 16) bound the work per query.
+    """
+    kind = (kind or os.environ.get("RAG_RERANKER", "off")).strip().lower()
+    if kind in ("", "0", "off", "none", "false", "no"):
+        return None
+    if kind not in ("lexical", "cross-encoder", "cross_encoder", "crossencoder"):
+        raise ValueError(f"Unknown reranker '{kind}'. Available: lexical, cross-encoder")
+    kind = "lexical" if kind == "lexical" else "cross-encoder"
+    batch_size = int(os.environ.get("RAG_RERANK_BATCH_SIZE", "16"))
+    model_name = os.environ.get("RAG_RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+    key = (kind, model_name if kind == "cross-encoder" else getattr(lexical_index, "db_path", None))
+    with _RERANKERS_LOCK:
+        reranker = _RERANKERS.get(key)
+        if reranker is None:
+            scorer = LexicalReranker(lexical_index) if kind == "lexical" else CrossEncoderReranker(model_name, batch_size=batch_size)
+            budget_ms = float(os.environ.get("RAG_RERANK_BUDGET_MS", "300"))
+            reranker = Reranker(
+                scorer,
+                max_candidates=int(os.environ.get("RAG_RERANK_MAX_CANDIDATES", "30")),
+                budget_ms=budget_ms if budget_ms > 0 else None,
+                batch_size=batch_size,
+            )
+            _RERANKERS[key] = reranker
+        return reranker
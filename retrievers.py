@@ -0,0 +1,299 @@
+import asyncio
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from ingestion import text_sha1
+from numpy_store import _encode_query, _encode_texts, _normalize_rows
+
+
+def document_key(doc: Document) -> str:
+    """Stable identity of a retrieved chunk: its chunk_id, or a hash of source/page/text."""
+    meta = getattr(doc, "metadata", {}) or {}
+    if meta.get("chunk_id"):
+        return meta["chunk_id"]
+    return text_sha1(f"{meta.get('source_file')}|{meta.get('page_number')}|{doc.page_content}")
+
+
+def multi_query_retrieve(retriever, queries: Sequence[str], max_concurrency: Optional[int] = None) -> List[List[Document]]:
+    """Run several queries through `retriever` at once; returns one ranking per query.
+
+    All query embeddings are computed in one batched encode call (`embed_queries_array`
+    primes the embeddings' query LRU, so each search reuses its vector), then the
+    searches run concurrently through `Runnable.batch`. Repeated queries are searched
+    once. Empty queries get an empty ranking.
+    """
+    unique = list(dict.fromkeys(q for q in queries if q and q.strip()))
+    if not unique:
+        return [[] for _ in queries]
+    embeddings = getattr(getattr(retriever, "vectorstore", None), "embeddings", None)
+    if hasattr(embeddings, "embed_queries_array"):
+        embeddings.embed_queries_array(unique)
+    results = retriever.batch(unique, config={"max_concurrency": max_concurrency or len(unique)})
+    by_query = dict(zip(unique, results))
+    return [list(by_query.get(q, [])) for q in queries]
+
+
+def _source_of(doc: Document) -> str:
+    meta = getattr(doc, "metadata", {}) or {}
+    return str(meta.get("source_file", meta.get("source", "")))
+
+
+def merge_with_source_diversity(rankings: Sequence[Sequence[Document]], limits: Sequence[int], max_total: int) -> List[Document]:
+    """Merge prioritized rankings (each cut to its limit) into at most `max_total` chunks.
+
+    Duplicates are dropped by `document_key` (a hash, not Document equality). Then each
+    source gets at most ceil(max_total / number of sources) slots in a first pass, in
+    priority order, and any free slots are filled with the remaining candidates, so one
+    article cannot take all the slots while others have relevant chunks.
+    """
+    seen = set()
+    candidates = []
+    for ranking, limit in zip(rankings, limits):
+        for doc in list(ranking)[:limit]:
+            key = document_key(doc)
+            if key in seen:
+                continue
+            seen.add(key)
+            candidates.append(doc)
+    if not candidates or max_total <= 0:
+        return []
+    quota = -(-max_total // len({_source_of(d) for d in candidates}))
+    picked, leftovers, per_source = [], [], {}
+    for doc in candidates:
+        source = _source_of(doc)
+        if len(picked) < max_total and per_source.get(source, 0) < quota:
+            picked.append(doc)
+            per_source[source] = per_source.get(source, 0) + 1
+        else:
+            leftovers.append(doc)
+    picked.extend(leftovers[:max_total - len(picked)])
+    return picked
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Document]], k: int, rrf_k: int = 60) -> List[Document]:
+    """Merge several ranked lists with RRF: score(d) = sum over lists of 1 / (rrf_k + rank)."""
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = document_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank)
+            docs.setdefault(key, doc)
+    ordered = sorted(scores, key=lambda key: scores[key], reverse=True)
+    return [docs[key] for key in ordered[:k]]
+
+
+def maximal_marginal_relevance(
+    query_vector: np.ndarray,
+    candidates: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.5,
+    groups: Optional[Sequence] = None,
+    max_per_group: Optional[int] = None,
+) -> List[int]:
+    """Indices of `k` rows of `candidates` picked by maximal marginal relevance.
+
+    Each step takes the row maximizing `lambda_mult * sim(query, row) - (1 - lambda_mult)
+    * max sim(row, already picked)`. The candidate-candidate similarities are one matrix
+    product and the running redundancy is updated with a vectorized `maximum`, so the
+    whole selection is O(n * k) NumPy work. With `max_per_group`, a group (e.g. a source
+    file) stops receiving picks once it has that many; if that leaves fewer than `k`
+    picks, the quota is lifted for the remaining slots.
+    """
+    n = len(candidates)
+    k = min(int(k), n)
+    if k <= 0:
+        return []
+    matrix = _normalize_rows(np.asarray(candidates, dtype=np.float32))
+    query = _normalize_rows(np.asarray(query_vector, dtype=np.float32)[None, :])[0]
+    relevance = matrix @ query
+    similarity = matrix @ matrix.T
+    redundancy = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    group_ids = None
+    if groups is not None and max_per_group:
+        _, group_ids = np.unique(np.asarray([str(g) for g in groups]), return_inverse=True)
+        group_counts = np.zeros(group_ids.max() + 1, dtype=int)
+    picked = []
+    while len(picked) < k:
+        candidates_mask = available
+        if group_ids is not None:
+            candidates_mask = available & (group_counts[group_ids] < max_per_group)
+            if not candidates_mask.any():
+                # cotas esgotadas: completar com os restantes
+                group_ids = None
+                candidates_mask = available
+        scores = np.where(candidates_mask, lambda_mult * relevance - (1.0 - lambda_mult) * redundancy, -np.inf)
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+        if group_ids is not None:
+            group_counts[group_ids[best]] += 1
+    return picked
+
+
+def candidate_vectors(vectorstore, embeddings, docs: Sequence[Document]) -> np.ndarray:
+    """Embeddings of retrieved `docs`, read back from the vector store instead of re-encoded.
+
+    Chunks are stored under their `chunk_id`, so a single `get(ids=..., include=["embeddings"])`
+    (Chroma, NumpyVectorStore) returns the stored rows; only chunks the store cannot
+    return (e.g. legacy ids) are encoded again.
+    """
+    keys = [getattr(doc, "id", None) or (doc.metadata or {}).get("chunk_id") for doc in docs]
+    stored = {}
+    wanted = [key for key in dict.fromkeys(keys) if key]
+    if wanted and vectorstore is not None and hasattr(vectorstore, "get"):
+        try:
+            got = vectorstore.get(ids=wanted, include=["embeddings"])
+            vectors = got.get("embeddings")
+            if vectors is not None:
+                stored = {i: np.asarray(v, dtype=np.float32) for i, v in zip(got.get("ids") or [], vectors)}
+        except Exception:
+            stored = {}
+    missing = [i for i, key in enumerate(keys) if key not in stored]
+    encoded = _encode_texts(embeddings, [docs[i].page_content for i in missing]) if missing else None
+    rows = []
+    fresh = iter(encoded if encoded is not None else [])
+    for key in keys:
+        rows.append(stored[key] if key in stored else next(fresh))
+    return np.stack(rows).astype(np.float32, copy=False)
+
+
+class MMRRetriever(BaseRetriever):
+    """Diversity re-ranking over an over-fetched candidate set of an inner retriever.
+
+    The inner retriever (plain vector or hybrid) is asked for `fetch_multiplier * k`
+    candidates; their stored embeddings (see `candidate_vectors`) and the query vector
+    (served from the embeddings' query LRU) feed `maximal_marginal_relevance`, so near
+    duplicates from the same page give way to other evidence. `max_per_source` caps how
+    many of the `k` results one source file may take.
+    """
+
+    inner: BaseRetriever
+    vectorstore: Any
+    search_kwargs: dict = {"k": 7}
+    fetch_multiplier: int = 4
+    lambda_mult: float = 0.5
+    max_per_source: Optional[int] = None
+
+    def _fetch_args(self, kwargs):
+        search_kwargs = {**self.search_kwargs, **kwargs}
+        k = int(search_kwargs.pop("k", 7))
+        return k, {**search_kwargs, "k": max(k, k * self.fetch_multiplier)}
+
+    def _rerank(self, query: str, docs: List[Document], k: int) -> List[Document]:
+        if len(docs) <= 1:
+            return list(docs)[:k]
+        embeddings = self.vectorstore.embeddings
+        matrix = candidate_vectors(self.vectorstore, embeddings, docs)
+        picked = maximal_marginal_relevance(
+            _encode_query(embeddings, query),
+            matrix,
+            k,
+            lambda_mult=self.lambda_mult,
+            groups=[_source_of(doc) for doc in docs],
+            max_per_group=self.max_per_source,
+        )
+        return [docs[i] for i in picked]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        k, fetch_kwargs = self._fetch_args(kwargs)
+        return self._rerank(query, self.inner.invoke(query, **fetch_kwargs), k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        k, fetch_kwargs = self._fetch_args(kwargs)
+        docs = await self.inner.ainvoke(query, **fetch_kwargs)
+        return await asyncio.to_thread(self._rerank, query, docs, k)
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector + BM25 retriever merged with reciprocal rank fusion.
+
+    Both searches over-fetch `fetch_multiplier * k` candidates and honour the same
+    `filter={"source_file": ...}` as the plain vector retriever. `search_kwargs` mirrors
+    `VectorStoreRetriever` so callers can keep tuning `k` the same way.
+    """
+
+    vectorstore: Any
+    lexical_index: Any
+    search_kwargs: dict = {"k": 7}
+    fetch_multiplier: int = 3
+    rrf_k: int = 60
+
+    def _search_args(self, kwargs):
+        search_kwargs = {**self.search_kwargs, **kwargs}
+        k = int(search_kwargs.pop("k", 7))
+        fetch_k = max(k, k * self.fetch_multiplier)
+        source_file = (search_kwargs.get("filter") or {}).get("source_file")
+        return k, fetch_k, source_file, search_kwargs
+
+    def _lexical_search(self, query: str, fetch_k: int, source_file) -> List[Document]:
+        return [doc for doc, _ in self.lexical_index.search(query, k=fetch_k, source_file=source_file)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        k, fetch_k, source_file, search_kwargs = self._search_args(kwargs)
+        vector_hits = self.vectorstore.similarity_search(query, k=fetch_k, **search_kwargs)
+        lexical_hits = self._lexical_search(query, fetch_k, source_file)
+        return reciprocal_rank_fusion([vector_hits, lexical_hits], k=k, rrf_k=self.rrf_k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        # as duas buscas (embedding da consulta + BM25 em SQLite) rodam em paralelo fora do event loop
+        k, fetch_k, source_file, search_kwargs = self._search_args(kwargs)
+        vector_hits, lexical_hits = await asyncio.gather(
+            asyncio.to_thread(self.vectorstore.similarity_search, query, k=fetch_k, **search_kwargs),
+            asyncio.to_thread(self._lexical_search, query, fetch_k, source_file),
+        )
+        return reciprocal_rank_fusion([vector_hits, lexical_hits], k=k, rrf_k=self.rrf_k)
+
+
+def _freeze(value):
+    """Hashable form of search kwargs (dicts/lists become sorted tuples)."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class CachedRetriever(BaseRetriever):
+    """Caches the results of an inner retriever per (query, search kwargs, index generation).
+
+    `generation_fn` returns the current index generation (bumped by every ingest), so
+    entries from before new PDFs arrived are never served; the cache TTL bounds how
+    long a result may be reused at all. The `cache` can be shared by every session of the
+    process via `namespace`, which identifies the underlying index.
+    """
+
+    inner: BaseRetriever
+    cache: Any
+    generation_fn: Callable[[], int]
+    namespace: str = ""
+    vectorstore: Any = None
+    search_kwargs: dict = {"k": 7}
+
+    def _cache_key(self, query: str, search_kwargs: dict):
+        normalized = " ".join((query or "").lower().split())
+        return (self.namespace, self.generation_fn(), normalized, _freeze(search_kwargs))
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        search_kwargs = {**self.search_kwargs, **kwargs}
+        key = self._cache_key(query, search_kwargs)
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = self.inner.invoke(query, **search_kwargs)
+            self.cache.put(key, list(docs))
+        return list(docs)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        search_kwargs = {**self.search_kwargs, **kwargs}
+        key = self._cache_key(query, search_kwargs)
+        docs = self.cache.get(key)
+        if docs is None:
+            docs = await self.inner.ainvoke(query, **search_kwargs)
+            self.cache.put(key, list(docs))
+        return list(docs)
@@ -0,0 +1,226 @@
+import os
+import re
+import math
+import heapq
+import threading
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional
+
+from history_store import HistoryStore, get_history_store, parse_history_line
+from lexical_index import BM25Index, fold_accents
+
+
+_WORD_RE = re.compile(r"\w+", flags=re.UNICODE)
+
+# palavras de conversa que nunca são bons termos de busca (a IDF do corpus cuida do resto)
+CHAT_STOPWORDS = frozenset(fold_accents(w) for w in (
+    "colaborai", "user", "assistant", "sobre", "então", "também", "quando", "porque", "alguém",
+    "pessoal", "obrigado", "obrigada", "valeu", "beleza", "gente", "pode", "podemos", "poderia",
+    "vamos", "queria", "quero", "acho", "achei", "explicar", "explica", "resumo", "resumir",
+    "artigo", "artigos", "exercícios", "exercicio", "pergunta", "perguntas", "alguma", "algum",
+))
+
+
+class DiscussionTermStats:
+    """TF-IDF keyword model of the recent conversation, updated incrementally.
+
+    Keeps term frequencies of the last `window` messages of the history log, for the
+    whole discussion and per participant (assistant messages count for the discussion
+    only). `update` consumes just the lines appended since the previous call, through
+    the log's offset index, and subtracts the messages that leave the window, so it
+    never rescans the history; when the log is untouched (same inode/size/mtime) it does
+    no I/O at all.
+
+    Document frequencies come from the BM25 index of the articles: a term scores
+    `tf * log(1 + (N - df + 0.5) / (df + 0.5))`, so words present in every chunk score
+    low, and terms absent from the corpus are ignored (they cannot improve a search over
+    the articles). DFs are looked up once per term and kept until `generation_fn`
+    changes (new PDFs indexed); rankings are memoized until the next change.
+    """
+
+    def __init__(
+        self,
+        store: HistoryStore,
+        lexical_index: Optional[BM25Index] = None,
+        window: int = 50,
+        min_length: int = 5,
+        generation_fn: Optional[Callable[[], int]] = None,
+    ):
+        self.store = store
+        self.lexical_index = lexical_index
+        self.window = max(1, int(window))
+        self.min_length = max(1, int(min_length))
+        self.generation_fn = generation_fn
+        self._messages = deque()
+        self._team = Counter()
+        self._by_user: Dict[str, Counter] = {}
+        self._surface = {}
+        self._count = 0
+        self._pushed = 0
+        self._stat_key = None
+        self._df = {}
+        self._n_docs = None
+        self._generation = None
+        self._ranked = {}
+        self._lock = threading.Lock()
+
+    # ------------------------------------------------------------------ updates
+    def _terms(self, text: str) -> Counter:
+        terms = Counter()
+        for word in _WORD_RE.findall((text or "").lower()):
+            term = fold_accents(word)
+            if len(term) < self.min_length or not term.isalpha() or term in CHAT_STOPWORDS:
+                continue
+            terms[term] += 1
+            # forma acentuada mais recente, para devolver palavras legíveis
+            self._surface[term] = word
+        return terms
+
+    def _push(self, line: str):
+        record = parse_history_line(line)
+        if record is None:
+            self._messages.append((None, Counter()))
+        else:
+            user = (record.user or "Usuário") if record.role == "user" else None
+            terms = self._terms(record.content)
+            # o nome dos participantes não é assunto da discussão
+            if user:
+                for part in self._terms(user):
+                    terms.pop(part, None)
+            self._messages.append((user, terms))
+            self._team.update(terms)
+            if user:
+                self._by_user.setdefault(user, Counter()).update(terms)
+        while len(self._messages) > self.window:
+            user, terms = self._messages.popleft()
+            self._team.subtract(terms)
+            counts = self._by_user.get(user) if user else None
+            # o contador pode já ter sido apagado: as mensagens restantes do participante
+            # podem não ter nenhum termo ("ok", "sim", "@colaborai")
+            if counts is not None:
+                counts.subtract(terms)
+                if not +counts:
+                    del self._by_user[user]
+        # apagar as contagens zeradas a cada `window` mensagens, para o vocabulário acompanhar a janela
+        self._pushed += 1
+        if self._pushed % self.window == 0:
+            self._team = +self._team
+            self._by_user = {u: +c for u, c in self._by_user.items()}
+            self._surface = {t: w for t, w in self._surface.items() if t in self._team}
+
+    def _reset(self):
+        self._messages.clear()
+        self._team = Counter()
+        self._by_user = {}
+        self._count = 0
+
+    def update(self) -> int:
+        """Consume the messages appended since the last call; returns the log's record count."""
+        with self._lock:
+            try:
+                st = os.stat(self.store.path)
+            except FileNotFoundError:
+                if self._count or self._messages:
+                    self._reset()
+                    self._ranked.clear()
+                self._stat_key = None
+                return 0
+            key = (st.st_ino, st.st_size, st.st_mtime_ns)
+            if key == self._stat_key:
+                return self._count
+            count = self.store.refresh()
+            replaced = self._stat_key is not None and self._stat_key[0] != st.st_ino
+            if replaced or count < self._count or count - self._count > self.window:
+                self._reset()
+            start = max(self._count, count - self.window)
+            if start < count:
+                for line in self.store.lines_range(start, count):
+                    self._push(line)
+                self._ranked.clear()
+            self._count = count
+            self._stat_key = key
+            return count
+
+    # ------------------------------------------------------------------ scoring
+    def _refresh_generation(self):
+        generation = self.generation_fn() if self.generation_fn is not None else None
+        if generation != self._generation:
+            self._generation = generation
+            self._df.clear()
+            self._n_docs = None
+            self._ranked.clear()
+
+    def _idf(self, terms) -> Dict[str, float]:
+        if self.lexical_index is None:
+            return {t: 1.0 for t in terms}
+        missing = [t for t in terms if t not in self._df]
+        if missing or self._n_docs is None:
+            self._n_docs, found = self.lexical_index.document_frequencies(missing)
+            self._df.update(found)
+        if not self._n_docs:
+            # sem corpus indexado no BM25: só a frequência na conversa
+            return {t: 1.0 for t in terms}
+        n = self._n_docs
+        return {
+            t: math.log(1.0 + (n - self._df[t] + 0.5) / (self._df[t] + 0.5))
+            for t in terms
+            if self._df.get(t)
+        }
+
+    def _top(self, counts: Counter, n: int) -> List[str]:
+        counts = +counts
+        idf = self._idf(list(counts))
+        scored = ((tf * idf[t], t) for t, tf in counts.items() if t in idf)
+        return [self._surface.get(t, t) for _, t in heapq.nlargest(n, scored)]
+
+    def top_keywords(self, n: int = 8, participant: Optional[str] = None) -> List[str]:
+        """The `n` most discriminative terms of the discussion (or of one participant's messages)."""
+        self.update()
+        with self._lock:
+            self._refresh_generation()
+            key = (participant, n)
+            if key not in self._ranked:
+                counts = self._team if participant is None else self._by_user.get(participant, Counter())
+                self._ranked[key] = self._top(counts, n) if n > 0 else []
+            return list(self._ranked[key])
+
+    def participant_keywords(self, n: int = 3, participants: Optional[List[str]] = None) -> Dict[str, List[str]]:
+        """{participant: top `n` terms of their recent messages}, for participants with any."""
+        self.update()
+        with self._lock:
+            names = list(self._by_user) if participants is None else [p for p in participants if p in self._by_user]
+        result = {}
+        for name in names:
+            keywords = self.top_keywords(n, participant=name)
+            if keywords:
+                result[name] = keywords
+        return result
+
+
+_TERM_STATS = {}
+_TERM_STATS_LOCK = threading.Lock()
+
+
+def get_discussion_term_stats(
+    history_path: str,
+    lexical_index: Optional[BM25Index] = None,
+    generation_fn: Optional[Callable[[], int]] = None,
+) -> DiscussionTermStats:
+    """Process-wide DiscussionTermStats for (`history_path`, BM25 index).
+
+    `RAG_DISCUSSION_WINDOW` (messages, default 50) sets how much of the recent
+    conversation the keywords are drawn from.
+    """
+    store = get_history_store(history_path)
+    key = (store.path, getattr(lexical_index, "db_path", None))
+    with _TERM_STATS_LOCK:
+        stats = _TERM_STATS.get(key)
+        if stats is None:
+            stats = DiscussionTermStats(
+                store,
+                lexical_index,
+                window=int(os.environ.get("RAG_DISCUSSION_WINDOW", "50")),
+                generation_fn=generation_fn,
+            )
+            _TERM_STATS[key] = stats
+        return stats
@@ -0,0 +1,19 @@
+from history_store import format_history_line, get_history_store
+from term_stats import DiscussionTermStats
+
+
+def _append(path, role, user, content):
+    with open(path, "a", encoding="utf-8") as fh:
+        fh.write(format_history_line(role, user, content))
+
+
+def test_evicting_termless_message_of_dropped_participant(tmp_path):
+    # o contador de Artur zera quando a mensagem com termos sai da janela, mas "ok" ainda está nela
+    path = str(tmp_path / "conversation_history.txt")
+    stats = DiscussionTermStats(get_history_store(path), window=3)
+    messages = [("Artur", "metodologia experimental robusta"), ("Artur", "ok")] + [("Pedro", "sim")] * 3
+    for user, content in messages:
+        _append(path, "user", user, content)
+        stats.top_keywords()
+    assert stats.top_keywords() == []
+    assert stats.participant_keywords() == {}